@@ -81,6 +81,27 @@ Similar to mark_function_args_lack_nltext, but you indicate the
 value of an argument.  This is useful for code like
    {{ add_tag("http://example.com") }}
 
+*** I18nizeConfig(ok_functions=(...), ...)
+
+The calls above change the customizations for everyone in the
+process.  If you need different customizations in different places
+-- say, two sites' templates in one process -- make an I18nizeConfig
+for each, and pass it to get_parser_for_file() (or to the lexers and
+text handlers).  I18nizeConfig().replace(...) is handy for this.
+
+*** load_config("i18nize.toml")
+
+Or you can describe your customizations in a TOML or JSON file, and
+use load_config() to get an I18nizeConfig for them.  This is what the
+--config flag does.  The file has one list for each of the calls
+above, which adds to the defaults just like the calls do:
+   nltext_tag_attributes = [["span", "myapp-description"],
+                            ["input", "value", ["type", "reset"]]]
+   nltext_separator_classes = ["separator"]
+   ok_functions = ["log.date.strftime"]
+   ok_function_params = ["style"]
+   ok_function_arguments = ["http://.*"]
+
 
 -- HOW IT WORKS:
 
@@ -193,13 +214,34 @@ The second usage modifies the files in-place.
 
 from.exceptions import HTMLParseError
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
 import html.entities
+import json
 import _markupbase
+import os
 import re
+import shutil
+import sqlite3
 import string
 import sys
+import tempfile
+import threading
 import unicodedata
 
+try:
+    import tomllib
+except ImportError:      # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
 
 # Taken from http://www.htmlhelp.com/reference/html40/inline.html
 # I've removed 'input' and 'textarea' since, while inline, they still
@@ -228,8 +270,8 @@ NATURAL_LANGUAGE_TAG_ATTRIBUTES = [
     ('input', 'value', ('type', 'text')),
 ]
 
-# A more code-friendly version of the above, set lazily.
-_NL_ATTR_MAP = None
+_DEFAULT_NATURAL_LANGUAGE_TAG_ATTRIBUTES = tuple(
+    NATURAL_LANGUAGE_TAG_ATTRIBUTES)
 
 
 # These are tag-classes that indicate an element separates
@@ -243,8 +285,11 @@ NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING = [
     'separator',
 ]
 
-_NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE = re.compile(
-    '(^| )(%s)( |$)' % '|'.join(NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING))
+_DEFAULT_NATURAL_LANGUAGE_SEPARATOR_CLASSES = tuple(
+    NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING)
+
+# The compiled version of the above, as used by the default config.
+_NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE = None
 
 
 # --- Regexps for Jinja2 functions.
@@ -275,73 +320,761 @@ _NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE = re.compile(
 # function-name, function-parameter, or function-argument exactly
 # (so no subset matching; put in .*'s if you need to).
 
+_DEFAULT_OK_FUNCTIONS = (
+    # jinja2 functions/filters
+    'attr',
+    'dictsort',
+    'groupby',
+    'int',
+    'map',
+    'reject',
+    'rejectattr',
+    'round',
+    'select',
+    'selectattr',
+    'sort',
+    'striptags',
+    'sum',
+    'urlize',
+    # django functions/filters
+    'center',
+    'date',
+    'dictsortreversed',
+    'divisibleby',
+    'floatformat',
+    'get_digit',
+    'length_is',
+    'ljust',
+    'removetags',
+    'rjust',
+    'slice',
+    'stringformat',
+    'time',
+    # functions/filters that indicate the args are already marked
+    '_',
+    'ngettext',
+    'i18n_do_not_translate',
+    # Khan-academy specific.  TODO(csilvers): move to KA-specific place.
+    'js_css_packages.package',
+    'handlebars_template',
+    'youtube.player_embed',
+    'log.date.strftime',
+    'emails.tracking_image_url',
+)
+
+_DEFAULT_OK_FUNCTION_PARAMS = (
+    'style',
+)
+
+_DEFAULT_OK_FUNCTION_ARGUMENTS = (
+    r'[^a-zA-Z]*',     # TODO(csilvers): have a better not-alnum RE
+    r'https?://.*',
+    r'([0-9]+px *)*',
+)
+
+# The lists the mark_* fns below add to.  _init() resets them.
 _OK_FUNCTIONS = []
-_OK_FUNCTIONS_RE = None     # set for real via the mark_* fn below.
 _OK_FUNCTION_PARAMS = []
-_OK_FUNCTION_PARAMS_RE = None
 _OK_FUNCTION_ARGUMENTS = []
-_OK_FUNCTION_ARGUMENTS_RE = None
+
+# The same {{ expressions }} show up over and over again in templates,
+# so we remember how we rewrote the most recent ones.  Likewise, the
+# same tags show up over and over again: '<br>', '<span
+# class="muted">', '<input type="submit" value="Save">'.  We remember
+# which class-attributes make a tag separate nl-text, and how the
+# text handlers rewrote the most recent tags.  All of these depend on
+# the customizations, so each I18nizeConfig has its own memos.
+_EXPRESSION_CACHE_SIZE = 10000
+_TAG_CACHE_SIZE = 10000
+
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   ('hits', 'misses', 'maxsize', 'currsize'))
+
+
+class _TagRewriteCache(object):
+    """Remembers how text handlers rewrote the most recent tags.
+
+    This is like functools.lru_cache, but it's keyed by the kind of
+    text handler (see NullTextHandler.__init__) and the tag text,
+    rather than by the arguments to the fn that does the rewriting.
+    It's shared by all text handlers with the same I18nizeConfig, so
+    it lasts across files, and across threads.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, handler_key, tag, rewrite_fn):
+        """Return rewrite_fn(tag), or what it returned last time."""
+        key = (handler_key, tag)
+        with self._lock:
+            rewritten = self._entries.get(key)
+            if rewritten is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return rewritten
+            self.misses += 1
+        # We don't hold the lock while rewriting: it's slow, and
+        # rewriting the tag's attributes can need the lock itself.
+        rewritten = str(rewrite_fn(tag))
+        with self._lock:
+            # We don't want to hold on to StartTags' parsed attrs.
+            self._entries[(handler_key, str(tag))] = rewritten
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return rewritten
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._entries))
+
+
+# Site chrome -- footers, nav items, 'Learn more' buttons -- gives
+# the same runs of nl-text in file after file.  If asked to, we
+# remember the markup we emitted for the most recent runs, using up
+# to max_bytes of memory (roughly: we count characters).
+RunCacheInfo = collections.namedtuple(
+    'RunCacheInfo',
+    ('hits', 'misses', 'maxsize', 'currsize', 'bytes_saved'))
+
+
+class _RunCache(object):
+    """Remembers the markup text handlers emitted for recent nltext runs.
+
+    It's keyed by the kind of text handler (like _TagRewriteCache),
+    the I18nizeConfig, and the segments in the run.  When the
+    segments and markup we remember take up more than max_bytes, we
+    forget the least recently used ones.  If db is not None, it's a
+    _RunCacheDb we look in before calling add_i18n(), and save the
+    results to.  Threads can share it: we use the db, too, only while
+    holding our lock.
+    """
+    def __init__(self, max_bytes, db=None):
+        self.max_bytes = max_bytes
+        self.db = db
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # key -> (markup, size)
+            self._entries = collections.OrderedDict()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.bytes_saved = 0
+
+    def get(self, handler_key, config, segments, add_i18n_fn):
+        """Return add_i18n_fn(segments), or what it returned last time."""
+        key = (handler_key, config, tuple(segments))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                (markup, size) = entry
+                self.hits += 1
+                self.bytes_saved += size - len(markup)
+                self._entries.move_to_end(key)
+                return markup
+            self.misses += 1
+            markup = None
+            if self.db is not None:
+                db_key = self.db.key(handler_key, config, segments)
+                markup = self.db.get(db_key)
+                if markup is not None:
+                    self.bytes_saved += sum(len(s) for s in segments)
+        # As for _TagRewriteCache, we don't hold the lock while
+        # doing the slow part.
+        from_db = markup is not None
+        if not from_db:
+            markup = add_i18n_fn(segments)
+        # We don't want to hold on to StartTags' parsed attrs.
+        key = (handler_key, config,
+               tuple(str(segment) for segment in segments))
+        size = sum(len(segment) for segment in key[2]) + len(markup)
+        with self._lock:
+            if self.db is not None and not from_db:
+                self.db.put(db_key, markup)
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (markup, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self.size -= self._entries.popitem(last=False)[1][1]
+        return markup
+
+    def info(self):
+        with self._lock:
+            return RunCacheInfo(self.hits, self.misses, self.max_bytes,
+                                self.size, self.bytes_saved)
+
+
+class _RunCacheDb(object):
+    """Remembers the markup for nltext runs in a sqlite file.
+
+    This lets the run memo last across invocations: if you i18nize
+    the same files every night, most runs will be the same as the
+    night before.  Entries are keyed by a hash of the run's
+    segments, the kind of text handler, and the customizations (see
+    I18nizeConfig.fingerprint()).  When the entries take up more
+    than max_bytes, close() forgets the ones used least recently.
+    Changes are only saved by flush() and close(), so several
+    processes can share the file without waiting on each other much.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}          # key -> markup, for flush() to save
+        self._used = set()          # keys for flush() to mark as used
+        # Other processes may be flushing; we're willing to wait a bit.
+        # _RunCache makes sure only one thread uses us at a time.
+        self._db = sqlite3.connect(path, timeout=60,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                         ' key TEXT PRIMARY KEY,'
+                         ' markup TEXT NOT NULL,'
+                         ' size INTEGER NOT NULL,'
+                         ' last_used INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS runs_by_last_used'
+                         ' ON runs (last_used)')
+        (self.size, last_used) = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0)'
+            ' FROM runs').fetchone()
+        # Everything we use in this invocation is equally recent.
+        self._now = last_used + 1
+
+    def key(self, handler_key, config, segments):
+        key = hashlib.sha1(config.fingerprint())
+        key.update(' '.join('%s.%s' % (cls.__module__, cls.__name__)
+                            for cls in handler_key).encode('utf-8'))
+        for segment in segments:
+            # We include the length so segment boundaries are unambiguous.
+            key.update(('\n%d:%s' % (len(segment), segment)).encode(
+                'utf-8', 'surrogatepass'))
+        return key.hexdigest()
+
+    def get(self, key):
+        """Return the markup for the run with the given key, or None."""
+        markup = self._pending.get(key)
+        if markup is None:
+            row = self._db.execute('SELECT markup FROM runs WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            markup = row[0]
+            self._used.add(key)
+        self.hits += 1
+        return markup
+
+    def put(self, key, markup):
+        self._pending[key] = markup
+        self.size += len(key) + len(markup)
+
+    def flush(self):
+        """Save the runs we've added or used since the last flush."""
+        if not self._pending and not self._used:
+            return
+        with self._db:          # as one transaction
+            self._db.executemany(
+                'UPDATE runs SET last_used = ? WHERE key = ?',
+                ((self._now, key) for key in self._used))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                ((key, markup, len(key) + len(markup), self._now)
+                 for (key, markup) in self._pending.items()))
+        self._pending = {}
+        self._used = set()
+
+    def close(self):
+        """Save, and forget old entries if we're over max_bytes."""
+        self.flush()
+        with self._db:
+            # Other processes may have added entries too.
+            self.size = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM runs').fetchone()[0]
+            if self.size > self.max_bytes:
+                rows = self._db.execute(
+                    'SELECT key, size FROM runs ORDER BY last_used'
+                ).fetchall()
+                for (key, size) in rows:
+                    if self.size <= self.max_bytes:
+                        break
+                    self._db.execute('DELETE FROM runs WHERE key = ?',
+                                     (key,))
+                    self.size -= size
+        self._db.close()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.max_bytes, self.size)
+
+
+_RUN_CACHE = None
+
+
+def enable_run_cache(max_bytes=64 * 1024 * 1024, cache_db=None,
+                     cache_db_max_bytes=256 * 1024 * 1024):
+    """Remember the markup for nltext runs we've seen, across files.
+
+    Text handlers will re-use the markup they emitted for a run of
+    nl-text when they see the exact same run again, as is common for
+    site chrome like footers and nav bars.  The memo uses at most
+    about max_bytes of memory, forgetting the least recently used
+    runs when it's full.
+
+    If cache_db is not None, it's the path to a sqlite file where we
+    also remember runs across invocations, using at most about
+    cache_db_max_bytes on disk.  disable_run_cache() saves it.
+    """
+    global _RUN_CACHE
+    disable_run_cache()
+    db = None
+    if cache_db is not None:
+        db = _RunCacheDb(cache_db, cache_db_max_bytes)
+    _RUN_CACHE = _RunCache(max_bytes, db)
+
+
+def disable_run_cache():
+    """Stop remembering nltext runs, and forget the ones we remember.
+
+    If we're remembering runs in a cache_db, this saves it first.
+    """
+    global _RUN_CACHE
+    if _RUN_CACHE is not None and _RUN_CACHE.db is not None:
+        _RUN_CACHE.db.close()
+    _RUN_CACHE = None
+
+
+def _clear_caches():
+    _CONFIG.clear_caches()
+    if _RUN_CACHE is not None:
+        _RUN_CACHE.clear()
+
+
+def run_statistics(config=None):
+    """Return a dict from the name of each memo to its CacheInfo.
+
+    These are the memos that last across files, so after i18nizing
+    many files this says how much they helped.  Each CacheInfo has
+    hits/misses/maxsize/currsize, like functools.lru_cache's.  The
+    per-config memos are those of the config given, or else of the
+    default config (the one the add_* and mark_* fns change).
+    """
+    statistics = (config or _CONFIG).cache_statistics()
+    if _RUN_CACHE is not None:
+        # This is a RunCacheInfo, which also has bytes_saved.  Its
+        # maxsize and currsize are in bytes, not entries.
+        statistics['nltext runs'] = _RUN_CACHE.info()
+        if _RUN_CACHE.db is not None:
+            # Likewise, this maxsize and currsize are in bytes.
+            statistics['cache db'] = _RUN_CACHE.db.info()
+    return statistics
+
+
+class _FunctionNameMatcher(object):
+    """Says whether a function name is matched by any of some regexps.
+
+    The regexps are like those passed to
+    mark_function_args_lack_nltext(): a function-name matches if one
+    of them matches the whole name, or the whole of the name after
+    some '.', as in r'\\b(regexp1|regexp2|...)\\s*$'.  But usually
+    there are hundreds of them, and almost all are just names, so
+    rather than trying each as a regexp, we look up the names: in a
+    set for plain names, and in a trie for dotted ones.  (The '.' in
+    'log.date.strftime' is still a regexp '.', so it matches any
+    char.)  Only the regexps that aren't just names are tried as
+    regexps.
+    """
+    _NAME = re.compile(r'\w[\w.]*\Z')
+
+    def __init__(self, regexps):
+        self._names = set()
+        self._dotted_names = {}     # a trie: char -> trie, None -> True
+        patterns = []
+        for regexp in regexps:
+            if not self._NAME.match(regexp):
+                patterns.append(regexp)
+            elif '.' not in regexp:
+                self._names.add(regexp)
+            else:
+                node = self._dotted_names
+                for c in regexp:
+                    node = node.setdefault(c, {})
+                node[None] = True
+        if patterns:
+            self._patterns_re = re.compile(
+                r'\b(%s)\s*$' % '|'.join(patterns), re.UNICODE)
+        else:
+            self._patterns_re = None
+
+    def _has_dotted_name(self, text, name_len):
+        """True if the trie has text[:i] for some i >= name_len.
+
+        text[name_len:] is whitespace, which a '.' can match too.
+        """
+        nodes = [self._dotted_names]
+        for (i, c) in enumerate(text):
+            if i >= name_len and any(None in node for node in nodes):
+                return True
+            # A '.' in the trie matches any char, including a '.'.
+            nodes = [child for node in nodes
+                     for child in (node.get(c), c != '.' and node.get('.'))
+                     if child]
+            if not nodes:
+                return False
+        return any(None in node for node in nodes)
+
+    def matches(self, s, start, end):
+        """True if the function-name in s[start:end] is matched.
+
+        s[start:end] is a name, as found by _parse_expression(),
+        maybe followed by whitespace.
+        """
+        text = s[start:end]
+        name = text.rstrip()
+        pos = 0
+        while True:
+            if name[pos:] in self._names or (
+                    self._dotted_names and
+                    self._has_dotted_name(text[pos:], len(name) - pos)):
+                return True
+            pos = name.find('.', pos) + 1
+            if not pos:
+                break
+        return (self._patterns_re is not None and
+                self._patterns_re.search(s, start, end) is not None)
+
+
+class I18nizeConfig(object):
+    """The customizations to use when i18nizing, compiled once.
+
+    The arguments are like the module-level lists that the add_* and
+    mark_* fns below add to: nltext_tag_attributes is like
+    NATURAL_LANGUAGE_TAG_ATTRIBUTES, nltext_separator_classes is
+    like NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING, and
+    ok_functions, ok_function_params, and ok_function_arguments are
+    the regexp-strings you'd pass to the mark_function_* fns.  Any
+    that are None get the defaults, which are what you get before
+    calling any add_* or mark_* fn.
+
+    A config can't be changed once it's made; use replace() to get a
+    new one.  That lets you have different configs in the same
+    process.  Each config has its own memos (of up to cache_size
+    entries each) for how it rewrites expressions and tags; they're
+    locked, so it's safe to share a config between threads.
+    """
+    _FIELDS = ('nltext_tag_attributes', 'nltext_separator_classes',
+               'ok_functions', 'ok_function_params', 'ok_function_arguments',
+               'cache_size')
+
+    def __init__(self, nltext_tag_attributes=None,
+                 nltext_separator_classes=None, ok_functions=None,
+                 ok_function_params=None, ok_function_arguments=None,
+                 cache_size=_TAG_CACHE_SIZE):
+        def _tuple(value, default):
+            return default if value is None else tuple(value)
+
+        fields = self.__dict__      # since __setattr__ won't let us
+        fields['nltext_tag_attributes'] = tuple(
+            tuple(entry[:2]) + tuple(tuple(prereq) for prereq in entry[2:])
+            for entry in _tuple(nltext_tag_attributes,
+                                _DEFAULT_NATURAL_LANGUAGE_TAG_ATTRIBUTES))
+        fields['nltext_separator_classes'] = _tuple(
+            nltext_separator_classes,
+            _DEFAULT_NATURAL_LANGUAGE_SEPARATOR_CLASSES)
+        fields['ok_functions'] = _tuple(ok_functions, _DEFAULT_OK_FUNCTIONS)
+        fields['ok_function_params'] = _tuple(ok_function_params,
+                                              _DEFAULT_OK_FUNCTION_PARAMS)
+        fields['ok_function_arguments'] = _tuple(
+            ok_function_arguments, _DEFAULT_OK_FUNCTION_ARGUMENTS)
+        fields['cache_size'] = cache_size
+
+        # An empty alternation would match everything, so we use a
+        # regexp that never matches for empty lists.
+        def _alternation(regexps):
+            return '|'.join(regexps) or '(?!)'
+
+        fields['_separator_classes_re'] = re.compile(
+            '(^| )(%s)( |$)' % _alternation(self.nltext_separator_classes))
+        fields['_ok_functions'] = _FunctionNameMatcher(self.ok_functions)
+        fields['_ok_function_params_re'] = re.compile(
+            r'\b(%s)\s*=\s*$' % _alternation(self.ok_function_params),
+            re.UNICODE)
+        fields['_ok_function_arguments_re'] = re.compile(
+            r'"(%(ok)s)"|\'(%(ok)s)\''
+            % {'ok': _alternation(self.ok_function_arguments)},
+            re.UNICODE)
+        self._index_nl_attributes()
+
+        fields['rewrite_expression'] = functools.lru_cache(
+            maxsize=cache_size)(self._rewrite_expression)
+        fields['is_separator_class'] = functools.lru_cache(
+            maxsize=cache_size)(self._is_separator_class)
+        fields['tag_rewrites'] = _TagRewriteCache(cache_size)
+        fields['_fingerprint'] = None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('I18nizeConfig is immutable; use replace()')
+
+    def __reduce__(self):
+        # Our memos can't be pickled, so we just pickle the args
+        # (e.g. to send a config to the processes for --jobs).
+        return (I18nizeConfig,
+                tuple(getattr(self, field) for field in self._FIELDS))
+
+    def __repr__(self):
+        return 'I18nizeConfig(%s)' % ', '.join(
+            '%s=%r' % (field, getattr(self, field)) for field in self._FIELDS)
+
+    def replace(self, **changes):
+        """Return a new config like this one, but with the given args."""
+        kwargs = dict((field, getattr(self, field)) for field in self._FIELDS)
+        kwargs.update(changes)
+        return I18nizeConfig(**kwargs)
+
+    def fingerprint(self):
+        """Return a hash of everything that affects the markup we emit.
+
+        That's the customizations, and this file itself, in case our
+        rules change.  The cache_size doesn't matter.
+        """
+        if self._fingerprint is None:
+            fingerprint = hashlib.sha1(_source_digest())
+            fingerprint.update(repr(tuple(
+                getattr(self, field) for field in self._FIELDS
+                if field != 'cache_size')).encode('utf-8'))
+            self.__dict__['_fingerprint'] = fingerprint.digest()
+        return self._fingerprint
+
+    def clear_caches(self):
+        self.rewrite_expression.cache_clear()
+        self.is_separator_class.cache_clear()
+        self.tag_rewrites.clear()
+
+    def cache_statistics(self):
+        """Return a dict from the name of each of our memos to its info."""
+        # (functools' CacheInfo is the same, but can't be pickled.)
+        return {
+            'expressions': CacheInfo(*self.rewrite_expression.cache_info()),
+            'separator classes': CacheInfo(
+                *self.is_separator_class.cache_info()),
+            'tag rewrites': self.tag_rewrites.info(),
+        }
+
+    def _index_nl_attributes(self):
+        """Set up what nl_attribute_rules() and friends need.
+
+        That's a map from tagname to (a map from attr to prereqs; see
+        nl_attribute_rules()), with the rules for '*' merged in for
+        attrs that have no tagname-specific rules, and a regexp
+        matching any attribute name that's in there.
+        """
+        prereq_map = {}
+        for entry in self.nltext_tag_attributes:
+            prereqs = prereq_map.setdefault(entry[0], {}).setdefault(
+                entry[1], [])
+            if len(entry) == 3:
+                prereqs.append(tuple(entry[2]))
+            else:
+                prereqs.append(None)   # no prereq
+        prereq_map.setdefault('*', {})
+        for (rule_tagname, attr_map) in prereq_map.items():
+            for (attr, prereqs) in prereq_map['*'].items():
+                attr_map.setdefault(attr, prereqs)
+        self.__dict__['_nl_attr_map'] = prereq_map
+        # This is used on lower-cased tags, since html attribute
+        # names are case-insensitive.  (re.IGNORECASE is much slower.)
+        self.__dict__['_nl_attr_names_re'] = re.compile(
+            '|'.join(re.escape(attr) for attr in
+                     sorted(set(entry[1].lower() for entry in
+                                self.nltext_tag_attributes)))
+            or '(?!)')
+
+    def nl_attribute_rules(self, tagname):
+        """Return a map from attrs that may have nltext in tagname to prereqs.
+
+        The map is attr -> a list of (prereq-key, prereq-value) pairs.
+        It means 'attr has a natural-language value when found in
+        tagname, if *any* of (pre-k1, pre-v1), (pre-k2, pre-v2), etc
+        are also found in the tag.'  A pair can also be None, to mean
+        'no prereqs needed.'
+        """
+        return self._nl_attr_map.get(tagname) or self._nl_attr_map['*']
+
+    def may_have_natural_language_attributes(self, tag):
+        """Return false if tag can't have any attrs with natural language.
+
+        tag is the text of an html tag.  This doesn't parse the tag,
+        it just checks that some attr from nltext_tag_attributes is
+        mentioned in it, so it's a quick way to skip most tags.
+        """
+        return self._nl_attr_names_re.search(tag.lower()) is not None
+
+    def natural_language_attributes(self, tagname, attrval_pairs):
+        """Yields indices into attrval_pairs where the value is nl-text.
+
+        For instance, if tagname is 'input' and attrval_pairs is
+        [('type', 'button'), ('value', 'foo')], then this will yield
+        [1].  We yield the indices in reverse order, so we can
+        rewrite one without affecting the positions of the next ones.
+        """
+        rules = self.nl_attribute_rules(tagname)
+        attrval_set = None          # set lazily, if we need to check prereqs
+        for i in range(len(attrval_pairs) - 1, -1, -1):
+            (attr, val) = attrval_pairs[i]
+            # If there's no value, we definitely don't need to munge it...
+            if val is None:
+                continue
+
+            # Sometimes an attribute-value only has natural-language
+            # text in it when another attribute is also present.  If
+            # this tagname/attr pair has no rules, then it cannot have
+            # a natural-language value.
+            prereqs = rules.get(attr)
+            if not prereqs:
+                continue
+            if attrval_set is None:
+                attrval_set = set(attrval_pairs)
+            for prereq in prereqs:
+                if prereq is None or prereq in attrval_set:
+                    # OK, this attr has natural language text, and all
+                    # the pre-requisites for i18nizing it are
+                    # satisified.  Go!
+                    yield i
+                    break
+
+    def _is_separator_class(self, classes):
+        """True if the value of a class attr makes a tag separate nl-text."""
+        return bool(self._separator_classes_re.search(classes))
+
+    def _rewrite_expression(self, var):
+        """Return (var with _() added, a python name for var's value).
+
+        var is the stripped contents of a {{ jinja2/django variable }}.
+        The python name is the name of the variable or function in
+        var, without any filters or function args, and with non-word
+        chars changed to '_': for 'foo.bar|escape', it's 'foo_bar'.
+        """
+        varname = re.split('[|(]', var, 1)[0]   # |==filter (==fn args
+        # Normalize varname so it's a legal python variable name.
+        varname = re.sub(r'\W', '_', varname.strip())
+        return (_add_underscore_in_expression(var, self), varname)
+
+
+@functools.lru_cache(maxsize=None)
+def _source_digest():
+    """A hash of this file, for I18nizeConfig.fingerprint()."""
+    with open(__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def load_config(path):
+    """Return an I18nizeConfig for the customizations in a config file.
+
+    The file is TOML if its name ends in .toml, or else JSON (see
+    the module docstring for what goes in it).  Its lists add to the
+    defaults.  Raises ValueError if the file doesn't make sense.
+
+    We remember the configs for the most recent file contents, so
+    loading the same config again doesn't recompile anything.
+    """
+    with open(path, 'rb') as f:
+        contents = f.read()
+    try:
+        return _config_from_file_contents(contents, path.endswith('.toml'))
+    except ValueError as why:
+        raise ValueError('%s: %s' % (path, why))
+
+
+@functools.lru_cache(maxsize=16)
+def _config_from_file_contents(contents, is_toml):
+    if not is_toml:
+        settings = json.loads(contents.decode('utf-8'))
+    elif tomllib is None:
+        raise ValueError('reading TOML needs python 3.11 or the tomli'
+                         ' package; use a JSON config instead')
+    else:
+        settings = tomllib.loads(contents.decode('utf-8'))
+    if not isinstance(settings, dict):
+        raise ValueError('expected a table of settings')
+
+    defaults = I18nizeConfig()
+    kwargs = {}
+    for (name, value) in settings.items():
+        if name not in I18nizeConfig._FIELDS or name == 'cache_size':
+            raise ValueError('unknown setting %r' % name)
+        if not isinstance(value, list):
+            raise ValueError('%s should be a list' % name)
+        for entry in value:
+            if name != 'nltext_tag_attributes':
+                ok = isinstance(entry, str)
+            else:
+                ok = (isinstance(entry, list) and len(entry) in (2, 3) and
+                      all(isinstance(x, str) for x in entry[:2]) and
+                      (len(entry) == 2 or
+                       (isinstance(entry[2], list) and len(entry[2]) == 2
+                        and all(isinstance(x, str) for x in entry[2]))))
+            if not ok:
+                raise ValueError('bad entry in %s: %r' % (name, entry))
+        kwargs[name] = getattr(defaults, name) + tuple(value)
+    try:
+        return I18nizeConfig(**kwargs)
+    except re.error as why:
+        # Say which entry it was, not what we compiled it into.
+        for (name, value) in settings.items():
+            for entry in (value if name != 'nltext_tag_attributes' else ()):
+                try:
+                    re.compile(entry)
+                except re.error as entry_why:
+                    raise ValueError('bad regexp in %s: %r: %s'
+                                     % (name, entry, entry_why))
+        raise ValueError('bad regexp: %s' % why)
+
+
+# The config that the add_* and mark_* fns below change, and that
+# lexers and text handlers use when they're not given one.
+_CONFIG = None
+
+
+def _set_default_config():
+    """Recompile the default config from the module-level lists."""
+    global _CONFIG, _NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE
+    _CONFIG = I18nizeConfig(NATURAL_LANGUAGE_TAG_ATTRIBUTES,
+                            NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING,
+                            _OK_FUNCTIONS, _OK_FUNCTION_PARAMS,
+                            _OK_FUNCTION_ARGUMENTS)
+    _NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE = _CONFIG._separator_classes_re
+    # The run memo is keyed by config, so this just frees memory.
+    if _RUN_CACHE is not None:
+        _RUN_CACHE.clear()
+
+
+def expression_cache_info():
+    """Return hits/misses/maxsize/currsize for the expression memo.
+
+    This is a functools.lru_cache CacheInfo, for the default config.
+    The counts start over whenever a mark_* call changes how we
+    rewrite expressions.
+    """
+    return _CONFIG.rewrite_expression.cache_info()
 
 
 def _init():
     # This is in a function so we can reset all this state for tests.
     # TODO(csilvers): add add_nltext_tag_attribute/etc here as well.
     global _OK_FUNCTIONS, _OK_FUNCTION_PARAMS, _OK_FUNCTION_ARGUMENTS
-    _OK_FUNCTIONS = []
-    _OK_FUNCTION_PARAMS = []
-    _OK_FUNCTION_ARGUMENTS = []
-
-    mark_function_args_lack_nltext(
-        # jinja2 functions/filters
-        'attr',
-        'dictsort',
-        'groupby',
-        'int',
-        'map',
-        'reject',
-        'rejectattr',
-        'round',
-        'select',
-        'selectattr',
-        'sort',
-        'striptags',
-        'sum',
-        'urlize',
-        # django functions/filters
-        'center',
-        'date',
-        'dictsortreversed',
-        'divisibleby',
-        'floatformat',
-        'get_digit',
-        'length_is',
-        'ljust',
-        'removetags',
-        'rjust',
-        'slice',
-        'stringformat',
-        'time',
-        # functions/filters that indicate the args are already marked
-        '_',
-        'ngettext',
-        'i18n_do_not_translate',
-        # Khan-academy specific.  TODO(csilvers): move to KA-specific place.
-        'js_css_packages.package',
-        'handlebars_template',
-        'youtube.player_embed',
-        'log.date.strftime',
-        'emails.tracking_image_url',
-        )
-
-    mark_function_param_lacks_nltext(
-        'style',
-        )
-
-    mark_function_arg_is_not_nltext(
-        r'[^a-zA-Z]*',     # TODO(csilvers): have a better not-alnum RE
-        r'https?://.*',
-        r'([0-9]+px *)*',
-        )
+    _OK_FUNCTIONS = list(_DEFAULT_OK_FUNCTIONS)
+    _OK_FUNCTION_PARAMS = list(_DEFAULT_OK_FUNCTION_PARAMS)
+    _OK_FUNCTION_ARGUMENTS = list(_DEFAULT_OK_FUNCTION_ARGUMENTS)
+    _set_default_config()
 
 
 # --- customization API calls
@@ -371,14 +1104,12 @@ def add_nltext_tag_attribute(tagname, attribute_name, prereqs=None):
           says that <input value="xxx" type=button> holds a natural
           language value, but <input value="xxx" type=submit> does not.
     """
-    global _NL_ATTR_MAP
     if prereqs:
         entry = (tagname, attribute_name, prereqs)
     else:
         entry = (tagname, attribute_name)
     NATURAL_LANGUAGE_TAG_ATTRIBUTES.append(entry)
-    # Force this to be re-computed on the next call.
-    _NL_ATTR_MAP = None
+    _set_default_config()
 
 
 def add_nltext_separator_class(classname_re_string):
@@ -400,11 +1131,8 @@ def add_nltext_separator_class(classname_re_string):
           match if this class exists as a separator word in a tag's
           'class' tag.
     """
-    global _NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE
     NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING.append(classname_re_string)
-    _NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE = re.compile(
-        '(^| )(%s)( |$)' % '|'.join(
-            NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE_STRING))
+    _set_default_config()
 
 
 def mark_function_args_lack_nltext(*fn_names):
@@ -425,10 +1153,8 @@ def mark_function_args_lack_nltext(*fn_names):
           Each name is actually a regex-string, which must match
           the whole function-name.
     """
-    global _OK_FUNCTIONS_RE
     _OK_FUNCTIONS.extend(fn_names)
-    _OK_FUNCTIONS_RE = re.compile(r'\b(%s)\s*$' % '|'.join(_OK_FUNCTIONS),
-                                  re.UNICODE)
+    _set_default_config()
 
 
 def mark_function_param_lacks_nltext(*param_names):
@@ -449,11 +1175,8 @@ def mark_function_param_lacks_nltext(*param_names):
           Each name is actually a regex-string, which must match
           the whole parameter-name.
     """
-    global _OK_FUNCTION_PARAMS_RE
     _OK_FUNCTION_PARAMS.extend(param_names)
-    _OK_FUNCTION_PARAMS_RE = re.compile(r'\b(%s)\s*=\s*$'
-                                        % '|'.join(_OK_FUNCTION_PARAMS),
-                                        re.UNICODE)
+    _set_default_config()
 
 
 def mark_function_arg_is_not_nltext(*arg_texts):
@@ -476,12 +1199,8 @@ def mark_function_arg_is_not_nltext(*arg_texts):
           match the whole argument.  Any argument that matches ^arg_text$
           will be automatically considered to not be natural-language.
     """
-    global _OK_FUNCTION_ARGUMENTS_RE
     _OK_FUNCTION_ARGUMENTS.extend(arg_texts)
-    _OK_FUNCTION_ARGUMENTS_RE = re.compile(
-        r'"(%(ok)s)"|\'(%(ok)s)\''
-        % {'ok': '|'.join(_OK_FUNCTION_ARGUMENTS)},
-        re.UNICODE)
+    _set_default_config()
 
 
 # Now that these functions are defined, we can call _init()!
@@ -490,71 +1209,342 @@ _init()
 # --- end customization API calls
 
 
-def _case_insensitive_hex(s):
-    """Replace a-e with [aA]-[fF]."""
-    for (frm, to) in (('a', '[aA]'), ('b', '[bB]'), ('c', '[cC]'),
-                      ('d', '[dD]'), ('e', '[eE]'), ('f', '[fF]')):
-        s = s.replace(frm, to)
-    return s
+# Find the entities that are not alnums, by their unicode code point.
+# The unicode category 'L' means letter, and 'N' means number.  We
+# have to add in apos manually, since it's not part of html4.  We add
+# in 7-bit ascii (by number) as well.
+_ENTITY_CODEPOINTS = dict(html.entities.name2codepoint, apos=ord("'"))
+_NON_ALNUM_CODEPOINTS = frozenset(
+    [num for num in html.entities.name2codepoint.values()
+     if not unicodedata.category(chr(num))[0] in ('L', 'N')] +
+    [ord(c) for c in (string.punctuation + string.whitespace)])
+
 
-# Find the entities that are not alnums -- by name and by number --
-# and put them all into a big regexp.  The unicode category 'L' means
-# letter, and 'N' means number.  We have to add in apos manually,
-# since it's not part of html4.  We add in 7-bit ascii as well.
-_NON_ALNUM_ENTITIES = 'apos' + ''.join(
-    '|%s|#%s|#[xX]%s' % (name, num, _case_insensitive_hex(hex(num)[2:]))
-    for (name, num) in html.entities.name2codepoint.items()
-    if not unicodedata.category(chr(num))[0] in ('L', 'N'))
-_NON_ALNUM_ENTITIES += ''.join(
-    '|#%s|#[xX]%s' % (ord(c), _case_insensitive_hex(hex(ord(c))[2:]))
-    for c in (string.punctuation + string.whitespace))
+class NaturalLanguageClassifier(object):
+    """Says which parts of a run of text are natural language.
+
+    A run of text has no natural language in it if it's all
+    punctuation, whitespace, and entities for punctuation or
+    whitespace, such as '&nbsp;' or '&#215;'.  Entities are
+    recognized by name, by decimal number, or by (case-insensitive)
+    hex number, and need not end with a semicolon: '&amp' counts
+    too.  Numbers with leading zeros don't count, though.
+
+    Text handlers ask about the same segments over and over (and
+    many segments, like ' ' or '.', show up everywhere), so we
+    remember the answers for the most recent cache_size segments.
+    """
+    # Where natural language, or an entity that may or may not be,
+    # starts.  group(1) is the entity-name, without the &.
+    _NL_START = re.compile(r'&(#?\w*)|\w')
+    # We find the non-nltext suffix of a segment by walking backwards
+    # through it, so these are written backwards: the first matches
+    # some suffix characters, the second an entity ('&amp' is 'pma&').
+    _REVERSED_SUFFIX_CHARS = re.compile(r'[\s@#$^*|]*')
+    _REVERSED_ENTITY = re.compile(r'(\w+)(#?)&')
+    _ENTITY_NUMBER = re.compile(r'#(?:([0-9]+)|[xX]([0-9a-fA-F]+))$')
+
+    def __init__(self, cache_size=1024):
+        self.prefix_end = functools.lru_cache(maxsize=cache_size)(
+            self._prefix_end)
+        self.suffix_start = functools.lru_cache(maxsize=cache_size)(
+            self._suffix_start)
+
+    def is_non_alnum_entity(self, name):
+        """Return true if '&' + name is an entity for a non-alnum char."""
+        if not name.startswith('#'):
+            return _ENTITY_CODEPOINTS.get(name) in _NON_ALNUM_CODEPOINTS
+        m = self._ENTITY_NUMBER.match(name)
+        if not m:
+            return False
+        if m.group(1):
+            codepoint = int(m.group(1))
+            canonical = m.group(1) == str(codepoint)
+        else:
+            codepoint = int(m.group(2), 16)
+            canonical = m.group(2).lower() == '%x' % codepoint
+        return canonical and codepoint in _NON_ALNUM_CODEPOINTS
+
+    def no_natural_language(self, segment):
+        """Return true if segment has no natural language in it at all."""
+        return self.prefix_end(segment) == len(segment)
+
+    def _prefix_end(self, segment):
+        """Return where the natural language in segment starts.
+
+        That is, segment[:retval] is all punctuation, whitespace and
+        non-alnum entities.  This is len(segment) if segment has no
+        natural language in it, and 0 if it starts right away.
+        """
+        pos = 0
+        while True:
+            m = self._NL_START.search(segment, pos)
+            if m is None:
+                return len(segment)
+            if m.group(1) is None or not self.is_non_alnum_entity(m.group(1)):
+                return m.start()
+            pos = m.end()
+
+    def _suffix_start(self, segment):
+        """Return where the whitespace/etc at the end of segment starts.
+
+        This is pickier than _prefix_end(): we only treat whitespace,
+        a few symbols, and non-alnum entities as the suffix, so as to
+        keep periods and other closing punctuation with the text.
+        segment[retval:] is the suffix; retval is len(segment) if
+        there isn't one.
+        """
+        reversed_segment = segment[::-1]
+        pos = 0
+        while True:
+            pos = self._REVERSED_SUFFIX_CHARS.match(reversed_segment,
+                                                    pos).end()
+            m = self._REVERSED_ENTITY.match(reversed_segment, pos)
+            if m is None or not self.is_non_alnum_entity(m.group(2) +
+                                                         m.group(1)[::-1]):
+                return len(segment) - pos
+            pos = m.end()
+
+
+def may_have_natural_language_attributes(tag):
+    """Return false if tag can't have any attrs with natural language.
+
+    This uses the default config: see
+    I18nizeConfig.may_have_natural_language_attributes().
+    """
+    return _CONFIG.may_have_natural_language_attributes(tag)
 
 
 def natural_language_attributes(tagname, attrval_pairs):
     """Yields indices into attrval_pairs where the value is natural language.
 
-    For instance, if tagname is 'input' and attrval_pairs is
-    [('type', 'button'), ('value', 'foo')], then this will yield [1].
-    We yield the indices in reverse order, so we can rewrite one
-    without affecting the positions of the next ones.
+    This uses the default config: see
+    I18nizeConfig.natural_language_attributes().
     """
-    global _NL_ATTR_MAP
-    if _NL_ATTR_MAP is None:
-        # Convert this to a map:
-        #    tagname -> {attr: ((pre-k1, pre-v1), ...)), ...}
-        # This means 'attr has a natural-language value when found in
-        # tagname, if *any* of (pre-k1, pre-v1), (pre-k2, pre-v2), etc
-        # are also found in the tag.'  (pre-k1, pre-v1) can also be
-        # None to mean 'no prereqs needed.'
-        _NL_ATTR_MAP = {}
-        for entry in NATURAL_LANGUAGE_TAG_ATTRIBUTES:
-            _NL_ATTR_MAP.setdefault(entry[0], {})
-            _NL_ATTR_MAP[entry[0]].setdefault(entry[1], [])
-            if len(entry) == 3:
-                _NL_ATTR_MAP[entry[0]][entry[1]].append(entry[2])
-            else:
-                _NL_ATTR_MAP[entry[0]][entry[1]].append(None)   # no prereq
+    return _CONFIG.natural_language_attributes(tagname, attrval_pairs)
 
-    for i in range(len(attrval_pairs) - 1, -1, -1):
-        (attr, val) = attrval_pairs[i]
-        # If there's no value, we definitely don't need to munge it...
-        if val is None:
-            continue
 
-        # Sometimes an attribute-value only has natural-language
-        # text in it when another attribute is also present.
-        # Figure out what those pre-reqs are: they will be in
-        # _NL_ATTR_MAP[tagname][attr] or _NL_ATTR_MAP['*'][attr].
-        # If they're absent from both, then this tagname/attr
-        # pair cannot have a natural-language value.
-        prereqs = (_NL_ATTR_MAP.get(tagname, {}).get(attr) or
-                   _NL_ATTR_MAP.get('*', {}).get(attr) or [])
-        for prereq in prereqs:
-            if prereq is None or prereq in attrval_pairs:
-                # OK, this attr has natural language text, and all the
-                # pre-requisites for i18nizing it are satisified.  Go!
-                yield i
-                break
+class Segment(collections.namedtuple(
+        'Segment', ('kind', 'start', 'end', 'separates_nltext', 'tagname'))):
+    """A segment of a document, as yielded by HtmlLexer.iter_segments().
+
+    This says where the segment is -- it's rawdata[start:end] -- but
+    doesn't hold the segment text itself, so lexing doesn't need to
+    make a new string for every segment.  Call text() if you need it.
+
+    kind is one of the constants below.  separates_nltext is the same
+    as segment_separates_nltext in HtmlLexer's callback.  tagname is
+    the name of the tag for STARTTAG and ENDTAG segments, else None.
+    """
+    __slots__ = ()
+
+    TEXT = 'text'               # text, including script and style data
+    STARTTAG = 'starttag'       # <tag ...>
+    ENDTAG = 'endtag'           # </tag>
+    TEMPLATE = 'template'       # {{ var }}, {% block %}, {# comment #}, etc.
+    COMMENT = 'comment'         # <!-- comment -->
+    PI = 'pi'                   # <?processing instruction?>
+    DECL = 'decl'               # <!DECLARATION>
+
+    def text(self, rawdata):
+        """Return the text of this segment of rawdata."""
+        return rawdata[self.start:self.end]
+
+
+class StartTag(str):
+    """The text of a start tag, as passed to HtmlLexer's callback.
+
+    This is a string like any other segment, but it also holds what
+    HtmlLexer.parse_starttag() found out about the tag when lexing
+    it: its tagname, its attrs as a list of (name, value) pairs, and
+    value_poses, the (start, end) of each value within the tag.  That
+    way text handlers don't need to parse the tag all over again.
+    """
+    __slots__ = ('tagname', 'attrs', 'value_poses')
+
+
+class SegmentTable(object):
+    """All the segments of a document, stored as parallel arrays.
+
+    This holds the same information as a list of Segments from
+    HtmlLexer.iter_segments() -- except for the tagnames -- but in
+    four array.array columns, so it takes a few bytes per segment
+    rather than a few hundred.  It can be pickled, or turned into a
+    string of bytes via tobytes() and back via frombytes(), so you
+    can lex a document once and save the result to re-use later.
+    HtmlLexer.replay() runs a callback (such as a text handler) over
+    a SegmentTable just as parse() would, without lexing again.
+
+    Segment i is rawdata[starts[i]:ends[i]], of kind KINDS[kinds[i]],
+    and separates nl-text if separates[i] is 1.
+    """
+    KINDS = (Segment.TEXT, Segment.STARTTAG, Segment.ENDTAG,
+             Segment.TEMPLATE, Segment.COMMENT, Segment.PI, Segment.DECL)
+    _KIND_CODES = dict((kind, code) for (code, kind) in enumerate(KINDS))
+
+    def __init__(self, starts=(), ends=(), kinds=(), separates=()):
+        self.starts = array.array('I', starts)
+        self.ends = array.array('I', ends)
+        self.kinds = array.array('B', kinds)
+        self.separates = array.array('B', separates)
+
+    @classmethod
+    def from_segments(cls, segments):
+        """Return a SegmentTable holding the given Segments."""
+        table = cls()
+        kind_codes = cls._KIND_CODES
+        for segment in segments:
+            table.starts.append(segment.start)
+            table.ends.append(segment.end)
+            table.kinds.append(kind_codes[segment.kind])
+            table.separates.append(segment.separates_nltext)
+        return table
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        """Yield the Segments in the table (with tagname set to None)."""
+        kinds = self.KINDS
+        for (start, end, kind, separates) in zip(
+                self.starts, self.ends, self.kinds, self.separates):
+            yield Segment(kinds[kind], start, end, bool(separates), None)
+
+    def __eq__(self, other):
+        return (isinstance(other, SegmentTable) and
+                self.starts == other.starts and self.ends == other.ends and
+                self.kinds == other.kinds and
+                self.separates == other.separates)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def tobytes(self):
+        """Return the table as bytes, for frombytes() to read back in.
+
+        The byte order is that of this machine, so this is for caching
+        the table, not for sending it elsewhere.
+        """
+        return b''.join((
+            array.array('I', (len(self),)).tobytes(),
+            self.starts.tobytes(), self.ends.tobytes(),
+            self.kinds.tobytes(), self.separates.tobytes()))
+
+    @classmethod
+    def frombytes(cls, data):
+        """Return the SegmentTable that tobytes() turned into data."""
+        table = cls()
+        header = array.array('I')
+        header.frombytes(data[:header.itemsize])
+        pos = header.itemsize
+        n = header[0]
+        for column in (table.starts, table.ends, table.kinds,
+                       table.separates):
+            end = pos + n * column.itemsize
+            column.frombytes(data[pos:end])
+            pos = end
+        if pos != len(data):
+            raise ValueError('Bad SegmentTable data: expected %d bytes, got %d'
+                             % (pos, len(data)))
+        return table
+
+
+class _NeedMoreData(Exception):
+    """Raised when HtmlLexer.feed() needs more data to finish an entity."""
+
+
+def _compile_entity_scanner(template_entities):
+    """Return a regexp that classifies the entity starting at some position.
+
+    template_entities is a sequence of (starttag, endtag,
+    segment_separates_nltext) triples, as in HtmlLexer.TEMPLATE_ENTITIES.
+    The regexp has one group for html tags ('<'), followed by one
+    group per triple, so a single match() tells us what kind of entity
+    we're looking at: m.lastindex is 1 for html, and i + 2 for
+    template_entities[i].  As with trying startswith() on each triple
+    in turn, earlier triples take precedence over later ones.
+    """
+    return re.compile('(<)%s' % ''.join('|(%s)' % re.escape(starttag)
+                                        for (starttag, _, _)
+                                        in template_entities))
+
+
+def _compile_value_stops(template_markup_start):
+    """Return regexps that find where an attribute value might stop.
+
+    This is a map from the quote that starts the value ('"', "'", or
+    None for an unquoted value) to a regexp whose first group matches
+    the character that ends the value.  If template_markup_start is
+    not None, the regexp also matches the start of template markup
+    (without setting group 1), which needs to be skipped over as a
+    unit: the quotes in <img alt={%if x%}"a"{%else%}"b"{%endif%}>
+    don't end anything.
+    """
+    value_ends = {'"': '"', "'": "'", None: r'[\'\">\s]'}
+    if template_markup_start:
+        return dict((quote,
+                     re.compile('(%s)|%s' % (end, template_markup_start)))
+                    for (quote, end) in value_ends.items())
+    return dict((quote, re.compile('(%s)' % end))
+                for (quote, end) in value_ends.items())
+
+
+def _compile_simple_attr(attr_name, template_var, flat_block):
+    """Return a regexp matching an attribute that is easy to parse.
+
+    That's an attribute, with or without a value, that doesn't have
+    any complicated template markup in it.  If template_var (a
+    compiled regexp) or flat_block (a regexp-string) is not None,
+    the attribute may be -- and its value may contain -- template
+    variables or simple template blocks, but otherwise may not have a
+    '{' at all, leaving other template markup to the general (and
+    slower) attribute parsing in parse_starttag().  The regexp's
+    lastgroup is the group holding the value, or 'attr' or 'markup'
+    if there is no value.
+    """
+    markup = '|'.join(m for m in (template_var and template_var.pattern,
+                                  flat_block)
+                      if m)
+    if not markup:
+        (lita, lit, bare) = (r"[^']", r'[^"]', r'[^\'\">\s]')
+        markup = '(?!)'         # never matches
+    else:
+        (lita, lit, bare) = ('(?:%s|%s)' % (chars, markup)
+                             for chars in
+                             (r"[^'{]", r'[^"{]', r'[^\'\">\s{]'))
+    # Attributes can also end right before a block: <a{% if x %} ...>
+    tag_end = '(?=>|/>%s)' % (flat_block and '|' + flat_block or '')
+    return re.compile(
+        r'(?:(?P<attr>%s)(?:'
+        r'\s*=\s*(?:'
+        r"'(?P<lita>%s*)'"              # LITA
+        r'|"(?P<lit>%s*)"'              # LIT
+        r'|(?P<bare>%s+)'               # bare value
+        r')(?:\s+|%s)'                  # end
+        r'|\s+(?![\s=])|%s)'            # or: just 'attr', not 'attr=value'
+        r'|(?P<markup>%s)(?:\s+(?![\s=])|%s))'
+        % (attr_name, lita, lit, bare, tag_end, tag_end, markup, tag_end))
+
+
+def _handlebars_block_regexp(names, depth):
+    """Return a regexp-string matching some handlebars balanced blocks.
+
+    It matches blocks started by one of the given names, like
+    {{#if x}}...{{/if}}, with blocks nested inside them no more than
+    depth deep (depth=1 allows no nested blocks at all).  We list the
+    names rather than using a backreference to match {{/...}} to
+    {{#...}}, and don't allow any other block tags inside, so the
+    regexp never needs to backtrack further than the next block tag.
+    """
+    inner = ''
+    if depth > 1:
+        inner = '|' + _handlebars_block_regexp(names, depth - 1)
+    return '|'.join(
+        (r'{{#\s*%(name)s(?=[\s}])(?:[^}]|}(?!}))*}}'
+         r'(?:[^{]|{(?!{[#/])%(inner)s)*'
+         r'{{/\s*%(name)s(?=[\s}])(?:[^}]|}(?!}))*}}')
+        % {'name': name, 'inner': inner}
+        for name in names)
 
 
 class HtmlLexer(_markupbase.ParserBase):
@@ -563,6 +1553,10 @@ class HtmlLexer(_markupbase.ParserBase):
     Usage:
         p = HtmlLexer(callback)
         p.parse(data)
+    or, to lex a document a piece at a time:
+        p.feed(data1)
+        p.feed(data2)
+        p.close()
 
     This is similar to the standard library HTMLParser, but simpler
     in that it doesn't try to handle entities, and structured to
@@ -590,6 +1584,9 @@ class HtmlLexer(_markupbase.ParserBase):
           parse() will return in turn.
        3) Never return anything.  In this case, parse() will return
           None.  (This is a special case of (2).)
+    In case (1), you can instead give parse() a file-like object, the
+    'sink', and HtmlLexer will write the strings to it as it goes,
+    rather than collecting them all in memory.
     """
     # 'Interesting' means: when does the next entity start?  For the
     # html parser, only tags are interesting entities.  (In CDATA
@@ -598,42 +1595,159 @@ class HtmlLexer(_markupbase.ParserBase):
     INTERESTING_NORMAL = re.compile('<')
     INTERESTING_CDATA = lambda cls, tag: re.compile(r'</\s*%s' % tag, re.I)
 
-    TAGFIND = re.compile('[a-zA-Z][-.a-zA-Z0-9:_]*(?:\s+|(?=>|/>))')
-    ENDTAGFIND = re.compile('</\s*([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>')
-    PICLOSE = '>'
+    # Non-html entities that subclasses know how to lex, as
+    # (starttag, endtag, segment_separates_nltext).  An entity runs
+    # from starttag through the next endtag.  If more than one starttag
+    # matches, the first one listed wins.
+    TEMPLATE_ENTITIES = ()
+    ENTITY_START = _compile_entity_scanner(TEMPLATE_ENTITIES)
 
-    _ATTR_NAME = r'[a-zA-Z_][-.:a-zA-Z0-9_]*'
-
-    # just 'attr', not 'attr=value'.
-    BARE_ATTR = re.compile(r'(?P<attr>%s)(?:\s+(?!=)|(?=>|/>))' % _ATTR_NAME,
-                           re.DOTALL)
+    TAGNAME = re.compile(r'([a-zA-Z][-.a-zA-Z0-9:_]*)\s*')
+    ENDTAGFIND = re.compile(r'</\s*([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>')
+    PICLOSE = '>'
 
-    ATTR_AND_VALUE = re.compile(
-        r'(?P<attr>%(attr)s)\s*=\s*'
-        r"(?:'(?P<lita>(?:[^\'])*)'"    # LITA
-        r'|"(?P<lit>(?:[^\"])*)"'       # LIT
-        r'|(?P<bare>(?:[^\'\">\s])+)'   # bare value
-        r')(?:\s+|(?=>|/>))'   # end
-        % {'attr': _ATTR_NAME}, re.DOTALL)
+    # When feed()ing, how much data past an entity we need to have seen
+    # before we lex it, since we peek ahead a bit: for '<br><br>', and
+    # to make sure we see all of a long starttag like '{{ _TODO('.
+    FEED_LOOKAHEAD = 64
 
-    def __init__(self, callback):
+    _ATTR_NAME = r'[a-zA-Z_][-.:a-zA-Z0-9_]*'
+    WHITESPACE = re.compile(r'\s*')
+    # An attribute name, followed by '=' if the attribute has a value.
+    ATTR_START = re.compile(r'(?P<attr>%s)\s*(?P<eq>=\s*)?' % _ATTR_NAME)
+
+    # Subclasses can allow template markup inside html tags, both
+    # as attributes and inside attribute values:
+    #    <div{% if foo %} class="clear"{% endif %} title="{{ t }}">
+    # TEMPLATE_MARKUP_START is a regexp-string matching where such
+    # markup might start.  TEMPLATE_VAR matches a template variable
+    # (which ends with TEMPLATE_VAR_END), and BLOCK_TAG matches the
+    # beginning of a block tag, with a group 'close' that is set for
+    # closing tags ('{% endif %}'), and a group 'name' holding the
+    # block name ('if'); BLOCK_TAG_END says how a block tag ends.
+    # See match_template_block().
+    TEMPLATE_MARKUP_START = None
+    TEMPLATE_VAR = None
+    TEMPLATE_VAR_END = None
+    BLOCK_TAG = None
+    BLOCK_TAG_END = None
+    # Whether a closing tag must name an open block to close it, or
+    # else just closes the innermost block.
+    BLOCK_CLOSE_MUST_MATCH = False
+    # A regexp-string matching a common, simple kind of balanced block,
+    # without any block tags inside it.  Blocks that match it can be
+    # lexed by SIMPLE_ATTR, without needing match_template_block().
+    FLAT_BLOCK = None
+
+    # The common case, which parse_starttag() tries first.
+    SIMPLE_ATTR = _compile_simple_attr(_ATTR_NAME, TEMPLATE_VAR, FLAT_BLOCK)
+    VALUE_STOPS = _compile_value_stops(TEMPLATE_MARKUP_START)
+
+    def __init__(self, callback, config=None):
+        """config is an I18nizeConfig; None means the default config."""
         _markupbase.ParserBase.__init__(self)
         # markupbase makes some callbacks we don't care about.
         for fn in ('handle_comment', 'handle_decl', 'unknown_decl'):
             setattr(self, fn, lambda *args, **kwargs: None)
 
         self.callback = callback
+        self.config = config
+        # (rawdata, i, end) for the most recent match_template_block().
+        self._last_block_match = (None, None, None)
+        # (rawdata, positions of opening block tags that never close).
+        self._unclosed_blocks = (None, set())
         # initialize line number and position
         self.reset()
 
+    def reset(self, sink=None):
+        """Forget any partially-lexed document, and start a new one.
+
+        If sink is not None, it's a file-like object that we write the
+        callback outputs to, rather than returning them from parse(),
+        feed(), or close().
+        """
+        # self.lineno and self.offset say where self.rawdata starts
+        # in the document; feed() discards what it's done lexing.
+        _markupbase.ParserBase.reset(self)
+        self.rawdata = ''
+        # Where we are in self.rawdata.  See getpos().
+        self._pos = 0
+        # (rawdata, offsets of the newlines in rawdata), built lazily.
+        self._newlines = (None, None)
+        self.sink = sink
+        self.callback_outputs = []
+        # True if the callback has ever returned non-None.
+        self._callback_returned_output = False
+        # If not None, iter_segments() is collecting Segments here.
+        self._segments = None
+        self.interesting = self.INTERESTING_NORMAL
+        # False if feed() may yet add to the end of self.rawdata.
+        self._at_eof = True
+
     def _call_callback(self, segment, segment_separates_nltext):
         """Call the callback and update self.callback_outputs."""
-        # We just accumulate all the non-None callback-outputs, and
-        # let HtmlLexer.parse() figure out which of the 3 cases
-        # (listed in HtmlLexer.__doc__) we fall under.
+        # We just accumulate all the non-None callback-outputs (or
+        # write them to the sink), and let HtmlLexer.parse() figure
+        # out which of the 3 cases (listed in HtmlLexer.__doc__) we
+        # fall under.
         retval = self.callback(segment, segment_separates_nltext)
         if retval is not None:
-            self.callback_outputs.append(retval)
+            self._callback_returned_output = True
+            if not retval:
+                pass            # no need to keep track of ''
+            elif self.sink is not None:
+                self.sink.write(retval)
+            else:
+                self.callback_outputs.append(retval)
+
+    def _emit(self, rawdata, kind, start, end, segment_separates_nltext,
+              tagname=None):
+        """Pass on the segment rawdata[start:end], of the given kind."""
+        if self._segments is not None:
+            # This is a faster way of saying Segment(kind, start, ...).
+            self._segments.append(tuple.__new__(
+                Segment,
+                (kind, start, end, segment_separates_nltext, tagname)))
+        else:
+            self._call_callback(rawdata[start:end], segment_separates_nltext)
+
+    def _reached_end(self):
+        """Called when some lookup runs off the end of self.rawdata.
+
+        If we're in the middle of feed()ing data, the lookup might
+        succeed once we have more data, so we stop and wait for it.
+        Otherwise, this does nothing, and the lookup just fails.
+        """
+        if not self._at_eof:
+            raise _NeedMoreData()
+
+    def updatepos(self, i, j):
+        """Note we've lexed rawdata[i:j], and return j.
+
+        ParserBase.updatepos() counts the newlines in every segment to
+        keep self.lineno up to date, but we only need line numbers if
+        there's an error, so we just remember where we are, and let
+        getpos() figure out the line number if anyone asks.
+        """
+        self._pos = j
+        return j
+
+    def position_of(self, i):
+        """Return the (line number, offset) of self.rawdata[i]."""
+        (rawdata, newlines) = self._newlines
+        if rawdata is not self.rawdata:
+            rawdata = self.rawdata
+            newlines = [m.start() for m in re.finditer('\n', rawdata)]
+            self._newlines = (rawdata, newlines)
+        num_newlines = bisect.bisect_left(newlines, i)
+        if num_newlines:
+            return (self.lineno + num_newlines,
+                    i - (newlines[num_newlines - 1] + 1))
+        return (self.lineno, self.offset + i)
+
+    def getpos(self):
+        """Return the current line number and offset."""
+        return self.position_of(self._pos)
 
     def error(self, message):
         raise HTMLParseError(message, self.getpos())
@@ -665,15 +1779,20 @@ class HtmlLexer(_markupbase.ParserBase):
         # By definition, 'data' is natural language text: this is
         # called for everything that's not meaningful html.
         if self.interesting == self.INTERESTING_NORMAL:
-            self._call_callback(rawdata[start:end],
-                                segment_separates_nltext=False)
+            self._emit(rawdata, Segment.TEXT, start, end,
+                       segment_separates_nltext=False)
         else:
             # Inside a script-tag, there's no such thing as nltext.
-            self._call_callback(rawdata[start:end],
-                                segment_separates_nltext=True)
+            self._emit(rawdata, Segment.TEXT, start, end,
+                       segment_separates_nltext=True)
+
+    def handle_tag(self, rawdata, start, end, tagname, attrs,
+                   value_poses=None):
+        """Handles a start tag or an end tag.  Excludes comments, PI, etc.
 
-    def handle_tag(self, rawdata, start, end, tagname, attrs):
-        """Handles a start tag or an end tag.  Excludes comments, PI, etc."""
+        value_poses is None for end tags, and for start tags is as
+        returned by parse_starttag().
+        """
         segment_separates_nltext = tagname not in INLINE_ELEMENTS
 
         # As a special case, we treat '<br><br>' as a text separator,
@@ -684,65 +1803,268 @@ class HtmlLexer(_markupbase.ParserBase):
             rawdata.startswith('<br/><br/>', start)):
             segment_separates_nltext = True
 
-        # Another special case: certain classes (defined at the top
-        # of the file) indicate a tag is separating natural language.
+        # Another special case: certain classes (see
+        # add_nltext_separator_class()) indicate a tag is separating
+        # natural language.
         if not segment_separates_nltext:
             for (attr, val) in attrs:
                 if (attr == 'class' and
-                    _NATURAL_LANGUAGE_SEPARATOR_CLASSES_RE.search(val)):
+                        (self.config or _CONFIG).is_separator_class(val)):
                     segment_separates_nltext = True
                     break
 
-        self._call_callback(rawdata[start:end], segment_separates_nltext)
+        if value_poses is None:
+            self._emit(rawdata, Segment.ENDTAG, start, end,
+                       segment_separates_nltext, tagname)
+        elif self._segments is not None:
+            self._emit(rawdata, Segment.STARTTAG, start, end,
+                       segment_separates_nltext, tagname)
+        else:
+            segment = StartTag(rawdata[start:end])
+            segment.tagname = tagname
+            segment.attrs = attrs
+            segment.value_poses = value_poses
+            self._call_callback(segment, segment_separates_nltext)
 
     def parse_to(self, to, i):
         """Find the next occurrence of 'to', past i, and return pos past it."""
         end = self.rawdata.find(to, i)
         if end == -1:
+            self._reached_end()
             self.error("No end %s found" % to)
         return end + len(to)
 
+    def match_template_var(self, rawdata, i):
+        """Return the end of the template variable at rawdata[i], or None."""
+        if self.TEMPLATE_VAR is None:
+            return None
+        m = self.TEMPLATE_VAR.match(rawdata, i)
+        if m:
+            return m.end()
+        if not self._at_eof and rawdata.find(self.TEMPLATE_VAR_END, i) == -1:
+            self._reached_end()
+        return None
+
+    def match_template_block(self, rawdata, i):
+        """Return the end of the balanced template block at rawdata[i].
+
+        Or return None if there's no balanced block at position i.
+        A balanced block starts with an opening block tag and extends
+        through the closing tag that matches it: '{% if x %}a{% endif %}'
+        or '{% if x %}{% for y in z %}...{% endfor %}{% endif %}'.  Tags
+        in between that are never closed ('{% else %}') are ignored.
+
+        We keep a stack of open blocks rather than using a regexp, so
+        nesting works and the work done is linear in the length of the
+        block: a regexp like '{%.*?{% end.*?%}' can backtrack over the
+        rest of the document, many times over, when a tag is unbalanced.
+        Likewise, when we scan to the end of the document without
+        closing a block, we remember which opening tags we never
+        closed, so we don't scan from each of them again.
+        """
+        if self.BLOCK_TAG is None:
+            return None
+        # parse_starttag() often asks about the same block twice in a
+        # row: once to see if an attribute ends there, and once to
+        # parse it as an attribute itself.
+        (last_rawdata, last_i, last_end) = self._last_block_match
+        if rawdata is last_rawdata and i == last_i:
+            return last_end
+
+        end = self._scan_template_block(rawdata, i)
+        self._last_block_match = (rawdata, i, end)
+        return end
+
+    def _scan_template_block(self, rawdata, i):
+        (unclosed_rawdata, unclosed) = self._unclosed_blocks
+        if rawdata is unclosed_rawdata and i in unclosed:
+            return None
+
+        block_tag = self.BLOCK_TAG
+        m = block_tag.match(rawdata, i)
+        if not m or m.group('close') is not None:
+            return None
+
+        open_blocks = []     # (name, position) of the open blocks
+        num_open = {}        # how often each name is in open_blocks
+        while m:
+            tag_end = rawdata.find(self.BLOCK_TAG_END, m.end())
+            if tag_end == -1:
+                break
+
+            (close, name) = m.group('close', 'name')
+            if close is None:
+                open_blocks.append((name, m.start()))
+                num_open[name] = num_open.get(name, 0) + 1
+            elif num_open.get(name):
+                while True:
+                    (open_name, _) = open_blocks.pop()
+                    num_open[open_name] -= 1
+                    if open_name == name:
+                        break
+            elif not self.BLOCK_CLOSE_MUST_MATCH:
+                num_open[open_blocks.pop()[0]] -= 1
+
+            if not open_blocks:
+                return tag_end + len(self.BLOCK_TAG_END)
+            m = block_tag.search(rawdata, tag_end)
+
+        self._reached_end()
+        # A block still open here would be unclosed if we scanned from
+        # it, too: what follows it is the same, and nothing closed it.
+        if rawdata is not unclosed_rawdata:
+            unclosed = set()
+            self._unclosed_blocks = (rawdata, unclosed)
+        unclosed.update(position for (_, position) in open_blocks)
+        return None
+
+    def match_template_markup(self, rawdata, i):
+        """Return the end of the template var or block at rawdata[i]."""
+        end = self.match_template_var(rawdata, i)
+        if end is None:
+            end = self.match_template_block(rawdata, i)
+        return end
+
+    def _can_end_attr(self, rawdata, i):
+        """True if an attribute can end right before rawdata[i].
+
+        Attributes are usually followed by whitespace, but they can
+        also be followed by the end of the tag, or by a template block:
+           <a id="foo"{% if is_profile_empty %} class="empty"{% endif %}>
+        """
+        return (rawdata.startswith(('>', '/>'), i) or
+                self.match_template_block(rawdata, i) is not None)
+
+    def match_tagname(self, rawdata, i):
+        """Return the end of the tagname (and whitespace) at rawdata[i].
+
+        Returns None if there's no tagname at position i.
+        """
+        m = self.TAGNAME.match(rawdata, i)
+        if not m:
+            return None
+        if m.end() == len(rawdata):
+            self._reached_end()
+        if m.end() > m.end(1) or self._can_end_attr(rawdata, m.end()):
+            return m.end()
+        return None
+
+    def _find_value_end(self, rawdata, i, quote):
+        """Return where the attribute value starting at rawdata[i] ends.
+
+        quote is the quote-character that started the value, or None
+        for an unquoted value.  Template markup inside the value is
+        skipped over as a unit.  If the value never ends, we return
+        len(rawdata).
+        """
+        value_stops = self.VALUE_STOPS[quote]
+        while True:
+            m = value_stops.search(rawdata, i)
+            if not m:
+                return len(rawdata)
+            if m.group(1) is not None:
+                return m.start()
+            # We're at what might be template markup.
+            i = self.match_template_markup(rawdata, m.start())
+            if i is None:          # ...but it's not, after all.
+                i = m.start() + 1
+
+    def _match_attr(self, rawdata, i):
+        """Match an attribute, with or without a value, at rawdata[i].
+
+        We require the attribute be named explicitly if it has a value
+        (no '{{attr}}=1'), but the value can be a raw string, a "quoted
+        string" or 'quoted string', and can include template variables
+        and blocks.  A value-less attribute can look like an
+        attribute-name, or it can look like a template variable or
+        block.  (If it's a block, it could be an attribute-value pair;
+        it's too annoying for us to figure it out.)  Either way, the
+        attribute is followed by a space or by the tag-end.
+
+        Returns:
+            None if there's no attribute at position i.  Otherwise
+            a tuple (end, attr, value_start, value_end), where
+            value_start and value_end are None if there's no value.
+        """
+        m = self.ATTR_START.match(rawdata, i)
+        if m is None:
+            attr_end = self.match_template_markup(rawdata, i)
+            if attr_end is None:
+                return None
+            attr = rawdata[i:attr_end]
+            end = self.WHITESPACE.match(rawdata, attr_end).end()
+            if end > attr_end:
+                if rawdata.startswith('=', end):
+                    return None
+            elif not self._can_end_attr(rawdata, end):
+                return None
+            return (end, attr, None, None)
+
+        if m.group('eq') is None:
+            end = m.end()
+            if end == m.end('attr') and not self._can_end_attr(rawdata, end):
+                return None
+            return (end, m.group('attr'), None, None)
+
+        value_start = m.end()
+        quote = rawdata[value_start:value_start + 1]
+        if quote in ('"', "'"):
+            value_start += 1
+            value_end = self._find_value_end(rawdata, value_start, quote)
+            if not rawdata.startswith(quote, value_end):
+                return None
+            end = value_end + 1
+        else:
+            value_end = self._find_value_end(rawdata, value_start, None)
+            if value_end == value_start:
+                return None
+            end = value_end
+
+        space_end = self.WHITESPACE.match(rawdata, end).end()
+        if space_end == end and not self._can_end_attr(rawdata, end):
+            return None
+        return (space_end, m.group('attr'), value_start, value_end)
+
     def parse_starttag(self, rawdata, i):
         """Given the beginning of a start tag, return its end location."""
         tagstart = i
 
         # First, find the tagname.
-        match = self.TAGFIND.match(rawdata, i + 1)
-        assert match, 'unexpected call to parse_starttag(): pos %s' % i
-        tag = rawdata[i + 1:match.end()].lower().strip()
-        i = match.end()
+        end = self.match_tagname(rawdata, i + 1)
+        assert end is not None, ('unexpected call to parse_starttag(): pos %s'
+                                 % i)
+        tag = rawdata[i + 1:end].lower().strip()
+        i = end
 
         attrs = []
         value_poses = []        # (start, end), from position of opening <
-        while not (rawdata.startswith('>', i) or rawdata.startswith('/>', i)):
-            # Check if we have a complete attr-value pair: an attribute
-            # name that doesn't end with an =.
-            match = self.BARE_ATTR.match(rawdata, i)
-            if match:
-                attrs.append((match.group('attr'), None))
-                value_poses.append((None, None))
-                i = match.end()
-                continue
-
-            match = self.ATTR_AND_VALUE.match(rawdata, i)
+        while not rawdata.startswith(('>', '/>'), i):
+            match = self.SIMPLE_ATTR.match(rawdata, i)
             if match:
-                attr = match.group('attr')
-                # one of the LITA/LIT/<bare> groups contains the
-                # value, the others contain None (it depends on the
-                # value format).
-                for n in ('lita', 'lit', 'bare'):
-                    if match.group(n) is not None:
-                        attrs.append((attr, match.group(n)))
-                        value_poses.append((match.start(n) - tagstart,
-                                            match.end(n) - tagstart))
-                        break
-                else:     # for/else: no value found  ('<tag attr=>')
-                    attrs.append((attr, ''))
-                    value_poses.append((0, 0))
+                # lastgroup is the group holding the value, if any.
+                if match.lastgroup in ('attr', 'markup'):
+                    attrs.append((match.group(match.lastgroup), None))
+                    value_poses.append((None, None))
+                else:
+                    attrs.append((match.group('attr'),
+                                  match.group(match.lastgroup)))
+                    value_poses.append(
+                        (match.start(match.lastgroup) - tagstart,
+                         match.end(match.lastgroup) - tagstart))
                 i = match.end()
                 continue
 
-            self.error('Malformed "%s" tag' % tag)
+            match = self._match_attr(rawdata, i)
+            if match is None:
+                self.error('Malformed "%s" tag' % tag)
+            (i, attr, value_start, value_end) = match
+            if value_start is None:
+                attrs.append((attr, None))
+                value_poses.append((None, None))
+            else:
+                attrs.append((attr, rawdata[value_start:value_end]))
+                value_poses.append((value_start - tagstart,
+                                    value_end - tagstart))
 
         if rawdata.startswith('>', i):
             if self.is_cdata_tag(tag, attrs):
@@ -777,51 +2099,78 @@ class HtmlLexer(_markupbase.ParserBase):
             An offset into self.rawdata pointing to the end of the
             entity at position i, or None if there was no
             'interesting' entity at position i after all.
+
+        Raises:
+            _NeedMoreData, without calling any callbacks, if we're
+            feed()ing and the entity might continue past the end of
+            self.rawdata.
         """
         rawdata = self.rawdata
-        if rawdata.startswith('<', i):
-            if self.TAGFIND.match(rawdata, i + 1):
-                (entity_end, tagname, attrs, _) = self.parse_starttag(rawdata,
-                                                                      i)
-                self.handle_tag(rawdata, i, entity_end, tagname, attrs)
-            elif rawdata.startswith("</", i):
-                (entity_end, tagname) = self.parse_endtag(rawdata, i)
-                self.handle_tag(rawdata, i, entity_end, tagname, [])
-            elif rawdata.startswith("<!--", i):
-                entity_end = self.parse_comment(i)      # in markupbase
-                # We *could* collect text like 'a<!-- b -->c', but...
-                self._call_callback(rawdata[i:entity_end],
-                                    segment_separates_nltext=True)
-            elif rawdata.startswith("<?", i):
-                entity_end = self.parse_to(self.PICLOSE, i)
-                self._call_callback(rawdata[i:entity_end],
-                                    segment_separates_nltext=True)
-            elif rawdata.startswith("<!", i):
-                entity_end = self.parse_declaration(i)  # in markupbase
-                self._call_callback(rawdata[i:entity_end],
-                                    segment_separates_nltext=True)
-            else:
-                entity_end = i + 1
-                self.handle_data(rawdata, i, entity_end)
-            return self.updatepos(i, entity_end)
-
-        return None
-
-    def parse(self, rawdata):
-        """Lex the contents of rawdata, calling a callback for each segment.
+        if not self._at_eof and i + self.FEED_LOOKAHEAD > len(rawdata):
+            raise _NeedMoreData()
+        m = self.ENTITY_START.match(rawdata, i)
+        if not m:
+            return None
+
+        # First figure out where the entity ends, then tell the callback.
+        # That way we don't call it at all if we need more data first.
+        tagname = None          # set for html tags
+        segment_separates_nltext = True
+        if m.lastindex > 1:     # one of our TEMPLATE_ENTITIES
+            (_, endtag, segment_separates_nltext) = (
+                self.TEMPLATE_ENTITIES[m.lastindex - 2])
+            kind = Segment.TEMPLATE
+            entity_end = self.parse_to(endtag, i)
+        elif self.match_tagname(rawdata, i + 1) is not None:
+            (entity_end, tagname, attrs, value_poses) = (
+                self.parse_starttag(rawdata, i))
+        elif rawdata.startswith("</", i):
+            (entity_end, tagname) = self.parse_endtag(rawdata, i)
+            (attrs, value_poses) = ([], None)
+        elif rawdata.startswith("<!--", i):
+            # We *could* collect text like 'a<!-- b -->c', but...
+            kind = Segment.COMMENT
+            entity_end = self.parse_comment(i)      # in markupbase
+        elif rawdata.startswith("<?", i):
+            kind = Segment.PI
+            entity_end = self.parse_to(self.PICLOSE, i)
+        elif rawdata.startswith("<!", i):
+            kind = Segment.DECL
+            entity_end = self.parse_declaration(i)  # in markupbase
+        else:
+            entity_end = None   # not an entity, just a '<'
+
+        if entity_end == -1:    # markupbase's way of saying 'incomplete'
+            self._reached_end()
+            self.error("Unterminated %s" % rawdata[i:i + 4])
+        if (not self._at_eof and entity_end is not None and
+                entity_end + self.FEED_LOOKAHEAD > len(rawdata)):
+            raise _NeedMoreData()
+
+        if entity_end is None:
+            entity_end = i + 1
+            self.handle_data(rawdata, i, entity_end)
+        elif tagname is not None:
+            self.handle_tag(rawdata, i, entity_end, tagname, attrs,
+                            value_poses)
+        else:
+            self._emit(rawdata, kind, i, entity_end, segment_separates_nltext)
+        return self.updatepos(i, entity_end)
 
-        Arguments:
-           rawdata: the document to parse.
+    def _lex(self):
+        """Lex as much of self.rawdata as we can, and discard it.
 
-        Returns:
-           Forwards the return value of the callback as described in
-           HtmlLexer.__doc__.
+        If self._at_eof is False, we stop at the start of the first
+        entity that might continue past the end of self.rawdata, or at
+        the start of the final run of text (which might continue into
+        the next feed()), and keep those around to lex next time.
         """
-        _markupbase.ParserBase.reset(self)
-        self.rawdata = rawdata
-        self.callback_outputs = []
-        self.interesting = self.INTERESTING_NORMAL
+        for _ in self._lex_steps():
+            pass
 
+    def _lex_steps(self):
+        """The guts of _lex(), yielding after lexing each entity."""
+        rawdata = self.rawdata
         i = 0
         n = len(rawdata)
         while i < n:
@@ -836,8 +2185,10 @@ class HtmlLexer(_markupbase.ParserBase):
             match = self.interesting.search(rawdata, i)  # <
             if match:
                 entity_start = match.start()
-            else:
+            elif self._at_eof:
                 entity_start = n
+            else:
+                break
 
             # 1) Everything up to the next tag.
             if i < entity_start:   # handle text up until the next entity
@@ -846,23 +2197,142 @@ class HtmlLexer(_markupbase.ParserBase):
 
             # 2) The next tag.
             if i < n:
-                i = self.parse_entity(i)
+                # parse_starttag() and parse_endtag() may change this.
+                interesting = self.interesting
+                try:
+                    i = self.parse_entity(i)
+                except _NeedMoreData:
+                    self.interesting = interesting
+                    break
+                except HTMLParseError:
+                    # This may just be because the entity is cut off.
+                    if self._at_eof:
+                        raise
+                    self.interesting = interesting
+                    break
                 assert i is not None, "interesting.search() lied"
+                yield
+
+        assert i == n or not self._at_eof, (i, n)
+        # Keep track of where the data we keep starts in the document.
+        _markupbase.ParserBase.updatepos(self, 0, i)
+        self._pos = 0
+        self.rawdata = rawdata[i:]
+
+    def _take_callback_outputs(self):
+        """Return the concatenated callback outputs so far, and clear them."""
+        if self.sink is not None:
+            return None         # we've written them to the sink instead
+        output = ''.join(self.callback_outputs)
+        self.callback_outputs = []
+        return output
 
-        assert i == n, (i, n)
-        if self.callback_outputs:
+    def _finish(self):
+        """Tell the callback we're done, and return parse()'s retval."""
+        if self._callback_returned_output:
             # Case (1) from HtmlLexer.__doc__: If the callback has
             # been returning values, then treat them as strings, and
             # concatenate and return them.  We need to make our
             # promised 'cleanup' callback call first, though.
             self._call_callback(None, segment_separates_nltext=True)
-            return ''.join(self.callback_outputs)
+            return self._take_callback_outputs()
         else:
             # Case (2) (and (3)) from HtmlLexer.__doc__: if the
             # callback has returned None up until now, we should
             # just forward the value of the 'cleanup' callback call.
             return self.callback(None, segment_separates_nltext=True)
 
+    def parse(self, rawdata, sink=None):
+        """Lex the contents of rawdata, calling a callback for each segment.
+
+        Arguments:
+           rawdata: the document to parse.
+           sink: if not None, a file-like object to write the callback
+              outputs to, in case (1) from HtmlLexer.__doc__.
+
+        Returns:
+           Forwards the return value of the callback as described in
+           HtmlLexer.__doc__, or None if it's been written to sink.
+        """
+        self.reset(sink)
+        self.rawdata = rawdata
+        self._lex()
+        return self._finish()
+
+    def iter_segments(self, rawdata):
+        """Lex rawdata, yielding a Segment for each segment.
+
+        This is an alternative to parse(), for when you don't need
+        the text of every segment: we don't call the callback, and
+        don't make a string for each segment, just a small record
+        of where it is in rawdata.  Note this resets any feed() in
+        progress.
+        """
+        self.reset()
+        self.rawdata = rawdata
+        self._segments = segments = []
+        for _ in self._lex_steps():
+            for segment in segments:
+                yield segment
+            del segments[:]
+        for segment in segments:     # the text after the last entity
+            yield segment
+        self._segments = None
+
+    def segment_table(self, rawdata):
+        """Lex rawdata into a SegmentTable, without calling the callback."""
+        return SegmentTable.from_segments(self.iter_segments(rawdata))
+
+    def replay(self, table, rawdata, sink=None):
+        """Like parse(), but takes the segments from a SegmentTable.
+
+        table should be what segment_table(rawdata) returned, perhaps
+        from some other lexer of the same type.  We call the callback
+        for each segment in it just as parse(rawdata, sink) would, and
+        return what parse() would, but without lexing rawdata again.
+        """
+        self.reset(sink)
+        call_callback = self._call_callback
+        for (start, end, separates) in zip(table.starts, table.ends,
+                                           table.separates):
+            call_callback(rawdata[start:end], separates == 1)
+        return self._finish()
+
+    def feed(self, data):
+        """Lex the next chunk of a document, calling the callback as we go.
+
+        This lets us lex a document in pieces, rather than needing it
+        all in memory at once for parse().  We only hold on to the
+        part of the document we haven't been able to lex yet: an
+        entity that may be cut off, and the text before it, which
+        may continue into the next chunk.  Call close() at the end
+        of the document, and reset() before starting a new one.  To
+        write the output to a file-like object as we go, pass it to
+        reset() as the sink.
+
+        Returns:
+           The concatenation of the strings the callback has returned
+           so far, not counting ones returned by earlier feed() calls,
+           for callbacks like case (1) in HtmlLexer.__doc__.  Thus
+           ''.join(the return values of feed()) + close() is the
+           same as parse() on the whole document.  If we have a sink,
+           we write the strings to it instead, and return None.
+        """
+        self._at_eof = False
+        self.rawdata += data
+        self._lex()
+        return self._take_callback_outputs()
+
+    def close(self):
+        """Lex whatever is left from feed(), and end the document.
+
+        Returns:
+           What parse() would, less what feed() has already returned.
+        """
+        self._at_eof = True
+        self._lex()
+        return self._finish()
+
 
 class Jinja2HtmlLexer(HtmlLexer):
     """A version of HtmlLexer that can handle jinja2 markup.
@@ -875,8 +2345,8 @@ class Jinja2HtmlLexer(HtmlLexer):
     while jinja2 variables are included in runs.
 
     The only tricky bit is parsing tag names and attributes: jinja2
-    elements can be inside html tags, gumming up the works.  So
-    BARE_ATTR and ATTR_AND_VALUE are a little complicated.
+    elements can be inside html tags, gumming up the works.  So we
+    tell HtmlLexer.parse_starttag() what jinja2 markup looks like.
 
     We need a specialized parser for this because jinja2 markup is
     processed *first*, before html markup, by the jinja2 template
@@ -887,76 +2357,35 @@ class Jinja2HtmlLexer(HtmlLexer):
     # TODO(csilvers): make sure we ignore end </'s in {# jinja2 comments #}
     INTERESTING_CDATA = lambda cls, tag: re.compile(r'</\s*%s' % tag, re.I)
 
+    # Allow '<div{%if foo%} clear{%endif%}>' and '<img alt="{{ alt }}">'.
+    TEMPLATE_MARKUP_START = '{[{%]'
     # Matches {{[not }}]*}}
-    _J2_VAR = r'{{(?:}?[^}])*}}'
+    TEMPLATE_VAR = re.compile(r'{{(?:}?[^}])*}}')
+    TEMPLATE_VAR_END = '}}'
     # Matches {% foo %}...{% else %}...{% etc %}...{% endfoo %}
     # Also, {%- foo -%}...{%- else -%}...{%- etc -%}...{%- endfoo -%}
-    _J2_BALANCED_BLOCK = r'{%-?\s*(?!end).*?{%-?\s*end[^%]*%}'
-
-    # Allow '<div{%if foo%} clear{%endif%}>'.
-    TAGFIND = re.compile('[a-zA-Z][-.a-zA-Z0-9:_]*(?:\s+|(?=>|/>|%s))'
-                         % _J2_BALANCED_BLOCK)
-
-    # A 'bare' attribute (without a value) can look like an attribute-
-    # name, or it can look like a jinja2 variable or a jinja2 block,
-    # but either way it's followed by a space or tag-end, and not by an
-    # equals.  (If it's a block, it could be an attribute-value pair;
-    # it's too annoying for us to figure it out.)
-    # NOTE: an attribute can end with a space, or with the tagend marker
-    # (> or />).  In jinja2-land, it can also end with a jinja2 block:
-    #    <a id="foo"{% if is_profile_empty %} class="empty"{% endif %}>
-    BARE_ATTR = re.compile(
-        r'(?P<attr>%s|%s|%s)(?:\s+(?!=)|(?=>|/>|%s))'
-        % (HtmlLexer._ATTR_NAME, _J2_VAR, _J2_BALANCED_BLOCK,
-           _J2_BALANCED_BLOCK),
-        re.DOTALL)
-
-    # Otherwise, the attribute has a value.  In this case, we require the
-    # attribute be named explicitly (no '{{attr}}=1'), but the value can
-    # be a raw string, a "quoted string" or 'quoted string', a {{jinja2
-    # variable}}, or a {%jinja2 block%}.
-    ATTR_AND_VALUE = re.compile(
-        r'(?P<attr>%(attr)s)\s*=\s*'
-        r"(?:'(?P<lita>(?:%(j2v)s|%(j2b)s|[^\'])*)'"    # LITA
-        r'|"(?P<lit>(?:%(j2v)s|%(j2b)s|[^\"])*)"'       # LIT
-        r'|(?P<bare>(?:%(j2v)s|%(j2b)s|[^\'\">\s])+)'   # bare value
-        r')(?:\s+|(?=>|/>|%(j2b)s))'           # end
-        % {'attr': HtmlLexer._ATTR_NAME,
-           'j2v': _J2_VAR, 'j2b': _J2_BALANCED_BLOCK},
-        re.DOTALL)
-
-    def parse_entity(self, i):
-        # First, see if it's an html entity.
-        retval = HtmlLexer.parse_entity(self, i)
-        if retval is not None:
-            return retval
-
-        # OK, maybe it's a jinja2 entity.
-        # 3rd value here is true for tags that break up natural language runs.
-        tags = (('{#', '#}', True),
-                ('{%', '%}', True),
-                ('{{', '}}', True),
-
-                # We never try to merge already-marked-up i18n
-                # text with its neighbors.
-                ('{{ _(', '}}', True),
-                ('{{ _TODO(', '}}', True),
-                ('{{ i18n_do_not_translate(', '}}', True),
-                ('{{ ngettext(', '}}', True),
-                # ('{{', '}}', False)
+    BLOCK_TAG = re.compile(r'{%-?\s*(?P<close>end)?(?P<name>\w*)')
+    BLOCK_TAG_END = '%}'
+
+    SIMPLE_ATTR = _compile_simple_attr(HtmlLexer._ATTR_NAME, TEMPLATE_VAR,
+                                       HtmlLexer.FLAT_BLOCK)
+    VALUE_STOPS = _compile_value_stops(TEMPLATE_MARKUP_START)
+
+    # 3rd value here is true for tags that break up natural language runs.
+    TEMPLATE_ENTITIES = (
+        ('{#', '#}', True),
+        ('{%', '%}', True),
+        ('{{', '}}', True),
+
+        # We never try to merge already-marked-up i18n
+        # text with its neighbors.
+        ('{{ _(', '}}', True),
+        ('{{ _TODO(', '}}', True),
+        ('{{ i18n_do_not_translate(', '}}', True),
+        ('{{ ngettext(', '}}', True),
+        # ('{{', '}}', False)
         )
-
-        rawdata = self.rawdata
-        for (starttag, endtag, segment_separates_nltext) in tags:
-            if rawdata.startswith(starttag, i):
-                entity_end = self.parse_to(endtag, i)
-                self._call_callback(rawdata[i:entity_end],
-                                    segment_separates_nltext)
-                return self.updatepos(i, entity_end)
-
-        # This is probably impossible: if we get here, it means
-        # self.INTERESTING matched something not present in `tags`.
-        return None
+    ENTITY_START = _compile_entity_scanner(TEMPLATE_ENTITIES)
 
 
 class HandlebarsHtmlLexer(HtmlLexer):
@@ -978,76 +2407,47 @@ class HandlebarsHtmlLexer(HtmlLexer):
     # TODO(csilvers): make sure we ignore end </'s in {{! comments }}
     INTERESTING_CDATA = lambda cls, tag: re.compile(r'</\s*%s' % tag, re.I)
 
+    # Allow '<div{{#if foo}} clear{{/if}}>' and '<img alt="{{alt}}">'.
+    TEMPLATE_MARKUP_START = '{{'
     # Matches {{[not }}]*}}
-    _HBARS_VAR = r'{{{?[^!#/>](?:}?[^}])*}?}}'
+    TEMPLATE_VAR = re.compile(r'{{{?[^!#/>](?:}?[^}])*}?}}')
+    TEMPLATE_VAR_END = '}}'
     # Matches {{#foo}}...{{else}}...{{etc}}...{{/foo}}
-    # We need to define this multiple times because the ?P= requires
-    # unique names.  We use _HBARS_BALANCED_BLOCK 4 times in ATTR_AND_VALUE,
-    # and each of those times needs a different (?P<name>...).
-    # Passing in different values for 'i' provides that.
-    _HBARS_BALANCED_BLOCK = lambda i: (
-        r'{{#\s*(?P<hbb%d>[^\s}]+).*?{{/\s*(?P=hbb%d)\s*}}' % (i, i))
-
-    # Allow '<div{{#if foo}} clear{{/if}}>'.
-    TAGFIND = re.compile('[a-zA-Z][-.a-zA-Z0-9:_]*(?:\s+|(?=>|/>|%s))'
-                         % _HBARS_BALANCED_BLOCK(1))
-
-    # These are similar to Jinja2HtmlLexer.BARE_ATTR.
-    BARE_ATTR = re.compile(
-        r'(?P<attr>%s|%s|%s)(?:\s+(?!=)|(?=>|/>|%s))'
-        % (HtmlLexer._ATTR_NAME, _HBARS_VAR, _HBARS_BALANCED_BLOCK(1),
-           _HBARS_BALANCED_BLOCK(2)),
-        re.DOTALL)
-
-    ATTR_AND_VALUE = re.compile(
-        r'(?P<attr>%(attr)s)\s*=\s*'
-        r"(?:'(?P<lita>(?:%(hbv)s|%(hbb1)s|[^\'])*)'"    # LITA
-        r'|"(?P<lit>(?:%(hbv)s|%(hbb2)s|[^\"])*)"'       # LIT
-        r'|(?P<bare>(?:%(hbv)s|%(hbb3)s|[^\'\">\s])+)'   # bare value
-        r')(?:\s+|(?=>|/>|%(hbb4)s))'           # end
-        % {'attr': HtmlLexer._ATTR_NAME, 'hbv': _HBARS_VAR,
-           'hbb1': _HBARS_BALANCED_BLOCK(1), 'hbb2': _HBARS_BALANCED_BLOCK(2),
-           'hbb3': _HBARS_BALANCED_BLOCK(3), 'hbb4': _HBARS_BALANCED_BLOCK(4)},
-        re.DOTALL)
-
-    def parse_entity(self, i):
-        # First, see if it's an html entity.
-        retval = HtmlLexer.parse_entity(self, i)
-        if retval is not None:
-            return retval
-
-        # OK, maybe it's a handlebars entity.
-        # 3rd value here is true for tags that break up natural language runs.
-        tags = (('{{!', '}}', True),
-                # We never try to i18nize already-marked-up text.
-                ('{{#_}}', '{{/_}}', True),
-                ('{{_', '}}', True),
-                ('{{', '}}', True),
-
-                ('{{#ngettext', '{{/ngettext}}', True),
-                ('{{#i18nDoNotTranslate', '{{/i18nDoNotTranslate}}', True),
-                # TODO(csilvers): how to i18n-ize function args?  Not
-                # critical since we don't seem to have any nl text here.
-                ('{{#', '}}', True),
-                ('{{else', '}}', True),
-                ('{{/', '}}', True),
-                ('{{>', '}}', True),
-                # This must come before '{{', so it matches first.
-                ('{{{', '}}}', False)
-                # ('{{', '}}', False))
-                )
-
-        rawdata = self.rawdata
-        for (starttag, endtag, segment_separates_nltext) in tags:
-            if rawdata.startswith(starttag, i):
-                entity_end = self.parse_to(endtag, i)
-                self._call_callback(rawdata[i:entity_end],
-                                    segment_separates_nltext)
-                return self.updatepos(i, entity_end)
-
-        # This is probably impossible: if we get here, it means
-        # self.INTERESTING matched something not present in `tags`.
-        return None
+    BLOCK_TAG = re.compile(r'{{(?:#|(?P<close>/))\s*(?P<name>[^\s}]+)')
+    BLOCK_TAG_END = '}}'
+    # {{/foo}} only closes a {{#foo}}; in particular, {{#if}}...{{/each}}
+    # isn't a balanced block.
+    BLOCK_CLOSE_MUST_MATCH = True
+    # Matches {{#if x}}...{{else}}...{{/if}}, for the block helpers
+    # people use most, nested at most one deep.
+    FLAT_BLOCK = _handlebars_block_regexp(('if', 'unless', 'each', 'with'),
+                                          depth=2)
+
+    SIMPLE_ATTR = _compile_simple_attr(HtmlLexer._ATTR_NAME, TEMPLATE_VAR,
+                                       FLAT_BLOCK)
+    VALUE_STOPS = _compile_value_stops(TEMPLATE_MARKUP_START)
+
+    # 3rd value here is true for tags that break up natural language runs.
+    TEMPLATE_ENTITIES = (
+        ('{{!', '}}', True),
+        # We never try to i18nize already-marked-up text.
+        ('{{#_}}', '{{/_}}', True),
+        ('{{_', '}}', True),
+        ('{{', '}}', True),
+
+        ('{{#ngettext', '{{/ngettext}}', True),
+        ('{{#i18nDoNotTranslate', '{{/i18nDoNotTranslate}}', True),
+        # TODO(csilvers): how to i18n-ize function args?  Not
+        # critical since we don't seem to have any nl text here.
+        ('{{#', '}}', True),
+        ('{{else', '}}', True),
+        ('{{/', '}}', True),
+        ('{{>', '}}', True),
+        # This must come before '{{', so it matches first.
+        ('{{{', '}}}', False)
+        # ('{{', '}}', False))
+        )
+    ENTITY_START = _compile_entity_scanner(TEMPLATE_ENTITIES)
 
 
 class NullTextHandler(object):
@@ -1070,24 +2470,41 @@ class NullTextHandler(object):
     # Used to test if a run of natural language actually has any
     # *language* in it.  For instance, ' ' is a run of natural
     # language as far as HtmlLexer is concerned, but not an
-    # interesting one as far as we're concerned...
-    NO_NATURAL_LANGUAGE = re.compile(r'^([^\w&]|&(%s)\b)*$'
-                                     % _NON_ALNUM_ENTITIES, re.UNICODE)
-
-    # We also want to ignore most natural language (especially
-    # whitespace) at the start of a run of text.
-    NO_NATURAL_LANGUAGE_PREFIX = re.compile(r'^([^\w&]|&(%s)\b)+'
-                                            % _NON_ALNUM_ENTITIES, re.UNICODE)
-
-    # Likewise, we want to ignore whitespace/etc at the end of a run of
-    # text.  But we want to keep periods and other closing punctuation.
-    NO_NATURAL_LANGUAGE_SUFFIX = re.compile(r'(\s|[@#$^*|]|&(%s)\b)+$'
-                                            % _NON_ALNUM_ENTITIES, re.UNICODE)
-
-    def __init__(self, tag_parser):
-        """tag_parser is used to i18nize nl-text inside tag attributes."""
+    # interesting one as far as we're concerned...  We also use it
+    # to ignore most non-language (especially whitespace) at the
+    # start of a run of text, and whitespace/etc at the end of it.
+    NL_CLASSIFIER = NaturalLanguageClassifier()
+
+    # Tags that have no end-tag, so we don't try to pair them up.
+    _NO_CLOSE_TAGS = frozenset(('<br>', '<img>'))
+    _NO_CLOSE_TAG_PREFIXES = ('<br ', '<img ')
+
+    def __init__(self, tag_parser, config=None):
+        """tag_parser is used to i18nize nl-text inside tag attributes.
+
+        config is the I18nizeConfig to use, or None to use the default
+        config (as changed by the add_* and mark_* fns).  tag_parser
+        should use the same config.
+        """
         self.nltext_segments = []
         self.tag_parser = tag_parser
+        self.config = config
+
+        # All text handlers of the same class, whose tag_parsers are
+        # of the same class and call back to the same class of text
+        # handler, rewrite a given tag or nltext run the same way.
+        # So they can share what they've rewritten (unless the
+        # tag_parser calls back to something we don't know about).
+        tag_handler = getattr(getattr(tag_parser, 'callback', None),
+                              '__self__', None)
+        if tag_parser is None or isinstance(tag_handler, NullTextHandler):
+            self._cache_key = (type(self), type(tag_parser),
+                                   type(tag_handler))
+        else:
+            self._cache_key = None
+
+    def _config(self):
+        return self.config or _CONFIG
 
     def is_entity(self, segment):
         """Return true if segment is an <html tag>, not a string of text."""
@@ -1108,7 +2525,7 @@ class NullTextHandler(object):
         can override this to add their own checks.
         """
         return (self.is_entity(segment) or
-                self.NO_NATURAL_LANGUAGE.match(segment))
+                self.NL_CLASSIFIER.no_natural_language(segment))
 
     def add_underscore(self, segments):
         return ''.join(segments)
@@ -1117,17 +2534,14 @@ class NullTextHandler(object):
         """If we don't have someone else to parse tags, then we're doing it."""
         return self.tag_parser is None
 
-    def _segment_is_tag(self, segment, tagname):
-        return (segment == '<%s>' % tagname or
-                segment.startswith('<%s ' % tagname))
-
     def replace_natural_language_in_attributes(self, tag_contents, tagname,
                                                attrs, value_poses, munge_fn):
         """Replaces any nl attrs with the result of the munge_fn within tag."""
 
         # This yields the attrs backwards, so when we rewrite one,
         # it doesn't affect the positions of the next ones.
-        for i in natural_language_attributes(tagname, attrs):
+        for i in self._config().natural_language_attributes(tagname,
+                                                             attrs):
             (_, val) = attrs[i]
             munged_val = munge_fn(val)
             value_pos = value_poses[i]     # (start, end) pos of value
@@ -1136,27 +2550,57 @@ class NullTextHandler(object):
 
         return tag_contents
 
+    def _i18nize_attribute_value(self, value):
+        """Return self.tag_parser.parse(value), but faster if we can."""
+        if self.tag_parser.INTERESTING_NORMAL.search(value):
+            return self.tag_parser.parse(value)
+        # Most values are just text, with no tags or template markup.
+        # Lexing them would just pass the whole value to the callback
+        # as one segment, so we can skip the lexing and do that here.
+        callback = self.tag_parser.callback
+        retval = callback(value, False) if value else ''
+        return retval + callback(None, True)
+
     def handle_tag(self, tag_contents):
         """Return a version of tag_contents with nl-text in attrs marked up."""
 
         if not self.tag_parser:
             return tag_contents
-
-        # First, we call into the parser to get the tagname and attributes.
-        try:
-            (tag_end, tagname, attrs, value_poses) = (
-                self.tag_parser.parse_starttag(tag_contents, 0))
-            assert tag_end == len(tag_contents)
-        except AssertionError:        # not actually a tag
+        if self._cache_key is None:
+            return self._handle_tag(tag_contents)
+        return self._config().tag_rewrites.get(self._cache_key, tag_contents,
+                                               self._handle_tag)
+
+    def _handle_tag(self, tag_contents):
+        """The uncached version of handle_tag()."""
+        # Most tags don't have any attrs that could hold nl-text, and
+        # we can tell that without parsing them.
+        config = self._config()
+        if not config.may_have_natural_language_attributes(tag_contents):
             return tag_contents
 
+        # First, we get the tagname and attributes.  Usually the lexer
+        # has already parsed the tag for us; if not, we do it ourselves.
+        if isinstance(tag_contents, StartTag):
+            (tagname, attrs, value_poses) = (tag_contents.tagname,
+                                             tag_contents.attrs,
+                                             tag_contents.value_poses)
+        else:
+            try:
+                (tag_end, tagname, attrs, value_poses) = (
+                    self.tag_parser.parse_starttag(tag_contents, 0))
+                assert tag_end == len(tag_contents)
+            except AssertionError:        # not actually a tag
+                return tag_contents
+
         # Check whether it's possible this tag has natural-language attr-vals.
         if not attrs:
             return tag_contents
 
         # i18nize any nl attrs within the tag.
         tag_contents = self.replace_natural_language_in_attributes(
-            tag_contents, tagname, attrs, value_poses, self.tag_parser.parse)
+            tag_contents, tagname, attrs, value_poses,
+            self._i18nize_attribute_value)
 
         return tag_contents
 
@@ -1220,51 +2664,56 @@ class NullTextHandler(object):
         # stay together.
 
         # Assume tags are properly nested.  We *could* check tagnames too...
-        tag_map = {}   # segment-holding-start-tag -> segment-holding-end-tag
+        # While we're looking at every segment, we also find the first
+        # and last ones with natural language in them.  (Tags never do.)
+        tag_pairs = []   # (segment-holding-start-tag, ...-end-tag)
         tag_stack = []
+        first = None     # first 'contentful' segment
+        last = None      # last 'contentful' segment
+        no_natural_language = self.NL_CLASSIFIER.no_natural_language
         for (i, text_segment) in enumerate(text_segments):
-            if text_segment.startswith('</'):
+            if not text_segment.startswith('<'):
+                if not no_natural_language(text_segment):
+                    if first is None:
+                        first = i
+                    last = i
+            elif text_segment.startswith('</'):
                 if tag_stack:
-                    start_segment = tag_stack.pop()
-                    tag_map[start_segment] = i
+                    tag_pairs.append((tag_stack.pop(), i))
             elif (text_segment.endswith('/>') or         # open+close together
-                  self._segment_is_tag(text_segment, 'br')  or  # has no close
-                  self._segment_is_tag(text_segment, 'img')):
+                  text_segment in self._NO_CLOSE_TAGS or        # has no close
+                  text_segment.startswith(self._NO_CLOSE_TAG_PREFIXES)):
                 pass                             # a push followed by a pop :)
-            elif text_segment.startswith('<'):
+            else:
                 tag_stack.append(i)
-
-        first = 0                       # first 'contentful' segment
-        last = len(text_segments) - 1   # last 'contentful' segment
-        while (first <= last and
-               (text_segments[first].startswith('<') or
-                self.NO_NATURAL_LANGUAGE.match(text_segments[first]))):
-            first += 1
-        while (first <= last and
-               (text_segments[last].startswith('<') or
-                 self.NO_NATURAL_LANGUAGE.match(text_segments[last]))):
-            last -= 1
+        if first is None:      # nothing contentful: an empty [first..last]
+            (first, last) = (len(text_segments), len(text_segments) - 1)
 
         # Now modify first and last so that matching tags stay together.
         # At the end of this, all pairs will either be entirely inside
-        # [first..last], or entirely outside it.  (This depends on the
-        # fact tags nest.)
-        for (start_segment, end_segment) in tag_map.items():
-            if start_segment >= first and start_segment <= last:
-                last = max(last, end_segment)
-            if end_segment >= first and end_segment <= last:
-                first = min(first, start_segment)
+        # [first..last], or entirely outside it.  Since tags nest, we
+        # only need to widen [first..last] once, for the pairs that
+        # have just one end inside it: if a pair P starts inside and
+        # ends after last, then any pair with an end between last and
+        # the end of P must be nested inside P, so it's inside the
+        # widened range too.  Likewise for pairs that end inside.
+        (first, last) = (
+            min([first] + [start for (start, end) in tag_pairs
+                           if first <= end <= last]),
+            max([last] + [end for (start, end) in tag_pairs
+                          if first <= start <= last]))
 
         # The above fails when end-of-sentence punctuation follows a
         # tag: "foo <b>bar</b>?"  In this case, '?' is in a segment of
         # its own, and since it's not natural language, it will be left
         # out of the segments-to-translate, which is bad.  We avoid
-        # this by using the looser NO_NATURAL_LANGUAGE_SUFFIX test on
-        # the last segment, when the preceding segment is a tag.
+        # this by using the looser NL_CLASSIFIER.suffix_start() test
+        # on the last segment, when the preceding segment is a tag.
         if (last > first and last < len(text_segments) - 1 and
             not self.is_entity(text_segments[last + 1]) and
             self.is_entity(text_segments[last]) and
-            not self.NO_NATURAL_LANGUAGE_SUFFIX.match(text_segments[last + 1])
+            not (text_segments[last + 1] and
+                 self.NL_CLASSIFIER.suffix_start(text_segments[last + 1]) == 0)
             ):
                 last += 1
 
@@ -1275,24 +2724,24 @@ class NullTextHandler(object):
         # The prefix of the first i18n segment, and the suffix of the last
         # i18n segment, may also be whitespace (or non-text).  e.g.
         # ['  My name!  '].  Move those out of _() as well.
-        def move_prefix_out(regexp):
-            """If i18n_segments starts with regexp, move it to pre_segments."""
+        def move_prefix_out(prefix_end):
+            """Move the start of i18n_segments[0] to pre_segments."""
             if i18n_segments and not self.is_entity(i18n_segments[0]):
-                m = regexp.match(i18n_segments[0])
-                if m:
-                    pre_segments.append(i18n_segments[0][:m.end()])
-                    i18n_segments[0] = i18n_segments[0][m.end():]
+                end = prefix_end(i18n_segments[0])
+                if end:
+                    pre_segments.append(i18n_segments[0][:end])
+                    i18n_segments[0] = i18n_segments[0][end:]
 
-        def move_suffix_out(regexp):
-            """If i18n_segments ends with regexp, move it to post_segments."""
+        def move_suffix_out(suffix_start):
+            """Move the end of i18n_segments[-1] to post_segments."""
             if i18n_segments and not self.is_entity(i18n_segments[-1]):
-                m = regexp.search(i18n_segments[-1])
-                if m:
-                    post_segments.insert(0, i18n_segments[-1][m.start():])
-                    i18n_segments[-1] = i18n_segments[-1][:m.start()]
+                start = suffix_start(i18n_segments[-1])
+                if start < len(i18n_segments[-1]):
+                    post_segments.insert(0, i18n_segments[-1][start:])
+                    i18n_segments[-1] = i18n_segments[-1][:start]
 
-        move_prefix_out(self.NO_NATURAL_LANGUAGE_PREFIX)
-        move_suffix_out(self.NO_NATURAL_LANGUAGE_SUFFIX)
+        move_prefix_out(self.NL_CLASSIFIER.prefix_end)
+        move_suffix_out(self.NL_CLASSIFIER.suffix_start)
 
         # The *only* difference in our handling of text inside a tag
         # attribute vs outside, is that when we're inside a tag we
@@ -1300,12 +2749,13 @@ class NullTextHandler(object):
         # part of the html markup:
         #    <img alt="hello">   <-- do not include quotes in _(...)
         if self.inside_tag():
-            quotes_re_string = '[\'\"]'
-            move_prefix_out(re.compile(r'^%s' % quotes_re_string))
-            move_suffix_out(re.compile(r'%s$' % quotes_re_string))
+            quotes = ('"', "'")
+            move_prefix_out(lambda text: 1 if text[:1] in quotes else 0)
+            move_suffix_out(lambda text: (len(text) - 1 if text[-1:] in quotes
+                                          else len(text)))
 
-        # NO_NATURAL_LANGUAGE_PREFIX and NO_NATURAL_LANGUAGE_SUFFIX
-        # are asymmetrical, so it's possible to match ')' on the end
+        # NL_CLASSIFIER.prefix_end() and suffix_start() are
+        # asymmetrical, so it's possible to match ')' on the end
         # of i18n_segments without matching the corresponding '(' at
         # the beginning.  Let's embrace symmetry and correct for that.
         _SYMMETRY_PAIRS = ('""', "''", '()', '[]', '{}', '<>')
@@ -1357,7 +2807,13 @@ class NullTextHandler(object):
             # Emit the natural-language text we've been buffering up.
             if self.nltext_segments:
                 # This add_i18n() call is the whole point of all this parsing!
-                retval += self.add_i18n(self.nltext_segments)
+                if _RUN_CACHE is None or self._cache_key is None:
+                    retval += self.add_i18n(self.nltext_segments)
+                else:
+                    retval += _RUN_CACHE.get(self._cache_key,
+                                             self._config(),
+                                             self.nltext_segments,
+                                             self.add_i18n)
                 self.nltext_segments = []
 
         # Now handle our new segment
@@ -1374,6 +2830,160 @@ class NullTextHandler(object):
         return retval
 
 
+# The kinds of tokens in a template expression (the stuff inside
+# {{...}}), numbered like the groups in _EXPRESSION_TOKEN.  We don't
+# need to understand much of jinja2 (or django) expression syntax:
+# just enough to find the string literals, the parens, and the names
+# of the functions and parameters the string literals are passed to.
+(_STRING, _NAME, _SPACE, _OPEN, _CLOSE, _OTHER) = range(1, 7)
+_EXPRESSION_TOKEN = re.compile(r'("[^"]*"|\'[^\']*\')|'
+                               r'([\w.]+)|'        # maybe-dotted name
+                               r'(\s+)|'
+                               r'(\()|'
+                               r'(\))|'
+                               r'([^\w.\s"\'()]+|.)',
+                               re.UNICODE | re.DOTALL)
+
+
+class _ExpressionGroup(object):
+    """A parenthesized part of a template expression, or all of it.
+
+    children is a list of tokens -- (kind, start, end) triples, where
+    kind is one of the token kinds above -- and nested
+    _ExpressionGroups.  Each group's children start with its '('
+    token, and end with its ')' token, if it has one.  If the parens
+    follow a name, as in the function call 'foo.bar("baz")', then
+    name_start is where the name starts, else it's None.  open_pos is
+    where the '(' is; it's None for the expression as a whole.
+    """
+    __slots__ = ('name_start', 'open_pos', 'children')
+
+    def __init__(self, name_start, open_pos):
+        self.name_start = name_start
+        self.open_pos = open_pos
+        self.children = []
+
+
+def _preceding_tokens(children, i, n):
+    """Return the n children before children[i], stopping at any group."""
+    tokens = children[max(i - n, 0):i]
+    for j in range(len(tokens) - 1, -1, -1):
+        if isinstance(tokens[j], _ExpressionGroup):
+            return tokens[j + 1:]
+    return tokens
+
+
+def _parse_expression(s):
+    """Return the tree of _ExpressionGroups for template expression s."""
+    group = _ExpressionGroup(None, None)
+    parents = []
+    for m in _EXPRESSION_TOKEN.finditer(s):
+        kind = m.lastindex
+        token = (kind, m.start(), m.end())
+        if kind == _OPEN:
+            # See if we're a function call: '(' follows a name.
+            prev = _preceding_tokens(group.children, len(group.children), 2)
+            if prev and prev[-1][0] == _SPACE:
+                prev.pop()
+            if prev and prev[-1][0] == _NAME:
+                name_start = prev[-1][1]
+            else:
+                name_start = None
+            parents.append(group)
+            group = _ExpressionGroup(name_start, m.start())
+            parents[-1].children.append(group)
+            group.children.append(token)
+        elif kind == _CLOSE and parents:
+            group.children.append(token)
+            group = parents.pop()
+        else:
+            group.children.append(token)
+    # If some parens were never closed, we close them at the end.
+    return parents[0] if parents else group
+
+
+def _is_ok_param_value(s, children, i, config):
+    """True if children[i] is the value of an ok param, as in style="x"."""
+    # We look for <name> = <children[i]>, with optional spaces.
+    tokens = _preceding_tokens(children, i, 4)
+    if tokens and tokens[-1][0] == _SPACE:
+        tokens.pop()
+    if not tokens or s[tokens[-1][1]:tokens[-1][2]] != '=':
+        return False
+    tokens.pop()
+    if tokens and tokens[-1][0] == _SPACE:
+        tokens.pop()
+    if not tokens or tokens[-1][0] != _NAME:
+        return False
+    return config._ok_function_params_re.search(s, tokens[-1][1],
+                                                children[i][1])
+
+
+def _add_underscore_in_expression(s, config):
+    """Return template expression s with string literals marked up.
+
+    String literals outside of any function call, as in
+    {{ "Hello" + bar }}, get _() around them, unless they're a
+    subscript, as in {{ hello["bar"] }}.  String literals passed to
+    functions get _TODO() around them, since we don't know if
+    they're natural language or not, unless the function or parameter
+    name or the literal itself says they're not, via the
+    mark_function_*() calls (or config, an I18nizeConfig).  Anything
+    else in s is left alone.
+
+    We parse s into a tree first, and then walk over the tree, so
+    this takes time linear in the length of s, however deeply the
+    function calls in s are nested.
+    """
+    retval = []
+    top = _parse_expression(s)
+    # Walking the tree without recursion: the stack holds (group,
+    # whether the group's function args are already-translated, an
+    # iterator over the group's children we haven't gotten to yet).
+    stack = [(top, False, enumerate(top.children))]
+    while stack:
+        (group, already_translated, children) = stack[-1]
+        for (i, child) in children:
+            if isinstance(child, _ExpressionGroup):
+                # Function inside a function!  When will it ever end?!
+                is_ok_function = (child.name_start is not None and
+                                  config._ok_functions.matches(
+                                      s, child.name_start, child.open_pos))
+                stack.append((child, is_ok_function,
+                              enumerate(child.children)))
+                break
+
+            (kind, start, end) = child
+            if kind != _STRING:
+                retval.append(s[start:end])
+            elif group is top:
+                # Quotes outside a function context: {{ "Hello" + bar }}
+                # Or maybe: {{ hello["bar"] }} -- check for that too.
+                if (s.endswith('[', 0, start) or
+                        config._ok_function_arguments_re.match(
+                            s, start, end)):
+                    retval.append(s[start:end])
+                else:
+                    retval.append('_(%s)' % s[start:end])
+            else:
+                # We can be told that a string fn-argument -- e.g. in
+                # {{ myfunc(myparam="myval") }} -- in 3 ways:
+                #   1) myfunc is in config.ok_functions
+                #   2) myparam is in config.ok_function_params
+                #   3) myval is in config.ok_function_arguments
+                if (already_translated or
+                        _is_ok_param_value(s, group.children, i,
+                                           config) or
+                        config._ok_function_arguments_re.match(
+                            s, start, end)):
+                    retval.append(s[start:end])
+                else:
+                    retval.append('_TODO(%s)' % s[start:end])
+        else:      # for/else: we're done with this group
+            stack.pop()
+    return ''.join(retval)
+
+
 class Jinja2TextHandler(NullTextHandler):
     # We want to ignore runs that can't have natural language in them.
     # In addition to punctuation/whitespace/etc, this includes those
@@ -1384,8 +2994,6 @@ class Jinja2TextHandler(NullTextHandler):
     # not {{ other_function_calls("with quoted text") }}, which may
     # have natural-language function args.
     J2_VAR = re.compile(r'{{((?:}[^}]|[^}])*)}}')
-    J2_FUNCTION_ARG = re.compile(r'"([^"]|\\.)*"|'
-                                 r"'([^']|\\.)*'")
 
     def is_entity(self, segment):
         """Return true if segment is an <html tag>, not a string of text."""
@@ -1398,7 +3006,7 @@ class Jinja2TextHandler(NullTextHandler):
         # because it calls our is_entity(), which includes an unwanted
         # test for '{{'.
         if (html_handler.is_entity(segment) or
-                html_handler.NO_NATURAL_LANGUAGE.match(segment)):
+                html_handler.NL_CLASSIFIER.no_natural_language(segment)):
             return True
 
         # To check if we're already marked for translation, we'll do
@@ -1416,40 +3024,6 @@ class Jinja2TextHandler(NullTextHandler):
 
         return False
 
-    def _add_underscore_in_one_fn(self, s, i):
-        """s[i] is '(', we return (newtext, j) where j points past ')'."""
-        assert s[i] == '(', (s, i)
-        # We can be told that a string fn-argument -- e.g. in
-        # {{ myfunc(myparam="myval") }} -- in 3 ways:
-        #   1) myfunc is in _OK_FUNCTIONS_RE
-        #   2) myparam is in _OK_FUNCTION_PARAMS_RE
-        #   3) myval is in _OK_FUNCTION_ARGUMENTS_RE
-        already_translated = _OK_FUNCTIONS_RE.search(s[:i])
-        retval = '('
-        i += 1
-        while i < len(s):
-            if s[i] in ('"', "'"):
-                m = self.J2_FUNCTION_ARG.match(s[i:])
-                if (already_translated or
-                        _OK_FUNCTION_PARAMS_RE.search(s[:i]) or
-                        _OK_FUNCTION_ARGUMENTS_RE.match(m.group())):
-                    retval += s[i:(i + m.end())]
-                else:
-                    retval += '_TODO(%s)' % s[i:(i + m.end())]
-                i += m.end()
-            elif s[i] == '(':
-                # Function inside a function!  When will it ever end?!
-                (new_text, i) = self._add_underscore_in_one_fn(s, i)
-                retval += new_text
-            elif s[i] == ')':
-                retval += s[i]
-                i += 1
-                return (''.join(retval), i)
-            else:
-                retval += s[i]
-                i += 1
-        return retval
-
     def _add_underscore_in_var(self, s):
         """Given s, the contents inside {{...}}, return marked up s.
 
@@ -1463,26 +3037,7 @@ class Jinja2TextHandler(NullTextHandler):
         foo(i18n_do_not_translate("bar")) -- that depends on whether
         the function argument is a natural language string or not.
         """
-        retval = ''
-        i = 0
-        while i < len(s):
-            m = self.J2_FUNCTION_ARG.match(s[i:])
-            if m:
-                # Quotes outside a function context: {{ "Hello" + bar }}
-                # Or maybe: {{ hello["bar"] }} -- check for that too.
-                if (s.endswith('[', 0, i) or
-                        _OK_FUNCTION_ARGUMENTS_RE.match(m.group())):
-                    retval += m.group()
-                else:
-                    retval += '_(%s)' % m.group()
-                i += m.end()
-            elif s[i] == '(':
-                (new_text, i) = self._add_underscore_in_one_fn(s, i)
-                retval += new_text
-            else:
-                retval += s[i]
-                i += 1
-        return retval
+        return self._config().rewrite_expression(s)[0]
 
     def add_underscore(self, segments):
         """Add _("...") around s, handling jinja2 variables correctly.
@@ -1545,7 +3100,7 @@ class Jinja2TextHandler(NullTextHandler):
         # (though still correct) '{{ "%(fn)s", fn=fn(_("arg")) }}'.
         for segment in segments:
             if (not self.is_entity(segment) and
-                   not self.NO_NATURAL_LANGUAGE.match(segment)):
+                   not self.NL_CLASSIFIER.no_natural_language(segment)):
                 # Oops, we have 'normal' nltext, can't use the shortcut
                 break
         else:      # for/else: if we get here we *can* use the shortcut!
@@ -1577,12 +3132,10 @@ class Jinja2TextHandler(NullTextHandler):
             m = self.J2_VAR.search(segment)
             if m:
                 var = m.group(1).strip()   # include any filters or fn args
-                # Get the name of the variable or function (sans fn args).
-                varname = re.split('[|(]', var, 1)[0]   # |==filter (==fn args
-                # Normalize varname so it's a legal python variable name.
-                varname = re.sub('\W', '_', varname.strip())
-
-                new_var = self._add_underscore_in_var(var)
+                # Get the name of the variable or function (sans fn
+                # args), and mark up the string literals in var.
+                (new_var, varname) = self._config().rewrite_expression(
+                    var)
 
                 vars.setdefault(varname, new_var)
                 if vars[varname] != new_var:
@@ -1616,8 +3169,6 @@ class Jinja2TextHandler(NullTextHandler):
 
 class DjangoTextHandler(NullTextHandler):
     J2_VAR = re.compile(r'{{((?:}[^}]|[^}])*)}}')
-    J2_FUNCTION_ARG = re.compile(r'"([^"]|\\.)*"|'
-                                 r"'([^']|\\.)*'")
 
     def is_entity(self, segment):
         """Return true if segment is an <html tag>, not a string of text."""
@@ -1627,7 +3178,7 @@ class DjangoTextHandler(NullTextHandler):
     def no_natural_language_or_already_translated(self, segment):
         html_handler = super(DjangoTextHandler, self)
         if (html_handler.is_entity(segment) or
-                html_handler.NO_NATURAL_LANGUAGE.match(segment)):
+                html_handler.NL_CLASSIFIER.no_natural_language(segment)):
             return True
 
         m = self.J2_VAR.match(segment)
@@ -1640,52 +3191,8 @@ class DjangoTextHandler(NullTextHandler):
 
         return False
 
-    def _add_underscore_in_one_fn(self, s, i):
-        assert s[i] == '(', (s, i)
-        already_translated = _OK_FUNCTIONS_RE.search(s[:i])
-        retval = '('
-        i += 1
-        while i < len(s):
-            if s[i] in ('"', "'"):
-                m = self.J2_FUNCTION_ARG.match(s[i:])
-                if (already_translated or
-                        _OK_FUNCTION_PARAMS_RE.search(s[:i]) or
-                        _OK_FUNCTION_ARGUMENTS_RE.match(m.group())):
-                    retval += s[i:(i + m.end())]
-                else:
-                    retval += '_TODO(%s)' % s[i:(i + m.end())]
-                i += m.end()
-            elif s[i] == '(':
-                (new_text, i) = self._add_underscore_in_one_fn(s, i)
-                retval += new_text
-            elif s[i] == ')':
-                retval += s[i]
-                i += 1
-                return (''.join(retval), i)
-            else:
-                retval += s[i]
-                i += 1
-        return retval
-
     def _add_underscore_in_var(self, s):
-        retval = ''
-        i = 0
-        while i < len(s):
-            m = self.J2_FUNCTION_ARG.match(s[i:])
-            if m:
-                if (s.endswith('[', 0, i) or
-                        _OK_FUNCTION_ARGUMENTS_RE.match(m.group())):
-                    retval += m.group()
-                else:
-                    retval += '_(%s)' % m.group()
-                i += m.end()
-            elif s[i] == '(':
-                (new_text, i) = self._add_underscore_in_one_fn(s, i)
-                retval += new_text
-            else:
-                retval += s[i]
-                i += 1
-        return retval
+        return self._config().rewrite_expression(s)[0]
 
     def add_underscore(self, segments):
         if not segments:
@@ -1694,7 +3201,7 @@ class DjangoTextHandler(NullTextHandler):
         retval = []
         for segment in segments:
             if (not self.is_entity(segment) and
-                   not self.NO_NATURAL_LANGUAGE.match(segment)):
+                   not self.NL_CLASSIFIER.no_natural_language(segment)):
                 # Oops, we have 'normal' nltext, can't use the shortcut
                 break
         else:      # for/else: if we get here we *can* use the shortcut!
@@ -1722,12 +3229,10 @@ class DjangoTextHandler(NullTextHandler):
             m = self.J2_VAR.search(segment)
             if m:
                 var = m.group(1).strip()   # include any filters or fn args
-                # Get the name of the variable or function (sans fn args).
-                varname = re.split('[|(]', var, 1)[0]   # |==filter (==fn args
-                # Normalize varname so it's a legal python variable name.
-                varname = re.sub('\W', '_', varname.strip())
-
-                new_var = self._add_underscore_in_var(var)
+                # Get the name of the variable or function (sans fn
+                # args), and mark up the string literals in var.
+                (new_var, varname) = self._config().rewrite_expression(
+                    var)
 
                 vars.setdefault(varname, new_var)
                 if vars[varname] != new_var:
@@ -1750,52 +3255,32 @@ class DjangoTextHandler(NullTextHandler):
 class DjangoHtmlLexer(HtmlLexer):
     INTERESTING_NORMAL = re.compile('<|{{|{#|{%')
     INTERESTING_CDATA = lambda cls, tag: re.compile(r'</\s*%s' % tag, re.I)
-    _DJ_VAR = r'{{(?:}?[^}])*}}'
-    _DJ_BALANCED_BLOCK = r'{%-?\s*(?!end).*?{%-?\s*end[^%]*%}'
-    TAGFIND = re.compile('[a-zA-Z][-.a-zA-Z0-9:_]*(?:\s+|(?=>|/>|%s))'
-                         % _DJ_BALANCED_BLOCK)
-    BARE_ATTR = re.compile(
-        r'(?P<attr>%s|%s|%s)(?:\s+(?!=)|(?=>|/>|%s))'
-        % (HtmlLexer._ATTR_NAME, _DJ_VAR, _DJ_BALANCED_BLOCK,
-           _DJ_BALANCED_BLOCK),
-        re.DOTALL)
-
-    ATTR_AND_VALUE = re.compile(
-        r'(?P<attr>%(attr)s)\s*=\s*'
-        r"(?:'(?P<lita>(?:%(j2v)s|%(j2b)s|[^\'])*)'"    # LITA
-        r'|"(?P<lit>(?:%(j2v)s|%(j2b)s|[^\"])*)"'       # LIT
-        r'|(?P<bare>(?:%(j2v)s|%(j2b)s|[^\'\">\s])+)'   # bare value
-        r')(?:\s+|(?=>|/>|%(j2b)s))'           # end
-        % {'attr': HtmlLexer._ATTR_NAME,
-           'j2v': _DJ_VAR, 'j2b': _DJ_BALANCED_BLOCK},
-        re.DOTALL)
-
-    def parse_entity(self, i):
-        retval = HtmlLexer.parse_entity(self, i)
-        if retval is not None:
-            return retval
-
-        tags = (('{#', '#}', True),
-                ('{% comment %}', '{% endcomment %}', True),
-                ('{% blocktrans', '{% endblocktrans %}', True),
-                ('{% block i18n_do_not_translate %}', '{% endblock i18n_do_not_translate %}', True),
-
-                ('{% if', '{% endif %}', True),
-                ('{%', '%}', True),
-                ('{{', '}}', True),
-
-                ('{{ _(', '}}', True),
-                ('{{ _TODO(', '}}', True),
-                ('{{ i18n_do_not_translate(', '}}', True),
-                ('{{ ngettext(', '}}', True))
-        rawdata = self.rawdata
-        for (starttag, endtag, segment_separates_nltext) in tags:
-            if rawdata.startswith(starttag, i):
-                entity_end = self.parse_to(endtag, i)
-                self._call_callback(rawdata[i:entity_end],
-                                    segment_separates_nltext)
-                return self.updatepos(i, entity_end)
-        return None
+    TEMPLATE_MARKUP_START = '{[{%]'
+    TEMPLATE_VAR = re.compile(r'{{(?:}?[^}])*}}')
+    TEMPLATE_VAR_END = '}}'
+    BLOCK_TAG = re.compile(r'{%-?\s*(?P<close>end)?(?P<name>\w*)')
+    BLOCK_TAG_END = '%}'
+    SIMPLE_ATTR = _compile_simple_attr(HtmlLexer._ATTR_NAME, TEMPLATE_VAR,
+                                       HtmlLexer.FLAT_BLOCK)
+    VALUE_STOPS = _compile_value_stops(TEMPLATE_MARKUP_START)
+
+    TEMPLATE_ENTITIES = (
+        ('{#', '#}', True),
+        ('{% comment %}', '{% endcomment %}', True),
+        ('{% blocktrans', '{% endblocktrans %}', True),
+        ('{% block i18n_do_not_translate %}',
+         '{% endblock i18n_do_not_translate %}', True),
+
+        ('{% if', '{% endif %}', True),
+        ('{%', '%}', True),
+        ('{{', '}}', True),
+
+        ('{{ _(', '}}', True),
+        ('{{ _TODO(', '}}', True),
+        ('{{ i18n_do_not_translate(', '}}', True),
+        ('{{ ngettext(', '}}', True),
+        )
+    ENTITY_START = _compile_entity_scanner(TEMPLATE_ENTITIES)
 
 
 class HandlebarsTextHandler(NullTextHandler):
@@ -1812,7 +3297,7 @@ class HandlebarsTextHandler(NullTextHandler):
         # We can't just call html_handler.no_natural_language() because
         # it calls is_entity, which for us includes an unwanted test for '{{'.
         return (html_handler.is_entity(segment) or
-                html_handler.NO_NATURAL_LANGUAGE.match(segment) or
+                html_handler.NL_CLASSIFIER.no_natural_language(segment) or
                 self.HANDLEBARS_VAR_NO_NATURAL_LANGUAGE.match(segment))
 
     def add_underscore(self, segments):
@@ -1822,81 +3307,656 @@ class HandlebarsTextHandler(NullTextHandler):
         return '{{_ "%s" }}' % ''.join(segments)
 
 
+# How much of an input file i18nize() reads at a time.
+_READ_SIZE = 64 * 1024
+
+
+def _i18nize_stream(infile, parser, outfile):
+    """Write the i18nized contents of infile to outfile as we go."""
+    parser.reset(sink=outfile)
+    while True:
+        chunk = infile.read(_READ_SIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    parser.close()
+
+
 def i18nize(html_file, parser):
     if html_file == '-':
-        input = sys.stdin.read()
-    else:
+        _i18nize_stream(sys.stdin, parser, sys.stdout)
+        return
+
+    # We modify in-place, by writing to a new file and then moving it
+    # over the old one.  That way we never need the whole file in
+    # memory, and don't clobber the file if we fail halfway through.
+    def _write(tmp_f):
         with open(html_file) as f:
-            input = f.read()
+            _i18nize_stream(f, parser, tmp_f)
 
-    parsed_output = parser.parse(input)
+    _replace_file(html_file, 'w', _write)
 
-    if html_file == '-':
-        sys.stdout.write(parsed_output)
-    else:
-        with open(html_file, 'w') as f:  # we modify in-place
-            f.write(parsed_output)
 
+def _replace_contents(html_file, contents):
+    """Replace the contents of html_file with the bytes contents."""
+    _replace_file(html_file, 'wb', lambda tmp_f: tmp_f.write(contents))
 
-def get_parser_for_file(html_file, assume_handlebars=False,
-                        debug_parser=False):
-    """Return a usable parser for a file named html_file, based on the name."""
-    if html_file == '-' and assume_handlebars:
-        parser_class = HandlebarsHtmlLexer
-        text_handler = HandlebarsTextHandler
 
-    elif html_file.endswith('.handlebars'):
-        parser_class = HandlebarsHtmlLexer
-        text_handler = HandlebarsTextHandler
+def _replace_file(html_file, mode, write_fn):
+    """Replace html_file with what write_fn(file opened with mode) writes.
+
+    We write to a new file and then move it over the old one, so we
+    don't clobber the file if we fail halfway through.
+    """
+    (fd, tmp_file) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(html_file)),
+        prefix='.%s.' % os.path.basename(html_file), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as tmp_f:
+            write_fn(tmp_f)
+        shutil.copymode(html_file, tmp_file)
+        os.rename(tmp_file, html_file)
+    finally:
+        if os.path.exists(tmp_file):     # we failed before the rename
+            os.unlink(tmp_file)
+
+
+# The template languages we know: name -> (lexer, text handler).
+DIALECTS = {
+    'jinja2': (Jinja2HtmlLexer, Jinja2TextHandler),
+    'django': (DjangoHtmlLexer, DjangoTextHandler),
+    'handlebars': (HandlebarsHtmlLexer, HandlebarsTextHandler),
+}
+
+# Which dialect a file is in, by how its name ends.  Files that don't
+# end in any of these are taken to be jinja2.  When walking a
+# directory, these are also the files we i18nize by default.
+DEFAULT_DIALECT_EXTENSIONS = {
+    '.handlebars': 'handlebars',
+    '.html': 'django',
+    '.jinja2': 'jinja2',
+    '.j2': 'jinja2',
+}
+
+
+def dialect_for_file(html_file, dialect_extensions=None):
+    """Return the name of the dialect html_file is in, from its name.
+
+    dialect_extensions is like DEFAULT_DIALECT_EXTENSIONS, which is
+    what we use if it's None.  The longest matching extension wins.
+    """
+    if dialect_extensions is None:
+        dialect_extensions = DEFAULT_DIALECT_EXTENSIONS
+    matches = [extension for extension in dialect_extensions
+               if html_file.endswith(extension)]
+    if not matches:
+        # TODO(arceduardvincent): separate command for the jinja2
+        return 'jinja2'
+    return dialect_extensions[max(matches, key=len)]
 
-    elif html_file.endswith('.html'):
-        parser_class = DjangoHtmlLexer
-        text_handler = DjangoTextHandler
 
+def get_parser_for_file(html_file, assume_handlebars=False,
+                        debug_parser=False, config=None,
+                        dialect_extensions=None):
+    """Return a usable parser for a file named html_file, based on the name.
+
+    config is the I18nizeConfig to use, or None for the default config.
+    dialect_extensions is as for dialect_for_file().
+    """
+    if html_file == '-' and assume_handlebars:
+        dialect = 'handlebars'
     else:
-        # TODO(arceduardvincent): separate command for the jinja2
-        parser_class = Jinja2HtmlLexer
-        text_handler = Jinja2TextHandler
+        dialect = dialect_for_file(html_file, dialect_extensions)
+    (parser_class, text_handler) = DIALECTS[dialect]
     if debug_parser:
         print("debug_parser")
         text_handler = NullTextHandler   # overrides the above
 
     # We need a second parser to handle nl-text in tag attributes.
-    tag_parser = parser_class(text_handler(None).handle_segment)
-    parser = parser_class(text_handler(tag_parser).handle_segment)
+    tag_parser = parser_class(text_handler(None, config).handle_segment,
+                              config)
+    parser = parser_class(text_handler(tag_parser, config).handle_segment,
+                          config)
     return parser
 
 
+def _matches_any(patterns, relpath):
+    """True if relpath matches any of the glob patterns.
+
+    Patterns with a '/' in them are matched against relpath; others
+    just against its last component, so '*.txt' matches 'a/b.txt'.
+    """
+    basename = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatchcase(relpath if '/' in pattern else basename,
+                                   pattern)
+               for pattern in patterns)
+
+
+def walk_html_files(top, includes=(), excludes=(), dialect_extensions=None):
+    """Yield the files under directory top to i18nize, in sorted order.
+
+    We i18nize files matching any glob in includes, or, if there are
+    none, files ending in one of the dialect_extensions (see
+    dialect_for_file()), but not files or directories matching any
+    glob in excludes.  The globs are matched against paths relative
+    to top, as for _matches_any().  We skip files and directories
+    starting with '.', which includes the temp files that i18nize()
+    writes as it goes.
+    """
+    if dialect_extensions is None:
+        dialect_extensions = DEFAULT_DIALECT_EXTENSIONS
+    extensions = tuple(dialect_extensions)
+    # Each entry is (directory, its path relative to top), and we
+    # keep them in reverse order so we can pop the next one.
+    stack = [(top, '')]
+    while stack:
+        (dirname, reldir) = stack.pop()
+        try:
+            with os.scandir(dirname) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as why:
+            print('WARNING: skipping %s: %s' % (dirname, why),
+                  file=sys.stderr)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            relpath = reldir + entry.name
+            if _matches_any(excludes, relpath):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, relpath + '/'))
+            elif (_matches_any(includes, relpath) if includes
+                  else entry.name.endswith(extensions)):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+_READ_FILE_LIST_SIZE = 64 * 1024
+
+
+def _read_file_list(path):
+    """Yield the NUL-separated filenames in path, or stdin if it's '-'."""
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        leftover = b''
+        while True:
+            chunk = f.read(_READ_FILE_LIST_SIZE)
+            if not chunk:
+                break
+            names = (leftover + chunk).split(b'\0')
+            leftover = names.pop()
+            for name in names:
+                if name:
+                    yield os.fsdecode(name)
+        if leftover:
+            yield os.fsdecode(leftover)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def _html_files(args):
+    """Yield the files to i18nize, as we find them.
+
+    These are args.html_files, with any directories walked, and then
+    the files in args.files_from.  We only yield each file once.
+    """
+    def _all_files():
+        for html_file in args.html_files:
+            if html_file != '-' and os.path.isdir(html_file):
+                for walked_file in walk_html_files(html_file, args.include,
+                                                   args.exclude,
+                                                   args.dialects):
+                    yield walked_file
+            else:
+                yield html_file
+        if args.files_from:
+            for listed_file in _read_file_list(args.files_from):
+                yield listed_file
+
+    seen = set()
+    for html_file in _all_files():
+        if html_file not in seen:
+            seen.add(html_file)
+            yield html_file
+
+
+# Where --incremental keeps its _Manifest, by default.
+DEFAULT_MANIFEST = '.i18nize-cache'
+
+# Filesystems whose timestamps are this coarse (FAT's are 2 seconds)
+# can give a file we've just written, and then someone else changed,
+# the mtime we recorded.  So for files changed this close to when we
+# saved the manifest, we look at their contents to see if they changed.
+_RACY_MTIME_NS = 2 * 10 ** 9
+
+
+class _Manifest(object):
+    """Remembers which files a run i18nized, so the next can skip them.
+
+    For each file we i18nized, we record the hash, size and mtime of
+    what we wrote.  Next time, a file with the same size and mtime,
+    or failing that the same hash, is one we've already i18nized and
+    can skip.  Entries are only good for the customizations and
+    version of i18nize-templates that made them (see
+    I18nizeConfig.fingerprint()), and the dialect the file is in.
+
+    We also notice files in a run with the same contents and dialect
+    as an earlier one, and rather than i18nizing them again, copy
+    what we wrote for the first one (see copy_duplicates()).
+    """
+    def __init__(self, path, config, dialect_extensions):
+        self.path = path
+        self.dialect_extensions = dialect_extensions
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self._fingerprint = hashlib.sha1(config.fingerprint()).hexdigest()
+        # abspath -> [sha1 of what we wrote, size, mtime_ns, dialect]
+        self._files = {}
+        self._written_ns = 0
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest['fingerprint'] == self._fingerprint:
+                self._files = manifest['files']
+                self._written_ns = os.stat(path).st_mtime_ns
+        except (IOError, ValueError, KeyError, TypeError):
+            pass        # no manifest yet, or one we can't use: start over
+        self._firsts = {}           # (dialect, sha1) -> first file with it
+        self._duplicates = []       # (html_file, first file like it, dialect)
+        self._pending = {}          # html_file -> (abspath, dialect)
+        self._recorded = set()      # files we've recorded this run
+
+    def _stat(self, abspath):
+        st = os.stat(abspath)
+        return (st.st_size, st.st_mtime_ns)
+
+    def changed_files(self, html_files):
+        """Yield the files in html_files that we need to i18nize.
+
+        These are the files that have changed since we last recorded
+        them, except for files like an earlier one, which we remember
+        for copy_duplicates().  Call record() for each when it's been
+        i18nized.
+        """
+        for html_file in html_files:
+            if html_file == '-':
+                yield html_file
+                continue
+            abspath = os.path.abspath(html_file)
+            dialect = dialect_for_file(html_file, self.dialect_extensions)
+            entry = self._files.get(abspath)
+            try:
+                (size, mtime_ns) = self._stat(abspath)
+                if (entry is not None and entry[3] == dialect and
+                        entry[1:3] == [size, mtime_ns] and
+                        mtime_ns + _RACY_MTIME_NS < self._written_ns):
+                    self.hits += 1
+                    continue
+                with open(abspath, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            except (IOError, OSError):
+                yield html_file         # we'll say what's wrong then
+                continue
+            if entry is not None and entry[0] == digest and (
+                    entry[3] == dialect):
+                # Just touched; remember the new mtime, to skip the
+                # read next time.
+                self._files[abspath] = [digest, size, mtime_ns, dialect]
+                self.hits += 1
+                continue
+            first = self._firsts.setdefault((dialect, digest), html_file)
+            if first != html_file:
+                self._duplicates.append((html_file, first, dialect))
+                continue
+            self.misses += 1
+            self._pending[html_file] = (abspath, dialect)
+            yield html_file
+
+    def record(self, html_file):
+        """Note that we've i18nized html_file, as yielded above."""
+        if html_file not in self._pending:
+            return
+        (abspath, dialect) = self._pending.pop(html_file)
+        try:
+            with open(abspath, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            (size, mtime_ns) = self._stat(abspath)
+        except (IOError, OSError):
+            return
+        self._files[abspath] = [digest, size, mtime_ns, dialect]
+        self._recorded.add(html_file)
+
+    def copy_duplicates(self):
+        """Give files like an earlier one what we wrote for that one.
+
+        Yields the files we couldn't do that for, because we couldn't
+        i18nize the earlier one (or copy it), to be i18nized on their
+        own.
+        """
+        (duplicates, self._duplicates) = (self._duplicates, [])
+        for (html_file, first, dialect) in duplicates:
+            self._pending[html_file] = (os.path.abspath(html_file), dialect)
+            if first in self._recorded:
+                try:
+                    with open(first, 'rb') as f:
+                        contents = f.read()
+                    _replace_contents(html_file, contents)
+                except (IOError, OSError):
+                    pass
+                else:
+                    print('i18nizing %s (a copy of %s)' % (html_file, first),
+                          file=sys.stderr)
+                    self.record(html_file)
+                    self.duplicates += 1
+                    continue
+            self.misses += 1
+            yield html_file
+
+    def save(self):
+        """Write out the manifest, forgetting files that are gone."""
+        files = dict((abspath, entry)
+                     for (abspath, entry) in self._files.items()
+                     if os.path.exists(abspath))
+        (fd, tmp_file) = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix='.%s.' % os.path.basename(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'fingerprint': self._fingerprint, 'files': files},
+                          f, sort_keys=True)
+            os.replace(tmp_file, self.path)
+        finally:
+            if os.path.exists(tmp_file):     # we failed before the rename
+                os.unlink(tmp_file)
+
+
+def _i18nize_files(args, html_files, manifest=None):
+    """i18nize html_files, and return how many we couldn't.
+
+    If manifest is not None, we record() the files we i18nize in it.
+    """
+    num_errors = 0
+    for html_file in html_files:
+        try:
+            print('i18nizing %s' % html_file, file=sys.stderr)
+            parser = get_parser_for_file(html_file, args.handlebars,
+                                         args.debug_parser, args.config,
+                                         args.dialects)
+            i18nize(html_file, parser)
+            if manifest is not None:
+                manifest.record(html_file)
+        except Exception as why:
+            print('ERROR i18nizing %s: %s' % (html_file, why), file=sys.stderr)
+            num_errors += 1
+            if _is_single_file(args):
+                # For just one file, let it raise the exception if it fails.
+                raise
+    return num_errors
+
+
+def _is_single_file(args):
+    """True if we were asked to i18nize just one file (or stdin)."""
+    return (len(args.html_files) == 1 and not args.files_from and
+            (args.html_files[0] == '-' or
+             not os.path.isdir(args.html_files[0])))
+
+
+# The settings for a process i18nizing files for --jobs.
+_WORKER_ARGS = None
+
+
+def _start_worker(args, config, run_cache_args):
+    global _WORKER_ARGS
+    _WORKER_ARGS = (args, config)
+    if run_cache_args:
+        enable_run_cache(*run_cache_args)
+
+
+def _i18nize_file_in_worker(html_file):
+    """i18nize html_file; return (an error message or None, stats)."""
+    (args, config) = _WORKER_ARGS
+    try:
+        parser = get_parser_for_file(html_file, args.handlebars,
+                                     args.debug_parser, config,
+                                     args.dialects)
+        i18nize(html_file, parser)
+        error = None
+    except Exception as why:
+        error = str(why)
+    if _RUN_CACHE is not None and _RUN_CACHE.db is not None:
+        _RUN_CACHE.db.flush()
+    # These are for everything this process has done so far.
+    return (error, (os.getpid(), run_statistics(config)))
+
+
+def _file_size(html_file):
+    try:
+        return os.path.getsize(html_file)
+    except OSError:
+        return 0        # we'll say what's wrong when we i18nize it
+
+
+# How many files we look at at once, to decide which to start first.
+_SCHEDULING_BATCH_SIZE = 256
+
+
+def _i18nize_files_in_parallel(args, html_files, config, run_cache_args,
+                               manifest=None):
+    """Like _i18nize_files(), but using args.jobs processes.
+
+    We hand html_files to the processes as we get them, a batch at a
+    time, starting with the biggest files in each batch, so no
+    process is left working on a big file after the others are done.
+    But we print our progress in the order of html_files, so the
+    output doesn't depend on how long each file took.  Returns the
+    number of errors and the combined run_statistics() of the
+    processes.  If manifest is not None, we record() the files we
+    i18nize in it.
+    """
+    num_errors = 0
+    statistics = {}         # pid -> run_statistics() for that process
+    futures = collections.deque()     # (html_file, future), in order
+
+    def _report_finished(wait):
+        nonlocal num_errors
+        while futures and (wait or futures[0][1].done()):
+            (html_file, future) = futures.popleft()
+            print('i18nizing %s' % html_file, file=sys.stderr)
+            try:
+                (error, (pid, worker_statistics)) = future.result()
+                # The counts only go up, so the biggest are the latest.
+                if (_num_lookups(worker_statistics) >
+                        _num_lookups(statistics.get(pid, {}))):
+                    statistics[pid] = worker_statistics
+            except Exception as why:      # the process died, say
+                error = str(why)
+            if error is not None:
+                print('ERROR i18nizing %s: %s' % (html_file, error),
+                      file=sys.stderr)
+                num_errors += 1
+            elif manifest is not None:
+                manifest.record(html_file)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            args.jobs, initializer=_start_worker,
+            initargs=(args, config, run_cache_args)) as executor:
+        def _submit(batch):
+            submitted = dict(
+                (html_file, executor.submit(_i18nize_file_in_worker,
+                                            html_file))
+                for html_file in sorted(batch, key=_file_size, reverse=True))
+            futures.extend((html_file, submitted[html_file])
+                           for html_file in batch)
+
+        batch = []
+        for html_file in html_files:
+            batch.append(html_file)
+            if len(batch) == _SCHEDULING_BATCH_SIZE:
+                _submit(batch)
+                batch = []
+                _report_finished(wait=False)
+        _submit(batch)
+        _report_finished(wait=True)
+
+    if args.cache_db:
+        # The processes saved their runs, but didn't make room.
+        _RunCacheDb(args.cache_db, args.cache_db_mb * 1024 * 1024).close()
+    return (num_errors, _add_statistics(statistics.values()))
+
+
+def _num_lookups(statistics):
+    return sum(info.hits + info.misses for info in statistics.values())
+
+
+def _add_statistics(all_statistics):
+    """Add up the hits, misses, etc, in several run_statistics()."""
+    totals = {}
+    for statistics in all_statistics:
+        for (name, info) in statistics.items():
+            total = totals.get(name)
+            if total is not None:
+                info = info._replace(**dict(
+                    (field, getattr(total, field) + getattr(info, field))
+                    for field in info._fields if field != 'maxsize'))
+            totals[name] = info
+    return totals
+
+
 def main(argv=sys.argv):
     arg_parser = argparse.ArgumentParser(
         description=('Auto-add _("...") to jinja2 and handlebars html files'
-                     ' (modifying them in place).'))
-    arg_parser.add_argument('html_files', nargs='*', default=['-'],
-                            metavar='html_file',
-                            help=('The HTML files to add _() to.'
+                     ' (modifying them in place).'),
+        fromfile_prefix_chars='@')
+    arg_parser.add_argument('html_files', nargs='*', metavar='html_file',
+                            help=('The HTML files to add _() to, or'
+                                  ' directories to look for them in.'
                                   ' If none is specified reads from stdin'
-                                  ' and writes to stdout.'))
+                                  ' and writes to stdout.  @FILE reads'
+                                  ' arguments from FILE, one per line.'))
+    arg_parser.add_argument('--files-from', metavar='FILE',
+                            help=('Also i18nize the files named in FILE,'
+                                  ' separated by NULs, as from find'
+                                  ' -print0.  - means stdin.'))
+    arg_parser.add_argument('--include', action='append', default=[],
+                            metavar='GLOB',
+                            help=('In directories, i18nize files matching'
+                                  ' GLOB (default: those with a known'
+                                  ' extension; see --dialect).'))
+    arg_parser.add_argument('--exclude', action='append', default=[],
+                            metavar='GLOB',
+                            help=('In directories, skip files and'
+                                  ' directories matching GLOB.'))
+    arg_parser.add_argument('--dialect', action='append', default=[],
+                            metavar='EXT=DIALECT',
+                            help=('Treat files ending in EXT as DIALECT'
+                                  ' (one of %s).  Defaults: %s.'
+                                  % (', '.join(sorted(DIALECTS)),
+                                     ', '.join(
+                                         '%s=%s' % item for item in
+                                         sorted(DEFAULT_DIALECT_EXTENSIONS
+                                                .items())))))
     arg_parser.add_argument('--debug_parser', '-d', action='store_true',
                             help=('Use the null parser, which does not add'
                                   ' any _().  Output should match input.'))
     arg_parser.add_argument('--handlebars', action='store_true',
                             help=('Assume stdin is a handlebars file, not'
                                   ' jinja2 (ignored except for stdin).'))
+    arg_parser.add_argument('--config', metavar='FILE',
+                            help=('A TOML or JSON file of customizations:'
+                                  ' nltext tag attributes, ok functions,'
+                                  ' etc.  See load_config().'))
+    arg_parser.add_argument('--jobs', '-j', type=int,
+                            default=os.cpu_count() or 1, metavar='N',
+                            help=('i18nize this many files at once'
+                                  ' (default: the number of cpus,'
+                                  ' %(default)s).'))
+    arg_parser.add_argument('--stats', action='store_true',
+                            help=('When done, print how often we re-used'
+                                  ' our work on expressions and tags.'))
+    arg_parser.add_argument('--run-cache-mb', type=int, default=0,
+                            metavar='MB',
+                            help=('Remember the markup for up to this many'
+                                  ' megabytes of nltext runs, to re-use'
+                                  ' when the same run is in many files.'))
+    arg_parser.add_argument('--cache-db', metavar='PATH',
+                            help=('Also remember nltext runs in this sqlite'
+                                  ' file, to re-use next time we run.'))
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help=('Skip files that haven\'t changed since'
+                                  ' we last i18nized them, and copy'
+                                  ' files that are the same as another.'))
+    arg_parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                            metavar='PATH',
+                            help=('Where --incremental records the files'
+                                  ' it i18nized (default %(default)s).'))
+    arg_parser.add_argument('--cache-db-mb', type=int, default=256,
+                            metavar='MB',
+                            help=('The most megabytes of nltext runs to'
+                                  ' keep in --cache-db'
+                                  ' (default %(default)s).'))
     args = arg_parser.parse_args(argv[1:])
-
-    num_errors = 0
-    for html_file in args.html_files:
+    if not args.html_files and not args.files_from:
+        args.html_files = ['-']
+    args.dialects = dict(DEFAULT_DIALECT_EXTENSIONS)
+    for dialect_arg in args.dialect:
+        (extension, _, dialect) = dialect_arg.partition('=')
+        if not extension or dialect not in DIALECTS:
+            arg_parser.error('--dialect wants EXT=DIALECT, where DIALECT'
+                             ' is one of %s' % ', '.join(sorted(DIALECTS)))
+        args.dialects[extension] = dialect
+    if args.config:
         try:
-            print('i18nizing %s' % html_file, file=sys.stderr)
-            parser = get_parser_for_file(html_file, args.handlebars,
-                                         args.debug_parser)
-            i18nize(html_file, parser)
-        except Exception as why:
-            print('ERROR i18nizing %s: %s' % (html_file, why), file=sys.stderr)
-            num_errors += 1
-            if len(args.html_files) == 1:
-                # For just one file, let it raise the exception if it fails.
-                raise
+            args.config = load_config(args.config)
+        except (IOError, ValueError) as why:
+            arg_parser.error(str(why))
+
+    run_cache_args = None
+    if args.run_cache_mb > 0 or args.cache_db:
+        run_cache_args = ((args.run_cache_mb or 64) * 1024 * 1024,
+                          args.cache_db, args.cache_db_mb * 1024 * 1024)
+
+    html_files = _html_files(args)
+    manifest = None
+    if args.incremental and not args.debug_parser:
+        manifest = _Manifest(args.manifest, args.config or _CONFIG,
+                             args.dialects)
+        html_files = manifest.changed_files(html_files)
+    if (args.jobs > 1 and not _is_single_file(args) and
+            '-' not in args.html_files):
+        (num_errors, statistics) = _i18nize_files_in_parallel(
+            args, html_files, args.config or _CONFIG, run_cache_args,
+            manifest)
+    else:
+        if run_cache_args:
+            enable_run_cache(*run_cache_args)
+        try:
+            num_errors = _i18nize_files(args, html_files, manifest)
+        finally:
+            statistics = run_statistics(args.config)
+            if run_cache_args:
+                disable_run_cache()       # this also saves --cache-db
+    if manifest is not None:
+        num_errors += _i18nize_files(args, manifest.copy_duplicates(),
+                                     manifest)
+        manifest.save()
+
+    if args.stats:
+        for (name, info) in sorted(statistics.items()):
+            lookups = info.hits + info.misses
+            report = ('%s: %d hits, %d misses (%.0f%% hit rate)'
+                      % (name, info.hits, info.misses,
+                         100.0 * info.hits / lookups if lookups else 0))
+            if hasattr(info, 'bytes_saved'):
+                report += ', %d bytes saved' % info.bytes_saved
+            print(report, file=sys.stderr)
+        if manifest is not None:
+            print('unchanged files: %d hits, %d misses, %d duplicates'
+                  % (manifest.hits, manifest.misses, manifest.duplicates),
+                  file=sys.stderr)
 
     return num_errors
 
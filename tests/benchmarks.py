@@ -0,0 +1,679 @@
+#!/usr/bin/env python
+
+"""Benchmarks for i18nize_templates.py.
+
+These are not unittests; run them by hand when working on performance:
+   python tests/benchmarks.py [benchmark_name ...]
+With no arguments, all benchmarks are run.
+"""
+
+import array
+import bisect
+import json
+import _markupbase
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+# This makes it so we can find i18nize_templates when running from repo-root.
+sys.path.insert(1, '.')
+
+import i18nize_templates
+
+
+def _best_time(fn, number, repeat=5):
+    """Return the fastest time, in seconds, of a single call to fn()."""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def _null_callback(segment, segment_separates_nltext):
+    return None
+
+
+def _count_segments(lexer_class, text):
+    segments = []
+
+    def _save_segment(segment, segment_separates_nltext):
+        segments.append(segment)
+
+    lexer_class(_save_segment).parse(text)
+    return len(segments)
+
+
+def _new_jinja2_parser():
+    """Return a jinja2 parser like get_parser_for_file() does."""
+    tag_parser = i18nize_templates.Jinja2HtmlLexer(
+        i18nize_templates.Jinja2TextHandler(None).handle_segment)
+    return i18nize_templates.Jinja2HtmlLexer(
+        i18nize_templates.Jinja2TextHandler(tag_parser).handle_segment)
+
+
+def bench_entity_dispatch():
+    """Entities/sec for lexing template-entity-heavy documents."""
+    documents = (
+        ('jinja2', i18nize_templates.Jinja2HtmlLexer,
+         '<p>Hi {{ user.name }}, {# note #}{% if x %}{{ a }}{% endif %}'
+         '{{ b|escape }} and {{ c }}.</p>\n' * 2000),
+        ('django', i18nize_templates.DjangoHtmlLexer,
+         '<p>Hi {{ user.name }}, {# note #}{% if x %}{{ a }}{% endif %}'
+         '{% url "home" %}{{ b|escape }} and {{ c }}.</p>\n' * 2000),
+        ('handlebars', i18nize_templates.HandlebarsHtmlLexer,
+         '<p>Hi {{user.name}}, {{! note }}{{#if x}}{{a}}{{else}}{{{b}}}'
+         '{{/if}}{{> partial}} and {{c}}.</p>\n' * 2000),
+        )
+    for (name, lexer_class, text) in documents:
+        lexer = lexer_class(_null_callback)
+        num_segments = _count_segments(lexer_class, text)
+        seconds = _best_time(lambda: lexer.parse(text), number=3)
+        print('%-12s %8d segments  %10.0f segments/sec'
+              % (name, num_segments, num_segments / seconds))
+
+
+def bench_handlebars_attributes():
+    """Throughput of lexing attribute-heavy handlebars templates."""
+    text = ('<div class="row {{#if wide}}wide{{/if}}" id="r{{id}}">'
+            '<a href="{{url}}" title="Go {{#if x}}home{{else}}away{{/if}}"'
+            '{{#if external}} target="_blank"{{/if}} data-x=1 hidden>'
+            '<img src="a.png" alt="A {{#each cats}}{{name}} {{/each}}cat">'
+            '</a><input type="submit" value="Save"{{#if off}} disabled'
+            '{{/if}}><span class={{#if a}}"a"{{else}}"b"{{/if}}>t</span>'
+            '</div>\n' * 2000)
+    lexer = i18nize_templates.HandlebarsHtmlLexer(_null_callback)
+    seconds = _best_time(lambda: lexer.parse(text), number=3)
+    print('handlebars   %8d bytes     %10.0f bytes/sec'
+          % (len(text), len(text) / seconds))
+
+
+def bench_feed():
+    """Time-to-first-output and buffering for feed() vs parse()."""
+    text = ('<p>Hello <b>{{ name }}</b>, see <a href="{{ url }}" title="Go'
+            ' home">here</a>.</p>\n<div {% if x %}class="a"{% endif %}>'
+            '{% if y %}Some text{% endif %}</div>\n' * 20000)
+    chunk_size = 64 * 1024
+
+    start = timeit.default_timer()
+    _new_jinja2_parser().parse(text)
+    parse_seconds = timeit.default_timer() - start
+
+    parser = _new_jinja2_parser()
+    first_output_seconds = None
+    max_buffered = 0
+    start = timeit.default_timer()
+    for i in range(0, len(text), chunk_size):
+        output = parser.feed(text[i:i + chunk_size])
+        if output and first_output_seconds is None:
+            first_output_seconds = timeit.default_timer() - start
+        max_buffered = max(max_buffered, len(parser.rawdata))
+    parser.close()
+    feed_seconds = timeit.default_timer() - start
+
+    print('parse()      %8d bytes  %8.3fs to first output  %10.0f bytes/sec'
+          % (len(text), parse_seconds, len(text) / parse_seconds))
+    print('feed()       %8d bytes  %8.3fs to first output  %10.0f bytes/sec'
+          '  (at most %d bytes buffered)'
+          % (len(text), first_output_seconds, len(text) / feed_seconds,
+             max_buffered))
+
+
+def bench_sink():
+    """Peak memory for i18nizing with and without an output sink."""
+    text = ('<p>Hello <b>{{ name }}</b>, see <a href="{{ url }}" title="Go'
+            ' home">here</a>.</p>\n' * 20000)
+
+    with open(os.devnull, 'w') as devnull:
+        for (name, sink) in (('parse()', None), ('parse(sink)', devnull)):
+            parser = _new_jinja2_parser()
+            tracemalloc.start()
+            parser.parse(text, sink)
+            (_, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('%-12s %8d bytes  %10d bytes peak memory'
+                  % (name, len(text), peak))
+
+
+def bench_iter_segments():
+    """Segments/sec for parse() with a recording callback vs iter_segments."""
+    text = ('<p>Hello <b>{{ name }}</b>, see <a href="{{ url }}" title="Go'
+            ' home">here</a>.</p>\n<div {% if x %}class="a"{% endif %}>'
+            '{% if y %}Some text{% endif %}</div>\n' * 5000)
+    segments = []
+
+    def _save_segment(segment, segment_separates_nltext):
+        segments.append((segment, segment_separates_nltext))
+
+    lexer = i18nize_templates.Jinja2HtmlLexer(_save_segment)
+    num_segments = _count_segments(i18nize_templates.Jinja2HtmlLexer, text)
+
+    def _parse():
+        del segments[:]
+        lexer.parse(text)
+
+    for (name, fn) in (('parse()', _parse),
+                       ('iter_segments', lambda: list(
+                           lexer.iter_segments(text)))):
+        seconds = _best_time(fn, number=3)
+        print('%-14s %8d segments  %10.0f segments/sec'
+              % (name, num_segments, num_segments / seconds))
+
+
+def bench_segment_table():
+    """Re-running text handlers from a SegmentTable vs re-lexing."""
+    text = ('<p>Hello <b>{{ name }}</b>, see <a href="{{ url }}" title="Go'
+            ' home">here</a>.</p>\n<div {% if x %}class="a"{% endif %}>'
+            '{% if y %}Some text{% endif %}</div>\n' * 5000)
+    table = i18nize_templates.Jinja2HtmlLexer(None).segment_table(text)
+    segments = []
+
+    def _save_segment(segment, segment_separates_nltext):
+        segments.append(segment)
+
+    i18nize_templates.Jinja2HtmlLexer(_save_segment).parse(text)
+    print('table        %8d segments  %10d bytes (vs %d bytes of segments)'
+          % (len(table), len(table.tobytes()),
+             sum(sys.getsizeof(s) for s in segments if s is not None)))
+
+    parser = _new_jinja2_parser()
+    for (name, fn) in (('parse()', lambda: parser.parse(text)),
+                       ('replay()', lambda: parser.replay(table, text))):
+        seconds = _best_time(fn, number=3)
+        print('%-12s %8d bytes     %10.0f bytes/sec'
+              % (name, len(text), len(text) / seconds))
+
+
+def bench_position_tracking():
+    """Lexing cost of keeping line numbers up to date, by line length."""
+    line = ('<p>Hello <b>{{ name }}</b>, see <a href="{{ url }}" title="Go'
+            ' home">here</a>.</p><div {% if x %}class="a"{% endif %}>'
+            '{% if y %}Some text{% endif %}</div>')
+    documents = (('minified', line * 5000),
+                 ('many-line', (line + '\n') * 5000),
+                 ('short-line', line.replace('><', '>\n<') * 5000))
+
+    class _CountingLexer(i18nize_templates.Jinja2HtmlLexer):
+        """Keeps lineno/offset current the way ParserBase used to."""
+        updatepos = _markupbase.ParserBase.updatepos
+
+    for (name, text) in documents:
+        for (lexer_name, lexer_class) in (
+                ('count', _CountingLexer),
+                ('lazy', i18nize_templates.Jinja2HtmlLexer)):
+            lexer = lexer_class(_null_callback)
+            seconds = _best_time(lambda: lexer.parse(text), number=3)
+            print('%-10s %-5s %8d bytes  %10.0f bytes/sec'
+                  % (name, lexer_name, len(text), len(text) / seconds))
+
+
+def bench_parsed_start_tags():
+    """i18nizing attribute-heavy templates, re-parsing tags or not."""
+    text = ('<div class="row" id="r{{ id }}"><a href="{{ url }}" title="Go'
+            ' home" target="_blank" data-x=1 hidden>Home</a><img src="a.png"'
+            ' alt="A cat" width=10 height=10><input type="submit"'
+            ' value="Save" {% if off %}disabled{% endif %}><span'
+            ' class="a b" title="Tip">t</span></div>\n' * 2000)
+
+    def _new_parser(reparse_tags):
+        tag_parser = i18nize_templates.Jinja2HtmlLexer(
+            i18nize_templates.Jinja2TextHandler(None).handle_segment)
+        handle_segment = i18nize_templates.Jinja2TextHandler(
+            tag_parser).handle_segment
+        if reparse_tags:
+            # str() turns StartTags back into plain strings, so the
+            # handler has to parse them again, as it used to.
+            return i18nize_templates.Jinja2HtmlLexer(
+                lambda segment, segment_separates_nltext: handle_segment(
+                    segment if segment is None else str(segment),
+                    segment_separates_nltext))
+        return i18nize_templates.Jinja2HtmlLexer(handle_segment)
+
+    for (name, reparse_tags) in (('reparse', True), ('parsed', False)):
+        parser = _new_parser(reparse_tags)
+        seconds = _best_time(lambda: parser.parse(text), number=3)
+        print('%-12s %8d bytes     %10.0f bytes/sec'
+              % (name, len(text), len(text) / seconds))
+
+
+def bench_attribute_values():
+    """i18nizing nl-text attribute values, with and without lexing them."""
+    text = ('<img src="a.png" alt="A cat" title="A cat, sitting">'
+            '<input type="text" placeholder="Your name" value="Save">'
+            '<a href="/" title="Go home">x</a>'
+            '<abbr title="Hello {{ name }}">y</abbr>\n' * 2000)
+
+    class _LexingTextHandler(i18nize_templates.Jinja2TextHandler):
+        """Always lexes attribute values, as we used to."""
+        def _i18nize_attribute_value(self, value):
+            return self.tag_parser.parse(value)
+
+    for (name, handler_class) in (
+            ('lexed', _LexingTextHandler),
+            ('fast path', i18nize_templates.Jinja2TextHandler)):
+        tag_parser = i18nize_templates.Jinja2HtmlLexer(
+            handler_class(None).handle_segment)
+        parser = i18nize_templates.Jinja2HtmlLexer(
+            handler_class(tag_parser).handle_segment)
+        seconds = _best_time(lambda: parser.parse(text), number=3)
+        print('%-12s %8d bytes     %10.0f bytes/sec'
+              % (name, len(text), len(text) / seconds))
+
+
+def bench_expressions():
+    """Time to add _TODO() to {{ expressions }} of increasing size."""
+    handler = i18nize_templates.Jinja2TextHandler(None)
+    for num_args in (10, 100, 1000, 10000):
+        var = '{{ fn(%s) }}' % ', '.join(
+            ['g("a", h(k="b"))'] * num_args)
+        seconds = _best_time(lambda: handler.add_underscore([var]), number=3)
+        print('%6d args  %8d bytes  %10.0f bytes/sec'
+              % (num_args, len(var), len(var) / seconds))
+
+
+def bench_expression_memo():
+    """Runs with repeated {{ vars }}, with and without the memo."""
+    runs = [['Hi ', '{{ user.name }}', ', see ', '{{ url("home") }}',
+             ' or ', '{{ fn("a", b|escape, c="d") }}', ' %d.' % i]
+            for i in range(2000)]
+    for (name, cache_size) in (('no memo', 0), ('memo', 10000)):
+        config = i18nize_templates.I18nizeConfig(cache_size=cache_size)
+        handler = i18nize_templates.Jinja2TextHandler(None, config)
+
+        def _add_underscores():
+            for run in runs:
+                handler.add_underscore(run)
+
+        seconds = _best_time(_add_underscores, number=3)
+        info = config.rewrite_expression.cache_info()
+        print('%-12s %8d runs      %10.0f runs/sec  (%d hits, %d misses)'
+              % (name, len(runs), len(runs) / seconds, info.hits,
+                 info.misses))
+
+
+def _entity_regexps():
+    """Return the regexps NaturalLanguageClassifier replaced."""
+    def _hex(codepoint):
+        return ''.join('[%s%s]' % (c, c.upper()) if c.isalpha() else c
+                       for c in '%x' % codepoint)
+
+    entities = '|'.join(
+        [name for (name, codepoint)
+         in i18nize_templates._ENTITY_CODEPOINTS.items()
+         if codepoint in i18nize_templates._NON_ALNUM_CODEPOINTS] +
+        ['#%d|#[xX]%s' % (codepoint, _hex(codepoint))
+         for codepoint in i18nize_templates._NON_ALNUM_CODEPOINTS])
+    return (re.compile(r'^([^\w&]|&(%s)\b)*$' % entities),
+            re.compile(r'^([^\w&]|&(%s)\b)+' % entities),
+            re.compile(r'(\s|[@#$^*|]|&(%s)\b)+$' % entities))
+
+
+def bench_natural_language_classifier():
+    """Segments/sec classified by the old regexps and the classifier."""
+    segments = (['Hello there', ' ', '\n  ', '.', ' &nbsp; ', '&times;',
+                 'Caf&eacute; ', ' Price: 10&#36; ', ' &mdash; ', ' | ']
+                * 1000 + ['Segment %d.  ' % i for i in range(2000)])
+    start = time.time()
+    (no_nl, prefix, suffix) = _entity_regexps()
+    print('%-22s %10.3f sec to compile' % ('regexps', time.time() - start))
+
+    def _regexps():
+        for segment in segments:
+            if not no_nl.match(segment):
+                prefix.match(segment)
+                suffix.search(segment)
+
+    def _classifier(classifier):
+        def _classify():
+            for segment in segments:
+                if not classifier.no_natural_language(segment):
+                    classifier.prefix_end(segment)
+                    classifier.suffix_start(segment)
+        return _classify
+
+    uncached = i18nize_templates.NaturalLanguageClassifier()
+    uncached.prefix_end = uncached._prefix_end
+    uncached.suffix_start = uncached._suffix_start
+    for (name, fn) in (
+            ('regexps', _regexps),
+            ('classifier, no cache', _classifier(uncached)),
+            ('classifier', _classifier(
+                i18nize_templates.NaturalLanguageClassifier()))):
+        seconds = _best_time(fn, number=3)
+        print('%-22s %8d segments  %10.0f segments/sec'
+              % (name, len(segments), len(segments) / seconds))
+
+
+def bench_add_i18n():
+    """Segments/sec through add_i18n() for short and long inline runs."""
+    handler = i18nize_templates.NullTextHandler(
+        i18nize_templates.HtmlLexer(
+            i18nize_templates.NullTextHandler(None).handle_segment))
+    runs = (
+        ('short', ['Hello ', '<b>', 'there', '</b>', '.']),
+        ('long, language inside',
+         [' ', '<i>', ' ', '</i>'] * 500 + ['word'] +
+         [' ', '<i>', ' ', '</i>'] * 500),
+        ('long, language at ends',
+         ['Hi'] + [' ', '<b>', 'x', '</b>'] * 1000 + ['there']),
+    )
+    for (name, run) in runs:
+        seconds = _best_time(lambda: handler.add_i18n(list(run)),
+                             number=max(1, 20000 // len(run)))
+        print('%-24s %6d segments  %10.0f segments/sec'
+              % (name, len(run), len(run) / seconds))
+
+
+
+def bench_nl_index():
+    """Classifying text segments, vs. a whole-document nl-text index.
+
+    add_i18n() asks NL_CLASSIFIER about each text segment, which
+    memoizes its answers.  The alternative is a pre-pass over the
+    whole document that finds where each bit of natural language
+    starts, and then answers "does this segment have language in
+    it?" by subtracting two prefix counts.  This compares building
+    and using such an index with the classifier calls it'd replace,
+    and with parsing the same document.
+    """
+    rawdata = ('<p>' + 'Some <b>word</b> {{ x }}, &amp; <i>more</i> text. '
+               * 400 + '</p>\n') * 20
+    table = i18nize_templates.Jinja2HtmlLexer(_null_callback).segment_table(
+        rawdata)
+    text_kind = table.KINDS.index(i18nize_templates.Segment.TEXT)
+    spans = [(start, end) for (start, end, kind)
+             in zip(table.starts, table.ends, table.kinds)
+             if kind == text_kind]
+    texts = [rawdata[start:end] for (start, end) in spans]
+    classifier = i18nize_templates.NullTextHandler.NL_CLASSIFIER
+    nl_start = re.compile(r'&(#?\w*)|\w+')
+
+    def _classify():
+        for text in texts:
+            classifier.no_natural_language(text)
+            classifier.prefix_end(text)
+            classifier.suffix_start(text)
+
+    def _build_index():
+        starts = array.array('I', (
+            m.start() for m in nl_start.finditer(rawdata)
+            if m.group(1) is None or
+            not classifier.is_non_alnum_entity(m.group(1))))
+        return array.array('I', (bisect.bisect_left(starts, pos)
+                                 for span in spans for pos in span))
+
+    counts = _build_index()
+
+    def _use_index():
+        for i in range(0, len(counts), 2):
+            counts[i + 1] - counts[i]
+
+    parser = i18nize_templates.get_parser_for_file('x.jinja2')
+    for (name, fn) in (('parse', lambda: parser.parse(rawdata)),
+                       ('classifier calls', _classify),
+                       ('build index', _build_index),
+                       ('index lookups', _use_index)):
+        print('%-18s %6d text segments  %8.1f ms'
+              % (name, len(texts), 1000 * _best_time(fn, number=1)))
+
+def bench_tag_pairing():
+    """Segments/sec through add_i18n() for runs of 10k inline tags."""
+    handler = i18nize_templates.NullTextHandler(
+        i18nize_templates.HtmlLexer(
+            i18nize_templates.NullTextHandler(None).handle_segment))
+    runs = (
+        ('links', ['<span>', ' '] +
+         ['<a href="/x">', 'Link', '</a>', ' | '] * 5000 + ['</span>']),
+        ('nested', ['<span>'] * 5000 + ['Hi'] + ['</span>'] * 5000),
+        ('br and img', ['Hi', '<br>', '<img src="a.png">'] * 5000),
+    )
+    for (name, run) in runs:
+        seconds = _best_time(lambda: handler.add_i18n(list(run)), number=3)
+        print('%-12s %6d segments  %10.0f segments/sec'
+              % (name, len(run), len(run) / seconds))
+
+
+def bench_tag_cache():
+    """Bytes/sec for documents of repeated tags, with and without memos."""
+    document = ('<p>Hi<br><span class="muted">there</span>, '
+                '<img src="a.png" alt="A cat"> '
+                '<input type="submit" value="Save"> '
+                '<a href="/home" title="Go home">home</a>.</p>\n') * 2000
+    for (name, cache_size) in (('no memo', 0), ('memo', 10000)):
+        config = i18nize_templates.I18nizeConfig(cache_size=cache_size)
+        parser = i18nize_templates.get_parser_for_file('x.jinja2',
+                                                       config=config)
+        if name == 'no memo':
+            parser.callback.__self__._cache_key = None
+        seconds = _best_time(lambda: parser.parse(document), number=3)
+        info = config.tag_rewrites.info()
+        print('%-8s %8d bytes  %10.0f bytes/sec  (%d hits, %d misses)'
+              % (name, len(document), len(document) / seconds,
+                 info.hits, info.misses))
+
+
+def bench_nl_attributes():
+    """Tags/sec through a text handler's handle_tag(), without the memo."""
+    tags = (['<div class="row-%d" id="item-%d">' % (i, i)
+             for i in range(3000)] +
+            ['<span data-id="%d">' % i for i in range(3000)] +
+            ['<img src="%d.png" alt="Picture %d">' % (i, i)
+             for i in range(1000)] +
+            ['<input type="submit" name="f%d" value="Save">' % i
+             for i in range(1000)])
+    handler = _new_jinja2_parser().callback.__self__
+    handler._cache_key = None
+
+    def _handle_tags():
+        for tag in tags:
+            handler.handle_tag(tag)
+
+    seconds = _best_time(_handle_tags, number=3)
+    print('%8d tags  %10.0f tags/sec' % (len(tags), len(tags) / seconds))
+
+
+def bench_run_cache():
+    """Files/sec for files sharing site chrome, with and without the memo."""
+    chrome = ('<div class="nav"><a href="/">Home</a> | '
+              '<a href="/about" title="About us">About <b>us</b></a> | '
+              '<a href="/help">Get <i>help</i></a></div>\n'
+              '<footer><p>Copyright &copy; Example, Inc.  '
+              '<a href="/terms">Terms of <em>service</em></a>.</p>'
+              '<p>Learn <a href="/more">more</a> about us.</p></footer>\n')
+    files = ['<h1>Page %d</h1>\n%s<p>This is page %d.</p>\n%s'
+             % (i, chrome, i, chrome) for i in range(500)]
+
+    def _i18nize_files():
+        for contents in files:
+            _new_jinja2_parser().parse(contents)
+
+    for name in ('no memo', 'memo'):
+        i18nize_templates._init()
+        if name == 'memo':
+            i18nize_templates.enable_run_cache()
+        try:
+            seconds = _best_time(_i18nize_files, number=1)
+            info = i18nize_templates.run_statistics().get('nltext runs')
+        finally:
+            i18nize_templates.disable_run_cache()
+        print('%-8s %6d files  %10.0f files/sec%s'
+              % (name, len(files), len(files) / seconds,
+                 '  (%d hits, %d misses, %d bytes saved)'
+                 % (info.hits, info.misses, info.bytes_saved)
+                 if info else ''))
+
+
+def bench_cache_db():
+    """Files/sec for a re-run over unchanged files, with the sqlite cache."""
+    files = ['<h1>Page %d</h1>\n<p>This is <b>page</b> number %d of the '
+             '<a href="{{ url_for("manual", page=%d) }}" title="Manual">'
+             'manual</a>, {{ user.name|e }}.</p>\n'
+             '<p>Read it &amp; weep, {{ greet(user, "reader %d") }}.</p>\n'
+             % (i, i, i, i) for i in range(500)]
+    tmpdir = tempfile.mkdtemp()
+    cache_db = os.path.join(tmpdir, 'cache.db')
+
+    def _i18nize_files(use_cache_db):
+        # Each call is a fresh invocation: nothing survives in memory.
+        i18nize_templates._init()
+        if use_cache_db:
+            i18nize_templates.enable_run_cache(cache_db=cache_db)
+        try:
+            for contents in files:
+                _new_jinja2_parser().parse(contents)
+            return i18nize_templates.run_statistics().get('cache db')
+        finally:
+            i18nize_templates.disable_run_cache()
+
+    try:
+        for name in ('no cache', 'cold db', 'warm db'):
+            start = time.perf_counter()
+            info = _i18nize_files(name != 'no cache')
+            seconds = time.perf_counter() - start
+            print('%-8s %6d files  %10.0f files/sec%s'
+                  % (name, len(files), len(files) / seconds,
+                     '  (%d hits, %d misses)' % (info.hits, info.misses)
+                     if info else ''))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_ok_functions():
+    """Expressions/sec as the function whitelist grows, without memos."""
+    expressions = ['fn%d(helpers.fmt%d("a"), pkg%d.helper_%d("b"), '
+                   'x|attr("c"))' % (i, i, i, i) for i in range(2000)]
+    for size in (40, 200, 1000):
+        config = i18nize_templates.I18nizeConfig(
+            ok_functions=(i18nize_templates.I18nizeConfig().ok_functions +
+                          tuple('helper_%d' % i for i in range(size // 2)) +
+                          tuple('pkg%d.helper_%d' % (i, i)
+                                for i in range(size // 2))),
+            cache_size=0)
+
+        def _rewrite_expressions():
+            for expression in expressions:
+                config.rewrite_expression(expression)
+
+        seconds = _best_time(_rewrite_expressions, number=1)
+        print('%5d names %8d expressions  %10.0f expressions/sec'
+              % (len(config.ok_functions), len(expressions),
+                 len(expressions) / seconds))
+
+
+def bench_load_config():
+    """Milliseconds to load a big config file, first time and again."""
+    settings = {
+        'ok_functions': (['helper_%d' % i for i in range(300)] +
+                         ['pkg.helper_%d' % i for i in range(300)] +
+                         ['gen_%d_.*' % i for i in range(50)]),
+        'ok_function_arguments': ['arg%d.*' % i for i in range(100)],
+    }
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'i18nize.json')
+    try:
+        with open(path, 'w') as f:
+            json.dump(settings, f)
+        for name in ('first', 'again'):
+            if name == 'first':
+                re.purge()
+            start = time.perf_counter()
+            i18nize_templates.load_config(path)
+            print('%-6s %8.2f ms' % (name,
+                                     (time.perf_counter() - start) * 1000))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_jobs():
+    """Files/sec through main(), one at a time and with --jobs."""
+    tmpdir = tempfile.mkdtemp()
+    html_files = []
+    for i in range(400):
+        html_file = os.path.join(tmpdir, '%d.jinja2' % i)
+        html_files.append(html_file)
+    jobs = os.cpu_count() or 1
+    old_stderr = sys.stderr
+    try:
+        for num_jobs in sorted(set((1, jobs))):
+            for (i, html_file) in enumerate(html_files):
+                with open(html_file, 'w') as f:
+                    f.write('<p>Page %d: <a href="/x" title="X">x</a>.</p>\n'
+                            % i * (i % 20 * 10 + 1))
+            sys.stderr = open(os.devnull, 'w')
+            start = time.perf_counter()
+            i18nize_templates.main(['i18nize_templates', '--jobs',
+                                    str(num_jobs)] + html_files)
+            seconds = time.perf_counter() - start
+            sys.stderr.close()
+            sys.stderr = old_stderr
+            print('%3d jobs  %6d files  %10.0f files/sec'
+                  % (num_jobs, len(html_files), len(html_files) / seconds))
+    finally:
+        sys.stderr = old_stderr
+        shutil.rmtree(tmpdir)
+
+
+def bench_walk():
+    """Files/sec found walking a tree, with and without globs."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for i in range(50):
+            dirname = os.path.join(tmpdir, 'app%d' % i, 'templates')
+            os.makedirs(dirname)
+            for j in range(200):
+                for ext in ('.html', '.js', '.handlebars'):
+                    open(os.path.join(dirname, '%d%s' % (j, ext)), 'w').close()
+        for (includes, excludes) in (((), ()),
+                                     (('*.handlebars',), ()),
+                                     ((), ('app1*',)),
+                                     (('app*/templates/1*.html',), ())):
+            start = time.perf_counter()
+            num_files = sum(1 for _ in i18nize_templates.walk_html_files(
+                tmpdir, includes, excludes))
+            seconds = time.perf_counter() - start
+            print('%-32s %-10s %6d files  %10.0f files/sec'
+                  % (' '.join(includes) or '(default)',
+                     ' '.join(excludes), num_files, num_files / seconds))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_incremental():
+    """Files/sec through main(), first and again with --incremental."""
+    tmpdir = tempfile.mkdtemp()
+    old_stderr = sys.stderr
+    try:
+        for i in range(400):
+            with open(os.path.join(tmpdir, '%d.jinja2' % i), 'w') as f:
+                # Every 10th file is the same as another.
+                f.write('<p>Page %d: <a href="/x" title="X">x</a>.</p>\n'
+                        % (i % 360) * (i % 20 * 10 + 1))
+        manifest = os.path.join(tmpdir, '.i18nize-cache')
+        for label in ('first run', 'unchanged', 'unchanged, -j1'):
+            sys.stderr = open(os.devnull, 'w')
+            start = time.perf_counter()
+            i18nize_templates.main(
+                ['i18nize_templates', '--incremental', '--manifest',
+                 manifest] + (['--jobs', '1'] if '-j1' in label else []) +
+                [tmpdir])
+            seconds = time.perf_counter() - start
+            sys.stderr.close()
+            sys.stderr = old_stderr
+            print('%-16s %10.0f files/sec' % (label, 400 / seconds))
+    finally:
+        sys.stderr = old_stderr
+        shutil.rmtree(tmpdir)
+
+
+def main(argv):
+    benchmarks = dict((name[len('bench_'):], fn)
+                      for (name, fn) in globals().items()
+                      if name.startswith('bench_'))
+    for name in (argv[1:] or sorted(benchmarks)):
+        print('--- %s: %s' % (name, benchmarks[name].__doc__))
+        benchmarks[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
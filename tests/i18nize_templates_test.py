@@ -2,7 +2,16 @@
 
 """Unitest for i18nize_templates.py."""
 
+import io
+import os
+import pickle
+import random
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 # This makes it so we can find i18nize_templates when running from repo-root.
@@ -39,6 +48,28 @@ class TestBase(unittest.TestCase):
             self.old_NLSCR)
 
 
+class TempDirTestBase(TestBase):
+    """For tests that need files: self.tmpdir is a fresh directory."""
+    def setUp(self):
+        super(TempDirTestBase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TempDirTestBase, self).tearDown()
+
+    def run_main(self, *args):
+        """Return main()'s return value, and what it wrote to stderr."""
+        old_stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            retval = i18nize_templates.main(['i18nize_templates'] +
+                                            list(args))
+            return (retval, sys.stderr.getvalue())
+        finally:
+            sys.stderr = old_stderr
+
+
 class SegmenterTest(TestBase):
     """Test how we segment html."""
     def check(self, input, expected):
@@ -97,6 +128,1112 @@ class SegmenterTest(TestBase):
                     (None, True)])
 
 
+class TemplateSegmenterTest(TestBase):
+    """Test how we segment template (non-html) entities."""
+    def check(self, lexer_class, input, expected):
+        def _save_segments(segment, segment_separates_nltext):
+            segments.append((segment, segment_separates_nltext))
+
+        segments = []
+        lexer_class(_save_segments).parse(input)
+        self.assertEqual(expected, segments)
+
+    def test_jinja2_entities(self):
+        self.check(i18nize_templates.Jinja2HtmlLexer,
+                   'a{# c #}{% if x %}{{ _("b") }}<b>',
+                   [('a', False),
+                    ('{# c #}', True),
+                    ('{% if x %}', True),
+                    ('{{ _("b") }}', True),
+                    ('<b>', False),
+                    (None, True)])
+
+    def test_django_entities_earlier_starttag_wins(self):
+        self.check(i18nize_templates.DjangoHtmlLexer,
+                   '{% if x %}a{% endif %}{% comment %}b{% endcomment %}'
+                   '{% url "c" %}',
+                   [('{% if x %}a{% endif %}', True),
+                    ('{% comment %}b{% endcomment %}', True),
+                    ('{% url "c" %}', True),
+                    (None, True)])
+
+    def test_handlebars_entities_earlier_starttag_wins(self):
+        self.check(i18nize_templates.HandlebarsHtmlLexer,
+                   '{{#_}}a{{/_}}{{! c }}{{#if d}}',
+                   [('{{#_}}a{{/_}}', True),
+                    ('{{! c }}', True),
+                    ('{{#if d}}', True),
+                    (None, True)])
+
+    def test_unterminated_entity(self):
+        with self.assertRaises(i18nize_templates.HTMLParseError):
+            self.check(i18nize_templates.Jinja2HtmlLexer, 'a {{ b', [])
+
+
+class IterSegmentsTest(TestBase):
+    """Test iter_segments(), and that it agrees with the callbacks."""
+    def check(self, lexer_class, input, expected):
+        def _save_segments(segment, segment_separates_nltext):
+            callback_segments.append((segment, segment_separates_nltext))
+
+        callback_segments = []
+        lexer_class(_save_segments).parse(input)
+
+        segments = list(lexer_class(None).iter_segments(input))
+        self.assertEqual(expected, segments)
+        self.assertEqual(callback_segments[:-1],     # no (None, True)
+                         [(s.text(input), s.separates_nltext)
+                          for s in segments])
+
+    def test_kinds(self):
+        Segment = i18nize_templates.Segment
+        self.check(i18nize_templates.HtmlLexer,
+                   '<!DOCTYPE html>a<b>c</b><!-- d --><?e?><style>f</style>',
+                   [Segment(Segment.DECL, 0, 15, True, None),
+                    Segment(Segment.TEXT, 15, 16, False, None),
+                    Segment(Segment.STARTTAG, 16, 19, False, 'b'),
+                    Segment(Segment.TEXT, 19, 20, False, None),
+                    Segment(Segment.ENDTAG, 20, 24, False, 'b'),
+                    Segment(Segment.COMMENT, 24, 34, True, None),
+                    Segment(Segment.PI, 34, 39, True, None),
+                    Segment(Segment.STARTTAG, 39, 46, True, 'style'),
+                    Segment(Segment.TEXT, 46, 47, True, None),
+                    Segment(Segment.ENDTAG, 47, 55, True, 'style'),
+                    ])
+
+    def test_template_entities(self):
+        Segment = i18nize_templates.Segment
+        self.check(i18nize_templates.Jinja2HtmlLexer,
+                   'a < b{{ c }}<p class="{{ d }}">e',
+                   [Segment(Segment.TEXT, 0, 2, False, None),
+                    Segment(Segment.TEXT, 2, 3, False, None),
+                    Segment(Segment.TEXT, 3, 5, False, None),
+                    Segment(Segment.TEMPLATE, 5, 12, True, None),
+                    Segment(Segment.STARTTAG, 12, 31, True, 'p'),
+                    Segment(Segment.TEXT, 31, 32, False, None),
+                    ])
+
+    def test_is_lazy(self):
+        lexer = i18nize_templates.Jinja2HtmlLexer(None)
+        segments = lexer.iter_segments('a<b>{{ c')
+        self.assertEqual((0, 1), next(segments)[1:3])
+        self.assertEqual((1, 4), next(segments)[1:3])
+        with self.assertRaises(i18nize_templates.HTMLParseError):
+            next(segments)
+
+
+class SegmentTableTest(TestBase):
+    """Test SegmentTable, and re-using one via HtmlLexer.replay()."""
+    def new_parser(self, lexer_class, handler_class):
+        tag_parser = lexer_class(handler_class(None).handle_segment)
+        return lexer_class(handler_class(tag_parser).handle_segment)
+
+    def check(self, lexer_class, handler_class, input):
+        table = self.new_parser(lexer_class, handler_class).segment_table(
+            input)
+        self.assertEqual([s._replace(tagname=None)
+                          for s in lexer_class(None).iter_segments(input)],
+                         list(table))
+        self.assertEqual(self.new_parser(lexer_class, handler_class).parse(
+                             input),
+                         self.new_parser(lexer_class, handler_class).replay(
+                             table, input))
+
+    def test_html(self):
+        self.check(i18nize_templates.HtmlLexer,
+                   i18nize_templates.NullTextHandler,
+                   '<!DOCTYPE html><p>Hello <b>world</b></p><!-- c -->'
+                   '<img alt="A cat"><script>a < b</script>')
+
+    def test_jinja2(self):
+        self.check(i18nize_templates.Jinja2HtmlLexer,
+                   i18nize_templates.Jinja2TextHandler,
+                   '<p>Hello {{ name }}, <a href="x" title="Go home">'
+                   'here</a>.</p>{% if x %}Hi{% endif %}')
+
+    def test_handlebars(self):
+        self.check(i18nize_templates.HandlebarsHtmlLexer,
+                   i18nize_templates.HandlebarsTextHandler,
+                   '<p>Hello {{name}}, {{#if x}}hi{{/if}}</p>')
+
+    def test_serialization(self):
+        input = '<p>Hello <b>world</b></p>{{ x }}'
+        table = i18nize_templates.Jinja2HtmlLexer(None).segment_table(input)
+        self.assertEqual(7, len(table))
+        data = table.tobytes()
+        self.assertEqual(table,
+                         i18nize_templates.SegmentTable.frombytes(data))
+        self.assertEqual(table, pickle.loads(pickle.dumps(table)))
+        with self.assertRaises(ValueError):
+            i18nize_templates.SegmentTable.frombytes(data[:-1])
+
+    def test_replay_to_sink(self):
+        input = '<p>Hello <b>world</b></p>'
+        parser = self.new_parser(i18nize_templates.Jinja2HtmlLexer,
+                                 i18nize_templates.Jinja2TextHandler)
+        table = parser.segment_table(input)
+        sink = io.StringIO()
+        self.assertEqual(None, parser.replay(table, input, sink))
+        self.assertEqual('<p>{{ _("Hello <b>world</b>") }}</p>',
+                         sink.getvalue())
+
+
+class StartTagTest(TestBase):
+    """Test passing parsed start tags from the lexer to text handlers."""
+    def test_start_tags_are_parsed(self):
+        segments = []
+        i18nize_templates.Jinja2HtmlLexer(
+            lambda segment, segment_separates_nltext: segments.append(
+                segment)).parse('<p>a<img alt="A cat" {{ x }}></p>')
+        self.assertEqual(['<p>', 'a', '<img alt="A cat" {{ x }}>', '</p>',
+                          None],
+                         segments)
+        self.assertEqual(('p', [], []),
+                         (segments[0].tagname, segments[0].attrs,
+                          segments[0].value_poses))
+        self.assertEqual(('img', [('alt', 'A cat'), ('{{ x }}', None)],
+                          [(10, 15), (None, None)]),
+                         (segments[2].tagname, segments[2].attrs,
+                          segments[2].value_poses))
+        self.assertFalse(isinstance(segments[1],
+                                    i18nize_templates.StartTag))
+        self.assertFalse(isinstance(segments[3],
+                                    i18nize_templates.StartTag))
+
+    def test_handler_does_not_reparse(self):
+        class _NoParseLexer(i18nize_templates.Jinja2HtmlLexer):
+            def parse_starttag(self, rawdata, i):
+                raise AssertionError('should not parse tags')
+
+        handler = i18nize_templates.Jinja2TextHandler(
+            _NoParseLexer(
+                i18nize_templates.Jinja2TextHandler(None).handle_segment))
+        self.assertEqual('<p title="{{ _("Hi") }}">{{ _("a") }}</p>',
+                         i18nize_templates.Jinja2HtmlLexer(
+                             handler.handle_segment).parse(
+                                 '<p title="Hi">a</p>'))
+
+    def test_plain_string_tags_still_work(self):
+        handler = i18nize_templates.Jinja2TextHandler(
+            i18nize_templates.Jinja2HtmlLexer(
+                i18nize_templates.Jinja2TextHandler(None).handle_segment))
+        self.assertEqual('<img alt="{{ _("A cat") }}">',
+                         handler.handle_segment('<img alt="A cat">', True))
+
+    def test_attribute_values_match_tag_parser(self):
+        tag_parser = i18nize_templates.Jinja2HtmlLexer(
+            i18nize_templates.Jinja2TextHandler(None).handle_segment)
+        handler = i18nize_templates.Jinja2TextHandler(tag_parser)
+        for value in ('', ' ', 'Go home', '  Go home!  ', '"Hi"', '(1%)',
+                      'a &amp; b', 'Hi {{ name }}', 'a <b>b</b>',
+                      '{% if x %}a{% endif %}'):
+            self.assertEqual(tag_parser.parse(value),
+                             handler._i18nize_attribute_value(value), value)
+
+
+class NaturalLanguageAttributesTest(TestBase):
+    def nl_attrs(self, tagname, attrs):
+        return list(i18nize_templates.natural_language_attributes(
+            tagname, attrs))
+
+    def test_rules(self):
+        self.assertEqual([2, 0], self.nl_attrs(
+            'img', [('alt', 'a'), ('src', 'b'), ('title', 'c')]))
+        self.assertEqual([], self.nl_attrs('div', [('alt', 'a')]))
+        self.assertEqual([], self.nl_attrs('div', [('title', None)]))
+
+    def test_prereqs(self):
+        self.assertEqual([1], self.nl_attrs(
+            'input', [('type', 'submit'), ('value', 'Save')]))
+        self.assertEqual([], self.nl_attrs(
+            'input', [('type', 'hidden'), ('value', 'Save')]))
+        self.assertEqual([], self.nl_attrs(
+            'input', [('value', 'Save'), ('data-type', 'submit')]))
+
+    def test_tagname_rules_override_star_rules(self):
+        i18nize_templates.add_nltext_tag_attribute('a', 'title', ('x', 'y'))
+        self.assertEqual([], self.nl_attrs('a', [('title', 'Go')]))
+        self.assertEqual([0], self.nl_attrs('a', [('title', 'Go'),
+                                                  ('x', 'y')]))
+        self.assertEqual([0], self.nl_attrs('b', [('title', 'Go')]))
+
+    def test_fast_reject(self):
+        may_have = i18nize_templates.may_have_natural_language_attributes
+        self.assertFalse(may_have('<div class="x" id="y">'))
+        self.assertFalse(may_have('</div>'))
+        self.assertTrue(may_have('<div TITLE="x">'))
+        self.assertTrue(may_have('<input type=text value=x>'))
+        i18nize_templates.add_nltext_tag_attribute('div', 'data-x')
+        self.assertTrue(may_have('<div data-x="y">'))
+
+    def test_mixed_case_attribute_names(self):
+        # html attribute names are case-insensitive, so these match
+        # however they're written in the tag.
+        i18nize_templates.add_nltext_tag_attribute('*', 'data-Bork')
+        may_have = i18nize_templates.may_have_natural_language_attributes
+        self.assertTrue(may_have('<div data-bork="y">'))
+        self.assertTrue(may_have('<div DATA-BORK="y">'))
+        parser = i18nize_templates.get_parser_for_file('x.jinja2')
+        self.assertEqual('<div data-Bork="{{ _("Hello there") }}"></div>',
+                         parser.parse('<div data-Bork="Hello there"></div>'))
+        config = i18nize_templates.I18nizeConfig(
+            nltext_tag_attributes=[('*', 'data-Bork')])
+        parser = i18nize_templates.get_parser_for_file('x.jinja2',
+                                                       config=config)
+        self.assertEqual('<div data-Bork="{{ _("Hello there") }}"></div>',
+                         parser.parse('<div data-Bork="Hello there"></div>'))
+
+    def test_rejected_tags_are_not_parsed(self):
+        class _NoParseLexer(i18nize_templates.HtmlLexer):
+            def parse_starttag(self, rawdata, i):
+                raise RuntimeError('should not parse tags')
+
+        handler = i18nize_templates.NullTextHandler(
+            _NoParseLexer(i18nize_templates.NullTextHandler(None)
+                          .handle_segment))
+        self.assertEqual('<div class="x">',
+                         handler.handle_tag('<div class="x">'))
+
+
+class BalancedBlockTest(TestBase):
+    """Test how we lex template blocks inside html tags."""
+    LEXERS = (i18nize_templates.Jinja2HtmlLexer,
+              i18nize_templates.DjangoHtmlLexer)
+
+    def check_block_end(self, input, expected_end):
+        for lexer_class in self.LEXERS:
+            lexer = lexer_class(None)
+            self.assertEqual(expected_end,
+                             lexer.match_template_block(input, 0))
+
+    def check_tag(self, input):
+        def _save_segments(segment, segment_separates_nltext):
+            segments.append(segment)
+
+        for lexer_class in self.LEXERS:
+            segments = []
+            lexer_class(_save_segments).parse(input)
+            self.assertEqual([input, None], segments)
+
+    def check_quick(self, input, fails=True):
+        """Check that lexing input looks at each block tag a few times.
+
+        A scanner that rescans the rest of the document for each
+        unbalanced tag looks at the block tags quadratically often.
+        """
+        class _CountingRegexp(object):
+            def __init__(self, regexp):
+                self.regexp = regexp
+                self.calls = 0
+
+            def match(self, *args):
+                self.calls += 1
+                return self.regexp.match(*args)
+
+            def search(self, *args):
+                self.calls += 1
+                return self.regexp.search(*args)
+
+        for lexer_class in self.LEXERS:
+            lexer = lexer_class(
+                lambda segment, segment_separates_nltext: None)
+            lexer.BLOCK_TAG = _CountingRegexp(lexer_class.BLOCK_TAG)
+            if fails:
+                with self.assertRaises(i18nize_templates.HTMLParseError):
+                    lexer.parse(input)
+            else:
+                lexer.parse(input)
+            num_block_tags = len(lexer_class.BLOCK_TAG.findall(input))
+            self.assertLessEqual(lexer.BLOCK_TAG.calls,
+                                 2 * num_block_tags + 2)
+
+    def check_fails_quickly(self, input):
+        self.check_quick(input, fails=True)
+
+    def test_simple_block(self):
+        self.check_block_end('{% if x %}a{% else %}b{% endif %}c', 33)
+        self.check_block_end('{%- if x -%}a{%- endif -%}c', 26)
+
+    def test_nested_blocks(self):
+        self.check_block_end('{% if x %}{% if y %}a{% endif %}{% endif %}b',
+                             43)
+        self.check_block_end('{% for x in y %}{% if x %}{% endfor %}b', 38)
+
+    def test_not_a_block(self):
+        self.check_block_end('{% endif %}', None)
+        self.check_block_end('{{ x }}', None)
+        self.check_block_end('{% if x %}a', None)
+        self.check_block_end('{% if x %}{% if y %}a{% endif %}', None)
+        self.check_block_end('{% if x %}a{% endif', None)
+
+    def test_nested_blocks_in_tag(self):
+        self.check_tag('<b {% if x %}{% if y %}id=a{% endif %}{% endif %}>')
+        self.check_tag('<b{% if x %} id={% if y %}"a"{% else %}"b"{% endif %}'
+                       '{% endif %}>')
+        self.check_tag('<input value="{% if a > b %}x{% endif %}">')
+
+    def test_unterminated_block_in_value(self):
+        rest = '<p>Some text {% endif %} here</p>\n' * 2000
+        self.check_fails_quickly('<input value="{% if a %}x>' + rest)
+        self.check_fails_quickly(
+            '<input value="' + '{% if a %}x' * 30 + '>' + rest)
+        self.check_fails_quickly(
+            '<input value=' + '{% if a %}x' * 30 + '"' + rest)
+
+    def test_unterminated_block_in_tag(self):
+        rest = '<p>Some text {% endfor %} here</p>\n' * 2000
+        self.check_fails_quickly('<b ' + '{% if a %}x ' * 30 + '"' + rest)
+        self.check_fails_quickly('<b {% if a %} class="a">' + rest)
+
+    def test_many_unterminated_blocks(self):
+        # Each one used to scan to the end of the document.
+        self.check_quick('<p title="{% if x %}a">hi</p>\n' * 3000,
+                         fails=False)
+        self.check_quick('<p title="{% if x %}{% if y %}{% for z in w %}a">'
+                         'hi</p>\n' * 3000, fails=False)
+
+
+class HandlebarsBalancedBlockTest(BalancedBlockTest):
+    LEXERS = (i18nize_templates.HandlebarsHtmlLexer,)
+
+    def test_simple_block(self):
+        self.check_block_end('{{#if x}}a{{else}}b{{/if}}c', 26)
+        self.check_block_end('{{#each xs}}{{name}}{{/each}}c', 29)
+        self.check_block_end('{{#foo x}}a{{/foo}}c', 19)
+
+    def test_nested_blocks(self):
+        self.check_block_end('{{#if x}}{{#if y}}a{{/if}}{{/if}}b', 33)
+        self.check_block_end('{{#if x}}{{#each y}}{{#if z}}a{{/if}}{{/each}}'
+                             '{{/if}}b', 53)
+        self.check_block_end('{{#if x}}a{{/each}}{{/if}}b', 26)
+
+    def test_not_a_block(self):
+        self.check_block_end('{{/if}}', None)
+        self.check_block_end('{{x}}', None)
+        self.check_block_end('{{#if x}}a', None)
+        self.check_block_end('{{#if x}}a{{/each}}', None)
+        self.check_block_end('{{#if x}}{{#if y}}a{{/if}}', None)
+        self.check_block_end('{{#if x}}a{{/if', None)
+
+    def test_nested_blocks_in_tag(self):
+        self.check_tag('<b {{#if x}}{{#if y}}id=a{{/if}}{{/if}}>')
+        self.check_tag('<b{{#if x}} id={{#if y}}"a"{{else}}"b"{{/if}}'
+                       '{{/if}}>')
+        self.check_tag('<b {{#if x}}{{#with y}}{{#each z}}{{a}}{{/each}}'
+                       '{{/with}}{{/if}} id="{{#foo}}a{{/foo}}">')
+        self.check_tag('<input value="{{#if a}}x{{/if}}">')
+
+    def test_unterminated_block_in_value(self):
+        rest = '<p>Some text {{/if}} here</p>\n' * 2000
+        self.check_fails_quickly('<input value="{{#if a}}x>' + rest)
+        self.check_fails_quickly(
+            '<input value="' + '{{#if a}}x' * 30 + '>' + rest)
+        self.check_fails_quickly(
+            '<input value=' + '{{#if a}}x' * 30 + '"' + rest)
+
+    def test_unterminated_block_in_tag(self):
+        rest = '<p>Some text {{/each}} here</p>\n' * 2000
+        self.check_fails_quickly('<b ' + '{{#if a}}x ' * 30 + '"' + rest)
+        self.check_fails_quickly('<b {{#if a}} class="a">' + rest)
+
+    def test_many_unterminated_blocks(self):
+        self.check_quick('<p title="{{#if x}}a">hi</p>\n' * 3000,
+                         fails=False)
+        self.check_quick('<p title="{{#if x}}{{#each y}}a">hi</p>\n' * 3000,
+                         fails=False)
+
+
+class FeedTest(TestBase):
+    """Test lexing a document a chunk at a time."""
+    def check(self, lexer_class, input):
+        """Make sure feed() gives the same segments as parse() does."""
+        def _save_segments(segment, segment_separates_nltext):
+            segments.append((segment, segment_separates_nltext))
+
+        segments = []
+        lexer_class(_save_segments).parse(input)
+        expected = segments
+
+        for chunk_size in (1, 2, 3, 10):
+            segments = []
+            lexer = lexer_class(_save_segments)
+            for i in range(0, len(input), chunk_size):
+                lexer.feed(input[i:i + chunk_size])
+            lexer.close()
+            self.assertEqual(expected, segments, chunk_size)
+
+    def test_html(self):
+        self.check(i18nize_templates.HtmlLexer,
+                   '<p>Hello <b>world</b><br><br>!<!-- c --><script>'
+                   'document.write("<b>x</b>");</script><img alt=a></p>')
+
+    def test_jinja2(self):
+        self.check(i18nize_templates.Jinja2HtmlLexer,
+                   '<p>Hi {{ name }}{# c #}<b x={% if a %}>{% endif %}>'
+                   '{{ _("done") }}<a href="{{ url }}" {% if x %}id=a'
+                   '{% endif %}>t</a></p>')
+
+    def test_handlebars(self):
+        self.check(i18nize_templates.HandlebarsHtmlLexer,
+                   '<p>Hi {{name}}{{! c }}<b {{#if a}}x{{/if}}>{{#_}}t{{/_}}'
+                   '<i title="{{#if x}}a{{else}}b{{/if}}">t</i></p>')
+
+    def test_output_is_returned_as_runs_end(self):
+        lexer = i18nize_templates.HtmlLexer(
+            i18nize_templates.NullTextHandler(None).handle_segment)
+        bye = 'Goodbye, cruel world.  ' * 5
+        self.assertEqual('', lexer.feed('<p>Hello'))
+        self.assertEqual('<p>Hello world</p><p>',
+                         lexer.feed(' world</p><p>' + bye))
+        self.assertEqual(bye, lexer.close())
+
+    def test_only_unfinished_data_is_kept(self):
+        lexer = i18nize_templates.Jinja2HtmlLexer(
+            lambda segment, segment_separates_nltext: None)
+        for _ in range(1000):
+            lexer.feed('<p>Hello <b title="{{ a }}">world</b>.</p>\n')
+        self.assertLess(len(lexer.rawdata), 200)
+        lexer.close()
+
+    def test_unterminated_entity(self):
+        lexer = i18nize_templates.Jinja2HtmlLexer(
+            lambda segment, segment_separates_nltext: None)
+        lexer.feed('<p>Hello {{ world')
+        with self.assertRaises(i18nize_templates.HTMLParseError):
+            lexer.close()
+
+    def test_sink(self):
+        input = '<p>Hello <b>world</b></p><p>{{ a }}</p>'
+        lexer = i18nize_templates.Jinja2HtmlLexer(
+            i18nize_templates.Jinja2TextHandler(None).handle_segment)
+        expected = lexer.parse(input)
+
+        sink = io.StringIO()
+        self.assertEqual(None, lexer.parse(input, sink))
+        self.assertEqual(expected, sink.getvalue())
+
+        sink = io.StringIO()
+        lexer.reset(sink)
+        self.assertEqual(None, lexer.feed(input[:10]))
+        self.assertEqual(None, lexer.feed(input[10:]))
+        self.assertEqual(None, lexer.close())
+        self.assertEqual(expected, sink.getvalue())
+
+
+class PositionTest(TestBase):
+    """Test the line numbers and offsets we give for errors."""
+    def check(self, input, expected_pos):
+        lexer = i18nize_templates.Jinja2HtmlLexer(
+            lambda segment, segment_separates_nltext: None)
+        with self.assertRaises(i18nize_templates.HTMLParseError) as cm:
+            lexer.parse(input)
+        self.assertEqual(expected_pos, cm.exception.args[1])
+
+        # And again, a chunk at a time.
+        lexer.reset()
+        with self.assertRaises(i18nize_templates.HTMLParseError) as cm:
+            for i in range(0, len(input), 3):
+                lexer.feed(input[i:i + 3])
+            lexer.close()
+        self.assertEqual(expected_pos, cm.exception.args[1])
+
+    def test_first_line(self):
+        self.check('<p>Hello {{ world', (1, 9))
+
+    def test_later_line(self):
+        self.check('<p>\nHello\n  <b>{{ world', (3, 5))
+
+    def test_newline_in_tag(self):
+        self.check('<p\nclass="a">\n\n{% if x %}\n<b>{{ x', (5, 3))
+
+    def test_position_of(self):
+        lexer = i18nize_templates.HtmlLexer(None)
+        lexer.rawdata = 'ab\ncd\n\ne'
+        self.assertEqual([(1, 0), (1, 1), (1, 2), (2, 0), (2, 1), (2, 2),
+                          (3, 0), (4, 0)],
+                         [lexer.position_of(i) for i in range(8)])
+
+
+class I18nizeFileTest(TempDirTestBase):
+    """Test i18nizing files in place."""
+    def i18nize(self, filename, contents):
+        html_file = os.path.join(self.tmpdir, filename)
+        with open(html_file, 'w') as f:
+            f.write(contents)
+        os.chmod(html_file, 0o640)
+        i18nize_templates.i18nize(
+            html_file, i18nize_templates.get_parser_for_file(html_file))
+        return html_file
+
+    def test_in_place(self):
+        html_file = self.i18nize('a.jinja2', '<p>Hello <b>world</b></p>\n')
+        with open(html_file) as f:
+            self.assertEqual('<p>{{ _("Hello <b>world</b>") }}</p>\n',
+                             f.read())
+        self.assertEqual(0o640, os.stat(html_file).st_mode & 0o777)
+        self.assertEqual(['a.jinja2'], os.listdir(self.tmpdir))
+
+    def test_error_leaves_file_alone(self):
+        with self.assertRaises(i18nize_templates.HTMLParseError):
+            self.i18nize('a.jinja2', '<p>Hello {{ world</p>\n')
+        with open(os.path.join(self.tmpdir, 'a.jinja2')) as f:
+            self.assertEqual('<p>Hello {{ world</p>\n', f.read())
+        self.assertEqual(['a.jinja2'], os.listdir(self.tmpdir))
+
+
+class ParallelTest(TempDirTestBase):
+    """Test i18nizing many files at once, with --jobs."""
+    def write_files(self):
+        """Write some files, of different sizes; return their names."""
+        html_files = []
+        for i in range(8):
+            html_file = os.path.join(self.tmpdir, '%d.jinja2' % i)
+            with open(html_file, 'w') as f:
+                f.write('<p>Hello <b>world</b> %d</p>\n' % i * (i % 3 + 1))
+            html_files.append(html_file)
+        bad_file = os.path.join(self.tmpdir, 'bad.jinja2')
+        with open(bad_file, 'w') as f:
+            f.write('<p>Hello {{ world</p>\n')
+        html_files.insert(3, bad_file)
+        return html_files
+
+    def contents(self, html_files):
+        retval = []
+        for html_file in html_files:
+            with open(html_file) as f:
+                retval.append(f.read())
+        return retval
+
+    def test_same_as_one_at_a_time(self):
+        html_files = self.write_files()
+        (retval, stderr) = self.run_main('--jobs', '3', *html_files)
+        contents = self.contents(html_files)
+
+        html_files = self.write_files()
+        self.assertEqual((retval, stderr),
+                         self.run_main('--jobs', '1', *html_files))
+        self.assertEqual(self.contents(html_files), contents)
+        self.assertEqual('<p>{{ _("Hello <b>world</b> 1") }}</p>\n' * 2,
+                         contents[1])
+
+    def test_errors_and_output_order(self):
+        html_files = self.write_files()
+        (retval, stderr) = self.run_main('--jobs', '3', *html_files)
+        self.assertEqual(1, retval)
+        expected = []
+        for html_file in html_files:
+            expected.append('i18nizing %s' % html_file)
+            if html_file.endswith('bad.jinja2'):
+                expected.append("ERROR i18nizing %s: ('No end }} found', "
+                                "(1, 9))" % html_file)
+        self.assertEqual(expected, stderr.splitlines())
+
+    def test_stats(self):
+        def _run_lookups(jobs):
+            (_, stderr) = self.run_main('--jobs', jobs, '--stats',
+                                    '--run-cache-mb', '1',
+                                    *self.write_files())
+            m = re.search(r'^nltext runs: (\d+) hits, (\d+) misses',
+                          stderr, re.M)
+            return int(m.group(1)) + int(m.group(2))
+
+        # Each process has its own memo, so the hits and misses
+        # depend on which process got which file, but the total
+        # shouldn't.
+        self.assertEqual(_run_lookups('1'), _run_lookups('3'))
+
+
+class WalkTest(TempDirTestBase):
+    """Test finding the files to i18nize: directories, globs, lists."""
+    def setUp(self):
+        super(WalkTest, self).setUp()
+        for name in ('a.html', 'b.handlebars', 'c.jinja2', 'notes.txt',
+                     '.hidden.html', 'sub/d.html', 'sub/e.txt',
+                     'sub/deeper/f.j2', 'vendor/g.html', '.git/h.html'):
+            path = os.path.join(self.tmpdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('<p>Hello {{ name }}</p>\n')
+
+    def walk(self, *args, **kwargs):
+        return [os.path.relpath(f, self.tmpdir) for f in
+                i18nize_templates.walk_html_files(self.tmpdir, *args,
+                                                  **kwargs)]
+
+    def main(self, *args):
+        """Return main()'s return value, and the files it i18nized."""
+        (retval, stderr) = self.run_main(*args)
+        return (retval,
+                [os.path.relpath(line[len('i18nizing '):], self.tmpdir)
+                 for line in stderr.splitlines()
+                 if line.startswith('i18nizing ')])
+
+    def contents(self, name):
+        with open(os.path.join(self.tmpdir, name)) as f:
+            return f.read()
+
+    def test_default_extensions(self):
+        self.assertEqual(['a.html', 'b.handlebars', 'c.jinja2',
+                          'sub/d.html', 'sub/deeper/f.j2', 'vendor/g.html'],
+                         self.walk())
+
+    def test_include_and_exclude(self):
+        self.assertEqual(['notes.txt', 'sub/e.txt'],
+                         self.walk(includes=['*.txt']))
+        self.assertEqual(['sub/e.txt'],
+                         self.walk(includes=['sub/*.txt']))
+        self.assertEqual(['a.html', 'b.handlebars', 'c.jinja2',
+                          'sub/d.html'],
+                         self.walk(excludes=['vendor', 'deeper']))
+        self.assertEqual(['a.html', 'vendor/g.html'],
+                         self.walk(includes=['*.html'],
+                                   excludes=['sub/*']))
+
+    def test_dialect_for_file(self):
+        self.assertEqual('django',
+                         i18nize_templates.dialect_for_file('a.html'))
+        self.assertEqual('handlebars',
+                         i18nize_templates.dialect_for_file('a.handlebars'))
+        self.assertEqual('jinja2',
+                         i18nize_templates.dialect_for_file('a.txt'))
+        extensions = {'.html': 'django', '.j2.html': 'jinja2'}
+        self.assertEqual('jinja2', i18nize_templates.dialect_for_file(
+            'a.j2.html', extensions))
+        self.assertEqual('django', i18nize_templates.dialect_for_file(
+            'a.html', extensions))
+
+    def test_main_walks_directories(self):
+        for jobs in ('1', '3'):
+            self.assertEqual(
+                (0, ['a.html', 'b.handlebars', 'c.jinja2', 'sub/d.html']),
+                self.main('--jobs', jobs, '--exclude', 'deeper',
+                          '--exclude', 'vendor', self.tmpdir))
+        self.assertEqual('<p>{{ _("Hello") }} {{ name }}</p>\n',
+                         self.contents('c.jinja2'))
+        self.assertEqual('<p>{{_ "Hello" }} {{ name }}</p>\n',
+                         self.contents('b.handlebars'))
+        self.assertEqual('<p>Hello {{ name }}</p>\n',
+                         self.contents('vendor/g.html'))
+        # We don't leave behind any temp files.
+        self.assertEqual(['.git', '.hidden.html', 'a.html', 'b.handlebars',
+                          'c.jinja2', 'notes.txt', 'sub', 'vendor'],
+                         sorted(os.listdir(self.tmpdir)))
+
+    def test_dialect_flag(self):
+        self.assertEqual(
+            (0, ['notes.txt']),
+            self.main('--include', '*.txt', '--dialect',
+                      '.txt=handlebars', self.tmpdir + '/notes.txt'))
+        self.assertEqual('<p>{{_ "Hello" }} {{ name }}</p>\n',
+                         self.contents('notes.txt'))
+
+    def test_files_from(self):
+        file_list = os.path.join(self.tmpdir, 'files')
+        with open(file_list, 'wb') as f:
+            f.write(b'\0'.join(os.path.join(self.tmpdir, name).encode()
+                               for name in ('c.jinja2', 'sub/e.txt',
+                                            'c.jinja2')))
+        self.assertEqual((0, ['a.html', 'c.jinja2', 'sub/e.txt']),
+                         self.main(self.tmpdir + '/a.html',
+                                   '--files-from', file_list))
+
+    def test_args_from_file(self):
+        arg_file = os.path.join(self.tmpdir, 'args')
+        with open(arg_file, 'w') as f:
+            f.write('--include\n*.txt\n%s\n' % self.tmpdir)
+        self.assertEqual((0, ['notes.txt', 'sub/e.txt']),
+                         self.main('@' + arg_file))
+
+    def test_errors_keep_going(self):
+        self.assertEqual(
+            (1, ['a.html', 'missing.html']),
+            self.main(self.tmpdir + '/a.html', self.tmpdir + '/missing.html'))
+        self.assertRaises(IOError, self.main, self.tmpdir + '/missing.html')
+
+
+class IncrementalTest(TempDirTestBase):
+    """Test skipping files we've already i18nized, with --incremental."""
+    def setUp(self):
+        super(IncrementalTest, self).setUp()
+        self.manifest = os.path.join(self.tmpdir, '.i18nize-cache')
+        self.write('a.jinja2', '<p>Hello</p>\n')
+        self.write('b.jinja2', '<p>Goodbye</p>\n')
+        self.write('copy_of_a.jinja2', '<p>Hello</p>\n')
+        self.write('a.handlebars', '<p>Hello</p>\n')
+        self.write('bad.jinja2', '<p>Hello {{ world</p>\n')
+
+    def write(self, name, contents):
+        with open(os.path.join(self.tmpdir, name), 'w') as f:
+            f.write(contents)
+
+    def contents(self, name):
+        with open(os.path.join(self.tmpdir, name)) as f:
+            return f.read()
+
+    def main(self, *args):
+        """Return main()'s return value and the last line of stderr."""
+        (retval, stderr) = self.run_main(
+            '--incremental', '--stats', '--manifest', self.manifest,
+            *(args + (self.tmpdir,)))
+        return (retval, stderr.splitlines()[-1])
+
+    def test_skips_unchanged_files(self):
+        self.assertEqual(
+            (1, 'unchanged files: 0 hits, 4 misses, 1 duplicates'),
+            self.main())
+        self.assertEqual('<p>{{ _("Hello") }}</p>\n',
+                         self.contents('copy_of_a.jinja2'))
+        self.assertEqual('<p>{{_ "Hello" }}</p>\n',
+                         self.contents('a.handlebars'))
+
+        # We try bad.jinja2 again, since we couldn't i18nize it.
+        self.assertEqual(
+            (1, 'unchanged files: 4 hits, 1 misses, 0 duplicates'),
+            self.main())
+
+        self.write('bad.jinja2', '<p>Hello {{ world }}</p>\n')
+        self.write('b.jinja2', '<p>Goodbye again</p>\n')
+        os.utime(os.path.join(self.tmpdir, 'a.jinja2'))   # no real change
+        self.assertEqual(
+            (0, 'unchanged files: 3 hits, 2 misses, 0 duplicates'),
+            self.main())
+        self.assertEqual('<p>{{ _("Goodbye again") }}</p>\n',
+                         self.contents('b.jinja2'))
+        self.assertEqual(
+            (0, 'unchanged files: 5 hits, 0 misses, 0 duplicates'),
+            self.main('--jobs', '3'))
+
+    def test_skips_without_reading(self):
+        self.main()
+        # Pretend the manifest was written long after the files were.
+        os.utime(self.manifest, (time.time() + 10, time.time() + 10))
+        opened = []
+
+        def _open(path, *args, **kwargs):
+            opened.append(os.path.basename(path))
+            return open(path, *args, **kwargs)
+
+        # This shadows the builtin open() for i18nize_templates.
+        i18nize_templates.open = _open
+        try:
+            self.main()
+        finally:
+            del i18nize_templates.open
+        # We still have to look at bad.jinja2, which we couldn't do.
+        self.assertEqual(['.i18nize-cache', 'bad.jinja2', 'bad.jinja2'],
+                         opened)
+
+    def test_parallel(self):
+        self.assertEqual(
+            (1, 'unchanged files: 0 hits, 4 misses, 1 duplicates'),
+            self.main('--jobs', '3'))
+        self.assertEqual('<p>{{ _("Hello") }}</p>\n',
+                         self.contents('copy_of_a.jinja2'))
+        self.assertEqual(
+            (1, 'unchanged files: 4 hits, 1 misses, 0 duplicates'),
+            self.main('--jobs', '3'))
+
+    def test_new_config_starts_over(self):
+        self.main()
+        config_file = os.path.join(self.tmpdir, 'config.json')
+        with open(config_file, 'w') as f:
+            f.write('{"ok_functions": ["foo"]}')
+        self.assertEqual(
+            (1, 'unchanged files: 0 hits, 4 misses, 1 duplicates'),
+            self.main('--config', config_file))
+
+    def test_dialect_change_starts_over(self):
+        self.main()
+        self.assertEqual(
+            (1, 'unchanged files: 1 hits, 3 misses, 1 duplicates'),
+            self.main('--dialect', '.jinja2=django'))
+
+
+class NaturalLanguageClassifierTest(TestBase):
+    def setUp(self):
+        super(NaturalLanguageClassifierTest, self).setUp()
+        self.classifier = i18nize_templates.NaturalLanguageClassifier()
+
+    def test_no_natural_language(self):
+        for text in ('', ' \n', '(...)?', '&nbsp;', '&amp', '&#38;',
+                     '&#x26;', '&#X2F;', '&apos; &times;&ndash;'):
+            self.assertTrue(self.classifier.no_natural_language(text),
+                            text)
+        for text in ('a', ' 1 ', '_', 'é', '&', '&eacute;', '&#233;',
+                     '&ampx;', '&#038;', '&#x026;', '&#x;', '&#;', '&foo;'):
+            self.assertFalse(self.classifier.no_natural_language(text),
+                             text)
+
+    def test_prefix_end(self):
+        self.assertEqual(0, self.classifier.prefix_end('Hi!'))
+        self.assertEqual(3, self.classifier.prefix_end(' - Hi!'))
+        self.assertEqual(7, self.classifier.prefix_end('&nbsp; Hi'))
+        self.assertEqual(1, self.classifier.prefix_end(' &eacute;té'))
+        self.assertEqual(5, self.classifier.prefix_end('(...)'))
+
+    def test_suffix_start(self):
+        self.assertEqual(3, self.classifier.suffix_start('Hi!'))
+        self.assertEqual(3, self.classifier.suffix_start('Hi! \n'))
+        self.assertEqual(3, self.classifier.suffix_start('Hi!&nbsp'))
+        self.assertEqual(3, self.classifier.suffix_start('Hi!*&#32 #'))
+        # The ';' of '&nbsp;' isn't whitespace-like, so it stays.
+        self.assertEqual(9, self.classifier.suffix_start('Hi!&nbsp;'))
+        self.assertEqual(2, self.classifier.suffix_start('Hi&amp'))
+        self.assertEqual(5, self.classifier.suffix_start('Hi&#a '))
+        self.assertEqual(0, self.classifier.suffix_start(' | '))
+
+    def test_cache(self):
+        self.classifier.prefix_end(' Hi')
+        self.classifier.prefix_end(' Hi')
+        self.assertEqual(1, self.classifier.prefix_end.cache_info().hits)
+
+    def test_handler_ignores_entities(self):
+        for handler in (i18nize_templates.NullTextHandler(None),
+                        i18nize_templates.Jinja2TextHandler(None)):
+            self.assertTrue(
+                handler.no_natural_language_or_already_translated(
+                    ' &nbsp;&#8212; '))
+            self.assertFalse(
+                handler.no_natural_language_or_already_translated(
+                    ' &eacute; '))
+
+
+class TagCacheTest(TestBase):
+    """Test that we re-use what we learned about a tag across files."""
+    def i18nize(self, input):
+        text_handler = i18nize_templates.Jinja2TextHandler
+        tag_parser = i18nize_templates.Jinja2HtmlLexer(
+            text_handler(None).handle_segment)
+        parser = i18nize_templates.Jinja2HtmlLexer(
+            text_handler(tag_parser).handle_segment)
+        return parser.parse(input)
+
+    def test_rewrites_are_shared_across_parsers(self):
+        input = '<p>Hi <img alt="A cat"></p>'
+        expected = '<p>{{ _("Hi") }} <img alt="{{ _("A cat") }}"></p>'
+        self.assertEqual(expected, self.i18nize(input))
+        before = i18nize_templates.run_statistics()['tag rewrites']
+        self.assertEqual(expected, self.i18nize(input))
+        after = i18nize_templates.run_statistics()['tag rewrites']
+        self.assertEqual(0, after.misses - before.misses)
+        self.assertLess(0, after.hits - before.hits)
+
+    def test_nltext_tag_attribute_clears_cache(self):
+        input = '<p><span data-x="Go">Hi</span></p>'
+        self.assertEqual('<p><span data-x="Go">{{ _("Hi") }}</span></p>',
+                         self.i18nize(input))
+        i18nize_templates.add_nltext_tag_attribute('span', 'data-x')
+        self.assertEqual('<p><span data-x="{{ _("Go") }}">{{ _("Hi") }}'
+                         '</span></p>',
+                         self.i18nize(input))
+
+    def test_separator_class_clears_cache(self):
+        input = '<p>Hi <span class="tab">x</span></p>'
+        self.assertEqual('<p>{{ _("Hi <span class=\\"tab\\">x</span>") }}'
+                         '</p>',
+                         self.i18nize(input))
+        i18nize_templates.add_nltext_separator_class('tab')
+        self.assertEqual('<p>{{ _("Hi") }} <span class="tab">{{ _("x") }}'
+                         '</span></p>',
+                         self.i18nize(input))
+
+
+    def test_threads(self):
+        class _SlowHashTag(str):
+            # A hash written in python lets other threads run in the
+            # middle of the cache's dict operations.
+            def __hash__(self):
+                for _ in range(3):
+                    pass
+                return str.__hash__(self)
+
+        # A small cache, so threads keep evicting each other's tags.
+        cache = i18nize_templates._TagRewriteCache(4)
+        tags = [_SlowHashTag('<b id="%d">' % i) for i in range(6)]
+        errors = []
+
+        def _rewrite_tags():
+            try:
+                for _ in range(3000):
+                    for tag in random.sample(tags, len(tags)):
+                        self.assertEqual(tag.upper(),
+                                         cache.get('key', tag, str.upper))
+            except Exception as why:
+                errors.append(why)
+
+        old_switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=_rewrite_tags)
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(old_switch_interval)
+        self.assertEqual([], errors)
+        info = cache.info()
+        self.assertEqual(4 * 3000 * len(tags), info.hits + info.misses)
+        self.assertEqual(4, info.currsize)
+
+
+class RunCacheTest(TestBase):
+    """Test re-using the markup for nltext runs across files."""
+    def setUp(self):
+        super(RunCacheTest, self).setUp()
+        i18nize_templates.enable_run_cache()
+
+    def tearDown(self):
+        i18nize_templates.disable_run_cache()
+        super(RunCacheTest, self).tearDown()
+
+    def i18nize(self, input):
+        text_handler = i18nize_templates.Jinja2TextHandler
+        tag_parser = i18nize_templates.Jinja2HtmlLexer(
+            text_handler(None).handle_segment)
+        parser = i18nize_templates.Jinja2HtmlLexer(
+            text_handler(tag_parser).handle_segment)
+        return parser.parse(input)
+
+    def run_info(self):
+        return i18nize_templates.run_statistics()['nltext runs']
+
+    def test_runs_are_shared_across_files(self):
+        footer = '<p>Learn <a href="/more" title="More">more</a></p>'
+        expected = ('<p>{{ _("Learn <a href=\\"/more\\" '
+                    'title=\\"More\\">more</a>") }}</p>')
+        self.assertEqual('<h1>{{ _("One") }}</h1>' + expected,
+                         self.i18nize('<h1>One</h1>' + footer))
+        self.assertEqual('<h1>{{ _("Two") }}</h1>' + expected,
+                         self.i18nize('<h1>Two</h1>' + footer))
+        info = self.run_info()
+        self.assertEqual(1, info.hits)
+        self.assertEqual(len('Learn <a href="/more" title="More">more</a>'),
+                         info.bytes_saved)
+
+    def test_memory_cap(self):
+        i18nize_templates.enable_run_cache(max_bytes=100)
+        for i in range(20):
+            self.i18nize('<p>Paragraph number %d</p>' % i)
+        info = self.run_info()
+        self.assertEqual(20, info.misses)
+        self.assertLessEqual(info.currsize, 100)
+        self.assertLess(0, info.currsize)
+        # The first paragraph was evicted, but the last one wasn't.
+        self.i18nize('<p>Paragraph number 0</p>')
+        self.i18nize('<p>Paragraph number 19</p>')
+        self.assertEqual(1, self.run_info().hits)
+
+    def test_customizations_clear_cache(self):
+        input = '<p><span data-x="Go">Hi</span></p>'
+        self.i18nize(input)
+        i18nize_templates.add_nltext_tag_attribute('span', 'data-x')
+        self.assertEqual(0, self.run_info().currsize)
+        self.assertEqual('<p><span data-x="{{ _("Go") }}">{{ _("Hi") }}'
+                         '</span></p>',
+                         self.i18nize(input))
+
+    def test_threads(self):
+        class _SlowHashSegment(str):
+            # As in TagCacheTest.test_threads.
+            def __hash__(self):
+                for _ in range(3):
+                    pass
+                return str.__hash__(self)
+
+        cache = i18nize_templates._RunCache(max_bytes=30)
+        runs = [[_SlowHashSegment('Run %d' % i)] for i in range(6)]
+        errors = []
+
+        def _add_i18n(segments):
+            return '_(%s)' % segments[0]
+
+        def _get_runs():
+            try:
+                for _ in range(3000):
+                    for run in random.sample(runs, len(runs)):
+                        self.assertEqual('_(%s)' % run[0],
+                                         cache.get('key', None, run,
+                                                   _add_i18n))
+            except Exception as why:
+                errors.append(why)
+
+        old_switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=_get_runs)
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(old_switch_interval)
+        self.assertEqual([], errors)
+        info = cache.info()
+        self.assertEqual(4 * 3000 * len(runs), info.hits + info.misses)
+        self.assertLessEqual(info.currsize, 30)
+
+    def test_disabled_by_default(self):
+        i18nize_templates.disable_run_cache()
+        self.assertNotIn('nltext runs', i18nize_templates.run_statistics())
+
+
+class CacheDbTest(TempDirTestBase):
+    """Test remembering nltext runs in a sqlite file across invocations."""
+    def setUp(self):
+        super(CacheDbTest, self).setUp()
+        self.cache_db = os.path.join(self.tmpdir, 'cache.db')
+
+    def tearDown(self):
+        i18nize_templates.disable_run_cache()
+        super(CacheDbTest, self).tearDown()
+
+    def i18nize(self, input, **kwargs):
+        """i18nize input in an 'invocation' of its own, using the db."""
+        i18nize_templates.enable_run_cache(cache_db=self.cache_db, **kwargs)
+        text_handler = i18nize_templates.Jinja2TextHandler
+        tag_parser = i18nize_templates.Jinja2HtmlLexer(
+            text_handler(None).handle_segment)
+        parser = i18nize_templates.Jinja2HtmlLexer(
+            text_handler(tag_parser).handle_segment)
+        output = parser.parse(input)
+        self.info = i18nize_templates.run_statistics()['cache db']
+        i18nize_templates.disable_run_cache()
+        return output
+
+    def test_runs_are_remembered_across_invocations(self):
+        input = '<p>Hi <b>there</b></p><p>Bye</p>'
+        expected = '<p>{{ _("Hi <b>there</b>") }}</p><p>{{ _("Bye") }}</p>'
+        self.assertEqual(expected, self.i18nize(input))
+        self.assertEqual((0, 2), (self.info.hits, self.info.misses))
+        self.assertEqual(expected, self.i18nize(input))
+        self.assertEqual((2, 0), (self.info.hits, self.info.misses))
+
+    def test_customizations_change_the_key(self):
+        # The markup we saved was made without this customization,
+        # so we can't trust it anymore.
+        self.i18nize('<p>Hi there</p>')
+        i18nize_templates.mark_function_args_lack_nltext('myfn')
+        self.i18nize('<p>Hi there</p>')
+        self.assertEqual((0, 1), (self.info.hits, self.info.misses))
+        self.i18nize('<p>Hi there</p>')
+        self.assertEqual((1, 0), (self.info.hits, self.info.misses))
+
+    def test_size_limit(self):
+        for i in range(20):
+            self.i18nize('<p>Paragraph number %d</p>' % i,
+                         cache_db_max_bytes=500)
+            self.assertLessEqual(self.info.currsize, 500 + 100)
+        # The last paragraph is still there, but the first is not.
+        self.i18nize('<p>Paragraph number 19</p>', cache_db_max_bytes=500)
+        self.assertEqual(1, self.info.hits)
+        self.i18nize('<p>Paragraph number 0</p>', cache_db_max_bytes=500)
+        self.assertEqual(0, self.info.hits)
+
+
 class HtmlTest(TestBase):
     """Test some simple html parsing."""
     def check(self, input):
@@ -135,6 +1272,21 @@ class Jinja2Test(TestBase):
     def todo(self, input, expected):
         pass
 
+    def test_long_run_of_non_language_segments(self):
+        self.check('<i> </i>' * 100 + 'Hi <b>there</b>.' +
+                   ' <i>&nbsp;</i>' * 100,
+                   '<i> </i>' * 100 + '{{ _("Hi <b>there</b>.") }}' +
+                   ' <i>&nbsp;</i>' * 100)
+
+    def test_run_without_language(self):
+        self.check(' <i>-</i> <b>?</b>', ' <i>-</i> <b>?</b>')
+
+    def test_many_tags_stay_together(self):
+        self.check('<span><i> </i><b>Hi</b>' + ' <a>x</a>' * 1000 +
+                   '</span> <i></i>',
+                   '<span><i> </i>{{ _("<b>Hi</b>' + ' <a>x</a>' * 1000 +
+                   '") }}</span> <i></i>')
+
     def test_simple(self):
         self.check('Hello, world.', '{{ _("Hello, world.") }}')
 
@@ -475,6 +1627,125 @@ class Jinja2Test(TestBase):
                    "{{ urlize('foo') + not_ok(_TODO('bar')) + _('baz') }}")
 
 
+class ExpressionTest(TestBase):
+    """Test adding _() and _TODO() inside {{ template expressions }}."""
+    def check(self, input, expected):
+        # The jinja2 and django handlers share this logic.
+        for text_handler in (i18nize_templates.Jinja2TextHandler,
+                             i18nize_templates.DjangoTextHandler):
+            self.assertEqual(expected,
+                             text_handler(None).add_underscore([input]))
+
+    def test_ok_function_only_covers_its_own_args(self):
+        self.check('{{ sort(fn("a"), "b") }}',
+                   '{{ sort(fn(_TODO("a")), "b") }}')
+        self.check('{{ fn(sort("a"), "b") }}',
+                   '{{ fn(sort("a"), _TODO("b")) }}')
+
+    def test_ok_param(self):
+        self.check('{{ fn(style="a", title="b", style == "c") }}',
+                   '{{ fn(style="a", title=_TODO("b"), '
+                   'style == _TODO("c")) }}')
+
+    def test_subscript(self):
+        self.check('{{ x["a"] ~ x[ "b"] ~ f(x["c"]) }}',
+                   '{{ x["a"] ~ x[ _("b")] ~ f(x[_TODO("c")]) }}')
+
+    def test_unclosed_function_call(self):
+        self.check('{{ fn("a", g("b" }}',
+                   '{{ fn(_TODO("a"), g(_TODO("b") }}')
+
+    def test_deeply_nested_function_args(self):
+        depth = 5000
+        self.check('{{ %s"a"%s }}' % ('fn(' * depth, ')' * depth),
+                   '{{ %s_TODO("a")%s }}' % ('fn(' * depth, ')' * depth))
+
+    def test_long_expression(self):
+        input = '{{ fn(%s) }}' % ', '.join(['x="a"'] * 20000)
+        self.check(input, input.replace('"a"', '_TODO("a")'))
+
+    def test_long_expression_is_linear(self):
+        # Rather than a time limit, which a slow machine can go over,
+        # we check that 4x the input takes nowhere near 16x the time.
+        config = i18nize_templates.I18nizeConfig()
+
+        def _seconds(num_args):
+            input = '{{ fn(%s) }}' % ', '.join(['x="a"'] * num_args)
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                i18nize_templates._add_underscore_in_expression(input,
+                                                                 config)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        self.assertLess(_seconds(20000), 8 * _seconds(5000))
+
+    def test_memo(self):
+        handler = i18nize_templates.Jinja2TextHandler(None)
+        segments = ['Hi ', '{{ fn("a") }}', ' and ', '{{ fn("a") }}']
+        expected = '{{ _("Hi %(fn)s and %(fn)s", fn=fn(_TODO("a"))) }}'
+        before = i18nize_templates.expression_cache_info()
+        self.assertEqual(expected, handler.add_underscore(segments))
+        self.assertEqual(expected, handler.add_underscore(segments))
+        after = i18nize_templates.expression_cache_info()
+        self.assertEqual(1, after.misses - before.misses)
+        self.assertEqual(3, after.hits - before.hits)
+
+    def test_memo_is_cleared_by_customizations(self):
+        self.check('{{ fn("a", b="c") }}',
+                   '{{ fn(_TODO("a"), b=_TODO("c")) }}')
+        i18nize_templates.mark_function_arg_is_not_nltext('a')
+        self.check('{{ fn("a", b="c") }}', '{{ fn("a", b=_TODO("c")) }}')
+        i18nize_templates.mark_function_param_lacks_nltext('b')
+        self.check('{{ fn("a", b="c") }}', '{{ fn("a", b="c") }}')
+        self.check('{{ g("d") }}', '{{ g(_TODO("d")) }}')
+        i18nize_templates.mark_function_args_lack_nltext('g')
+        self.check('{{ g("d") }}', '{{ g("d") }}')
+
+
+class FunctionNameMatcherTest(TestBase):
+    def matches(self, regexps, expression):
+        """True if the fn called in expression is matched by regexps."""
+        matcher = i18nize_templates._FunctionNameMatcher(regexps)
+        return matcher.matches(expression, 0, expression.index('('))
+
+    def test_names(self):
+        self.assertTrue(self.matches(['myfn', 'other'], 'myfn("a")'))
+        self.assertTrue(self.matches(['myfn'], 'myfn  ("a")'))
+        self.assertTrue(self.matches(['myfn'], 'foo.myfn("a")'))
+        self.assertFalse(self.matches(['myfn'], 'foo_myfn("a")'))
+        self.assertFalse(self.matches(['myfn'], 'myfn.foo("a")'))
+        self.assertFalse(self.matches([], 'myfn("a")'))
+
+    def test_dotted_names(self):
+        self.assertTrue(self.matches(['log.date'], 'log.date("a")'))
+        self.assertTrue(self.matches(['log.date'], 'x.log.date("a")'))
+        self.assertFalse(self.matches(['log.date'], 'log.dates("a")'))
+        # The '.' is still a regexp '.', as with the regexp we replaced.
+        self.assertTrue(self.matches(['log.date'], 'log_date("a")'))
+        self.assertTrue(self.matches(['log.'], 'log ("a")'))
+
+    def test_regexps(self):
+        self.assertTrue(self.matches(['my.*', 'other'], 'myfn("a")'))
+        self.assertTrue(self.matches(['my.*'], 'foo.myfn("a")'))
+        self.assertFalse(self.matches(['my.*'], 'foo_myfn("a")'))
+        self.assertTrue(self.matches(['[fg]n'], 'gn("a")'))
+
+    def test_many_names(self):
+        names = ['helper_%d' % i for i in range(1000)]
+        names += ['pkg.helper_%d' % i for i in range(1000)]
+        self.assertTrue(self.matches(names, 'helper_999("a")'))
+        self.assertTrue(self.matches(names, 'pkg.helper_5("a")'))
+        self.assertFalse(self.matches(names, 'helper_1000("a")'))
+        config = i18nize_templates.I18nizeConfig(ok_functions=names)
+        handler = i18nize_templates.Jinja2TextHandler(None, config)
+        self.assertEqual('{{ _("Hi %(helper_5)s", '
+                         'helper_5=helper_5("a", f(_TODO("b")))) }}',
+                         handler.add_underscore(
+                             ['Hi ', '{{ helper_5("a", f("b")) }}']))
+
+
 class HandlebarsTest(TestBase):
     def check(self, input, expected):
         text_handler = i18nize_templates.HandlebarsTextHandler
@@ -707,5 +1978,141 @@ class CustomizationTest(TestBase):
         self.check('{{ fn("barg") }}', '{{ fn(_TODO("barg")) }}')
 
 
+class I18nizeConfigTest(TestBase):
+    """Test using customizations other than the module-wide ones."""
+    def i18nize(self, input, config=None):
+        parser = i18nize_templates.get_parser_for_file('x.jinja2',
+                                                       config=config)
+        return parser.parse(input)
+
+    def test_configs_coexist(self):
+        input = '<p><span data-x="Go" class="sep">Hi</span> there</p>'
+        plain = i18nize_templates.I18nizeConfig()
+        plain_output = self.i18nize(input, plain)
+        custom = plain.replace(
+            nltext_tag_attributes=(plain.nltext_tag_attributes +
+                                   (('span', 'data-x'),)),
+            nltext_separator_classes=('sep',))
+        self.assertEqual('<p>{{ _("<span data-x=\\"Go\\" '
+                         'class=\\"sep\\">Hi</span> there") }}</p>',
+                         self.i18nize(input, plain))
+        self.assertEqual('<p><span data-x="{{ _("Go") }}" class="sep">'
+                         '{{ _("Hi</span> there") }}</p>',
+                         self.i18nize(input, custom))
+        # And again, to make sure the memos didn't mix them up.
+        self.assertEqual(plain_output, self.i18nize(input, plain))
+
+    def test_expressions(self):
+        config = i18nize_templates.I18nizeConfig(ok_functions=('fn',))
+        segments = ['Hi ', '{{ fn("a") }}']
+        self.assertEqual(
+            '{{ _("Hi %(fn)s", fn=fn(_TODO("a"))) }}',
+            i18nize_templates.Jinja2TextHandler(None).add_underscore(
+                segments))
+        self.assertEqual(
+            '{{ _("Hi %(fn)s", fn=fn("a")) }}',
+            i18nize_templates.Jinja2TextHandler(None, config).add_underscore(
+                segments))
+
+    def test_default_config_customizations_do_not_leak(self):
+        config = i18nize_templates.I18nizeConfig()
+        i18nize_templates.add_nltext_tag_attribute('span', 'data-x')
+        input = '<p><span data-x="Go">Hi</span></p>'
+        self.assertEqual('<p><span data-x="{{ _("Go") }}">{{ _("Hi") }}'
+                         '</span></p>',
+                         self.i18nize(input))
+        self.assertEqual('<p><span data-x="Go">{{ _("Hi") }}</span></p>',
+                         self.i18nize(input, config))
+
+    def test_immutable(self):
+        config = i18nize_templates.I18nizeConfig()
+        with self.assertRaises(AttributeError):
+            config.ok_functions = ('fn',)
+        other = config.replace(ok_functions=['fn'])
+        self.assertEqual(('fn',), other.ok_functions)
+        self.assertIn('attr', config.ok_functions)
+        self.assertEqual(config.nltext_tag_attributes,
+                         other.nltext_tag_attributes)
+
+    def test_pickle(self):
+        config = i18nize_templates.I18nizeConfig(ok_functions=('fn',),
+                                                 cache_size=5)
+        config.rewrite_expression('fn("a")')
+        copy = pickle.loads(pickle.dumps(config))
+        self.assertEqual(repr(config), repr(copy))
+        self.assertEqual(config.fingerprint(), copy.fingerprint())
+        self.assertEqual(0, copy.rewrite_expression.cache_info().currsize)
+
+    def test_fingerprint(self):
+        config = i18nize_templates.I18nizeConfig()
+        self.assertEqual(config.fingerprint(),
+                         config.replace(cache_size=1).fingerprint())
+        self.assertNotEqual(
+            config.fingerprint(),
+            config.replace(ok_function_params=('style', 'x')).fingerprint())
+
+
+class ConfigFileTest(TempDirTestBase):
+    """Test reading customizations from a config file."""
+    def load(self, filename, contents):
+        path = os.path.join(self.tmpdir, filename)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return i18nize_templates.load_config(path)
+
+    def test_toml(self):
+        if i18nize_templates.tomllib is None:
+            self.skipTest('no TOML parser')
+        config = self.load('i18nize.toml',
+                           'nltext_tag_attributes = [\n'
+                           '    ["span", "data-x"],\n'
+                           '    ["input", "value", ["type", "reset"]],\n'
+                           ']\n'
+                           'ok_functions = ["log.date.strftime", "fn"]\n')
+        defaults = i18nize_templates.I18nizeConfig()
+        self.assertEqual(defaults.nltext_tag_attributes +
+                         (('span', 'data-x'),
+                          ('input', 'value', ('type', 'reset'))),
+                         config.nltext_tag_attributes)
+        self.assertEqual(defaults.ok_functions + ('log.date.strftime', 'fn'),
+                         config.ok_functions)
+        self.assertEqual(defaults.ok_function_params,
+                         config.ok_function_params)
+        self.assertEqual([1], list(config.natural_language_attributes(
+            'input', [('type', 'reset'), ('value', 'Clear')])))
+
+    def test_json(self):
+        config = self.load('i18nize.json',
+                           '{"nltext_separator_classes": ["sep"],'
+                           ' "ok_function_arguments": ["#.*"]}')
+        self.assertEqual(('sep',), config.nltext_separator_classes[-1:])
+        self.assertEqual(('#.*',), config.ok_function_arguments[-1:])
+        parser = i18nize_templates.get_parser_for_file('x.jinja2',
+                                                       config=config)
+        self.assertEqual('{{ _("a") }}<span class="sep"></span>{{ _("b") }}',
+                         parser.parse('a<span class="sep"></span>b'))
+
+    def test_same_contents_same_config(self):
+        contents = '{"ok_functions": ["fn"]}'
+        self.assertIs(self.load('a.json', contents),
+                      self.load('b.json', contents))
+        self.assertIsNot(self.load('a.json', contents),
+                         self.load('a.json', '{"ok_functions": ["g"]}'))
+
+    def test_errors(self):
+        for contents in ('[]', '{"no_such_setting": []}',
+                         '{"ok_functions": "fn"}', '{"ok_functions": [1]}',
+                         '{"nltext_tag_attributes": [["span"]]}',
+                         '{"nltext_tag_attributes": [["a", "b", "c"]]}',
+                         '{"ok_functions": ',
+                         '{"ok_functions": ["foo("]}',
+                         '{"ok_function_params": ["a)"]}',
+                         '{"ok_function_arguments": ["*x"]}',
+                         '{"nltext_separator_classes": ["[x"]}'):
+            with self.assertRaises(ValueError) as cm:
+                self.load('bad.json', contents)
+            self.assertIn('bad.json: ', str(cm.exception))
+
+
 if __name__ == '__main__':
     unittest.main()